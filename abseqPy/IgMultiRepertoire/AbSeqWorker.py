@@ -1,8 +1,15 @@
 import traceback
 import sys
+import os
+import logging
 
 from multiprocessing import Process, current_process, Lock, Value
 
+from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import setMemoryBudget
+from abseqPy.instrumentation import StageTimer, setRunStats, loadRunStats
+from abseqPy.IgRepReporting.runReport import writeRunReport
+
 
 class AbSeqWorker(Process):
     ops = FASTQC, ANNOT, ABUN, PROD, DIVER, SECR, UTR5, RSA, PRIM, SEQLEN = 'runFastqc', 'annotateClones', \
@@ -14,6 +21,31 @@ class AbSeqWorker(Process):
                                                                           'analyzeRestrictionSites', \
                                                                           'analyzePrimerSpecificity', \
                                                                           'analyzeSeqLen'
+    # tasks that provide a resource other tasks share, they are added to the task graph when needed
+    MERGE, STORE = 'mergePairedReads', '_loadSeqStore'
+
+    # resources shared by the tasks of a sample
+    resources = READS, SEQSTORE, ANNOTATION, REFINED, PRIMERS, CLONOTYPES = 'reads', 'seqStore', 'cloneAnnot', \
+                                                                          'refinedCloneAnnot', \
+                                                                          'primerCloneAnnot', 'clonotypes'
+
+    # task -> (resources it requires, resources it produces), see TaskGraph
+    io = {
+        FASTQC: ((), ()),
+        MERGE: ((), (READS,)),
+        STORE: ((READS,), (SEQSTORE,)),
+        ANNOT: ((READS, SEQSTORE), (ANNOTATION,)),
+        ABUN: ((READS, SEQSTORE, ANNOTATION), ()),
+        PROD: ((READS, SEQSTORE, ANNOTATION), (REFINED,)),
+        DIVER: ((READS, SEQSTORE, ANNOTATION, REFINED), (CLONOTYPES,)),
+        SECR: ((READS, SEQSTORE, ANNOTATION), ()),
+        UTR5: ((READS, SEQSTORE, ANNOTATION), ()),
+        RSA: ((READS, SEQSTORE, ANNOTATION, REFINED), ()),
+        PRIM: ((READS, SEQSTORE, ANNOTATION, REFINED), (PRIMERS,)),
+        SEQLEN: ((READS,), ())
+    }
+
+    providers = {READS: MERGE, SEQSTORE: STORE}
 
     def __init__(self, repertoire, resultQueue, resourcePool):
         super(AbSeqWorker, self).__init__()
@@ -22,29 +54,104 @@ class AbSeqWorker(Process):
         self.resourcePool = resourcePool
 
     def run(self):
-        while True:
-
-            task, args, kwargs = self.repertoire._nextTask()
-            if task is None:
-                # all jobs done for this repertoire
-                self.repertoire._minimize()
-                self.resultQueue.put(self.repertoire)
-                # return resource to available pool
-                self.resourcePool.increment(self.repertoire.threads)
-                break
-            try:
-                self.repertoire.threads += self.resourcePool.consume()
-                getattr(self.repertoire, task)(*args, **kwargs)
-            except Exception as e:
-                exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
-                fmtMsg = ("Job name: " + str(self.repertoire.name) + " :: An error occurred while processing " +
-                          str(task))
-                newE = e.message
-                if self.resultQueue is not None:
-                    self.resultQueue.put((newE, fmtMsg, traceback.format_exception(exceptionType, exceptionValue,
-                                                                                   exceptionTraceback)))
+        """
+        runs the task graph of the repertoire. Tasks whose dependencies are done are started together and share
+        the threads of the repertoire. The tasks other tasks depend on run in this process, so that the resources
+        they leave in the repertoire object (e.g. the clone annotation dataframe) are there for the tasks that
+        depend on them. The others run in forked processes, each with a snapshot of the repertoire as it is when
+        they start. Every stage records its statistics, they are summarized in the run report of the sample once
+        all its tasks are done
+
+        :return: None
+        """
+        # every stage of this sample (and the processes it spawns) sizes itself against the sample's budget
+        setMemoryBudget(self.repertoire.memory)
+        # and records its statistics in the same file
+        statsFile = os.path.join(self.repertoire.hdfDir, "run_stats.jsonl")
+        setRunStats(statsFile)
+        logger = logging.getLogger(self.repertoire.name)
+        graph = self.repertoire._tasks
+        threads = self.repertoire.threads
+        # forked process -> (task, threads)
+        running = {}
+        while len(graph):
+            threads += self.resourcePool.consume()
+            ready = graph.ready(running=[task for task, _ in running.values()])
+            if not ready:
+                # everything left depends on a task that is still running
+                self._reap(graph, running, block=True)
                 continue
-        return
+            producers = [task for task in ready if graph.hasDependents(task)]
+            local = (producers or ready)[0]
+            forked = [task for task in ready if task is not local and task not in producers]
+            free = threads - sum(n for _, n in running.values())
+            share = max(1, free // (len(forked) + 1))
+            for task in forked:
+                printto(logger, "{} is running alongside {}".format(task, local), LEVEL.DEBUG)
+                self.repertoire.threads = share
+                proc = Process(target=self._runForked, args=(task,))
+                proc.start()
+                running[proc] = (task, share)
+            self.repertoire.threads = max(1, free - share * len(forked))
+            self._runTask(task=local)
+            self.repertoire.threads = threads
+            graph.done(local)
+            self._reap(graph, running)
+        # all jobs done for this repertoire
+        try:
+            writeRunReport(loadRunStats(statsFile), self.repertoire.name, self.repertoire.auxDir, stream=logger)
+        except Exception as e:
+            # the report is a summary, the sample's results are worth more than it
+            printto(logger, "Run report of {} could not be written: {}".format(self.repertoire.name, e), LEVEL.WARN)
+        self.repertoire.threads = threads
+        self.repertoire._minimize()
+        self.resultQueue.put(self.repertoire)
+        # return resource to available pool
+        self.resourcePool.increment(self.repertoire.threads)
+
+    def _runTask(self, task):
+        """
+        :param task: Task to run on the repertoire of this worker
+        :return: True if the task succeeded. Otherwise, the error is put in the results queue
+        """
+        try:
+            with StageTimer(task.method):
+                getattr(self.repertoire, task.method)(**task.kwargs)
+            return True
+        except Exception as e:
+            exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
+            fmtMsg = ("Job name: " + str(self.repertoire.name) + " :: An error occurred while processing " +
+                      str(task.method))
+            newE = e.message
+            if self.resultQueue is not None:
+                self.resultQueue.put((newE, fmtMsg, traceback.format_exception(exceptionType, exceptionValue,
+                                                                               exceptionTraceback)))
+            return False
+
+    def _runForked(self, task):
+        if not self._runTask(task):
+            sys.exit(1)
+
+    @staticmethod
+    def _reap(graph, running, block=False):
+        """
+        marks the tasks of the forked processes that have exited as done
+
+        :param graph: TaskGraph
+        :param running: dict of forked process -> (task, threads), exited processes are removed from it
+        :param block: bool. If True, waits for at least one process to exit
+        :return: None
+        """
+        while running:
+            for proc in list(running):
+                if not proc.is_alive():
+                    proc.join()
+                    graph.done(running.pop(proc)[0])
+                    block = False
+            if not block:
+                return
+            # wait a little for the first process to exit
+            next(iter(running)).join(0.1)
 
 
 class AbSeqWorkerException(Exception):
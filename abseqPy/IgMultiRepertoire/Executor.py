@@ -0,0 +1,297 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+import math
+import time
+import errno
+import pickle
+import socket
+import logging
+
+from uuid import uuid4
+from multiprocessing import Queue, cpu_count
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker, AbSeqWorkerException, ResourcePool
+from abseqPy.logger import printto, setupLogger, LEVEL
+from abseqPy.utilities import memoryBudget, setCpuSlots
+
+
+# share of the CPUs of a host that its samples may use
+HOST_CPU_FRACTION = 0.8
+
+
+def hostThreads():
+    """
+    :return: int. number of threads the samples run by this host may use in total
+    """
+    return max(1, int(math.floor(cpu_count() * HOST_CPU_FRACTION)))
+
+
+class LocalExecutor(object):
+    """
+    runs every sample in its own AbSeqWorker process on this host, all at the same time
+    """
+
+    def __init__(self, resultQueue, cpuSlots=None):
+        """
+        :param resultQueue: multiprocessing queue the workers send their repertoire (or their error) back with
+        :param cpuSlots: int. size of the run-wide CPU slots pool, see utilities.setCpuSlots
+        """
+        self.resultQueue = resultQueue
+        self.cpuSlots = cpuSlots
+
+    def run(self, repertoires):
+        """
+        :param repertoires: list of IgRepertoire objects
+        :return: list of the IgRepertoire objects sent back by the workers once they are done, in the order they
+        finished. An AbSeqWorkerException is raised as soon as a worker reports an error
+        """
+        # resource pool - initially all consumed by repertoire objects
+        resourcePool = ResourcePool(0)
+
+        # the workers (and every process they spawn) inherit the CPU slots
+        setCpuSlots(self.cpuSlots)
+
+        # initialize workers
+        workers = [AbSeqWorker(rep, self.resultQueue, resourcePool) for rep in repertoires]
+        done = []
+        try:
+            # start workers
+            for w in workers:
+                w.start()
+
+            # wait for all workers to complete
+            for _ in range(len(workers)):
+                res = self.resultQueue.get()
+                if isinstance(res, tuple):
+                    # XXX: encountered an exception! - here, decide to raise it immediately.
+                    # all accompanying processes will halt immediately due to this raise.
+                    raise AbSeqWorkerException(*res)
+                done.append(res)
+
+            for w in workers:
+                w.join()
+        finally:
+            # samples never hold CPU slots themselves, their chunk workers do (and are stopped with
+            # utilities.stopWorkers). Besides, the pool is dropped along with the samples
+            for w in workers:
+                w.terminate()
+            setCpuSlots(None)
+        return done
+
+
+class SharedQueueExecutor(object):
+    """
+    job queue of samples in a directory of a filesystem shared by several hosts. The samples are queued by the
+    host that runs abseq, every host that works the queue (that one, and the ones running abseq-worker on the same
+    directory) claims samples as long as it has threads to spare, and runs them as LocalExecutor does. All hosts
+    write their results in the outdir of the samples, which must be on the shared filesystem as well.
+
+    A sample is a pickled IgRepertoire object, it moves between the sub-directories of the queue directory::
+
+        <queueDir>/pending/<job>.pkl    waiting for a host
+        <queueDir>/running/<job>.pkl    claimed by a host (claims are atomic renames from pending)
+        <queueDir>/done/<job>.pkl       the repertoire, once all its tasks are done
+        <queueDir>/failed/<job>.pkl     the (message, errors, traceback) tuple of the first error of the sample
+
+    A sample claimed by a host that died stays in running, it can be queued again by moving it back to pending
+    """
+
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+    def __init__(self, queueDir, threads=None, poll=2.0, stream=None):
+        """
+        :param queueDir: string. queue directory, it is created if needed
+        :param threads: int. threads this host lends to the samples it claims. Defaults to hostThreads()
+        :param poll: float. seconds between two looks at the queue directory when there is nothing else to do
+        :param stream: logging stream
+        """
+        self.queueDir = os.path.abspath(queueDir)
+        self.threads = max(1, threads if threads is not None else hostThreads())
+        self.poll = poll
+        self.stream = stream
+        for state in (SharedQueueExecutor.PENDING, SharedQueueExecutor.RUNNING,
+                      SharedQueueExecutor.DONE, SharedQueueExecutor.FAILED):
+            try:
+                os.makedirs(os.path.join(self.queueDir, state))
+            except OSError as e:
+                # another host got there first
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, state, job):
+        return os.path.join(self.queueDir, state, job + ".pkl")
+
+    def _dump(self, obj, state, job):
+        # written next to its destination first, so that other hosts never see a partial file
+        tmpFile = os.path.join(self.queueDir, "{}.{}.{}.tmp".format(job, socket.gethostname(), os.getpid()))
+        with open(tmpFile, 'wb') as fp:
+            pickle.dump(obj, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFile, self._path(state, job))
+
+    def _load(self, state, job):
+        with open(self._path(state, job), 'rb') as fp:
+            return pickle.load(fp)
+
+    def run(self, repertoires):
+        """
+        queues the repertoires, works the queue along with the other hosts until no sample is pending, and waits
+        for the samples other hosts are still running
+
+        :param repertoires: list of IgRepertoire objects
+        :return: list of the IgRepertoire objects once they are done, in the order of repertoires. An
+        AbSeqWorkerException is raised if one of them failed
+        """
+        jobs = self.submit(repertoires)
+        self.work()
+        return self.collect(jobs)
+
+    def submit(self, repertoires):
+        """
+        :param repertoires: list of IgRepertoire objects
+        :return: list of job names, one per repertoire
+        """
+        jobs = []
+        for rep in repertoires:
+            job = "{}_{}".format(rep.name, uuid4().hex)
+            self._dump(rep, SharedQueueExecutor.PENDING, job)
+            jobs.append(job)
+        printto(self.stream, "{:,} sample(s) were queued in {}".format(len(jobs), self.queueDir))
+        return jobs
+
+    def collect(self, jobs):
+        """
+        waits for the jobs to be done (or to fail)
+
+        :param jobs: list of job names, as returned by submit
+        :return: list of IgRepertoire objects, in the order of jobs
+        """
+        results = {}
+        while len(results) < len(jobs):
+            for job in jobs:
+                if job in results:
+                    continue
+                if os.path.exists(self._path(SharedQueueExecutor.FAILED, job)):
+                    raise AbSeqWorkerException(*self._load(SharedQueueExecutor.FAILED, job))
+                if os.path.exists(self._path(SharedQueueExecutor.DONE, job)):
+                    results[job] = self._load(SharedQueueExecutor.DONE, job)
+            if len(results) < len(jobs):
+                time.sleep(self.poll)
+        return [results[job] for job in jobs]
+
+    def claim(self):
+        """
+        :return: (job, repertoire) tuple of the oldest pending sample this host managed to claim, or (None, None)
+        if there is none left
+        """
+        pendingDir = os.path.join(self.queueDir, SharedQueueExecutor.PENDING)
+        pending = sorted(os.listdir(pendingDir), key=lambda f: os.path.getmtime(os.path.join(pendingDir, f))
+                         if os.path.exists(os.path.join(pendingDir, f)) else 0)
+        for filename in pending:
+            job = os.path.splitext(filename)[0]
+            try:
+                os.rename(self._path(SharedQueueExecutor.PENDING, job), self._path(SharedQueueExecutor.RUNNING, job))
+            except OSError:
+                # claimed by another host in the meantime
+                continue
+            return job, self._load(SharedQueueExecutor.RUNNING, job)
+        return None, None
+
+    def work(self, wait=False):
+        """
+        claims pending samples and runs them, each in its own AbSeqWorker, as long as the samples running on this
+        host use fewer threads than it lends to the queue
+
+        :param wait: bool. If True, keeps waiting for new samples once the queue is empty. Otherwise, returns once
+        the queue is empty and the samples this host claimed are done
+        :return: None
+        """
+        # job -> (worker, results queue, threads), the samples running on this host
+        running = {}
+        failed = set()
+        setCpuSlots(self.threads)
+        try:
+            while True:
+                while sum(n for _, _, n in running.values()) < self.threads:
+                    job, rep = self.claim()
+                    if job is None:
+                        break
+                    running[job] = self._start(job, rep)
+                if not running and not wait and not os.listdir(os.path.join(self.queueDir,
+                                                                            SharedQueueExecutor.PENDING)):
+                    break
+                if not self._reap(running, failed):
+                    time.sleep(self.poll if not running else min(self.poll, 0.5))
+        finally:
+            # as in LocalExecutor.run, terminating a sample never takes CPU slots away from the others
+            for w, _, _ in running.values():
+                w.terminate()
+            setCpuSlots(None)
+
+    def _start(self, job, rep):
+        rep.threads = min(rep.threads, self.threads)
+        rep.args['threads'] = rep.threads
+        if rep.memory is None:
+            # this host's memory goes to its samples in proportion to their threads
+            rep.memory = int(memoryBudget() * rep.threads // self.threads)
+            rep.args['memory'] = rep.memory
+        if not logging.getLogger(rep.name).handlers:
+            # the sample was queued by another host
+            setupLogger(rep.name, rep.task, rep.args['log'])
+        printto(logging.getLogger(rep.name), "The sample was claimed by {} (process {}) from the job queue {}"
+                .format(socket.gethostname(), os.getpid(), self.queueDir), LEVEL.INFO)
+        resultQueue = Queue()
+        worker = AbSeqWorker(rep, resultQueue, ResourcePool(0))
+        worker.start()
+        return worker, resultQueue, rep.threads
+
+    def _reap(self, running, failed):
+        """
+        moves the samples running on this host that are done to done (or failed)
+
+        :param running: dict of job -> (worker, results queue, threads), finished jobs are removed from it
+        :param failed: set of the jobs that reported an error
+        :return: bool. True if anything was reaped
+        """
+        reaped = False
+        for job in list(running):
+            worker, resultQueue, _ = running[job]
+            exited = not worker.is_alive()
+            while True:
+                try:
+                    # a worker that exited may still have results in the pipe
+                    res = resultQueue.get(timeout=(1 if exited else 0.01))
+                except Empty:
+                    break
+                if isinstance(res, tuple):
+                    # only the first error of a sample is reported
+                    if job not in failed:
+                        failed.add(job)
+                        self._dump(res, SharedQueueExecutor.FAILED, job)
+                    printto(self.stream, res[1], LEVEL.ERR)
+                    continue
+                if job not in failed:
+                    self._dump(res, SharedQueueExecutor.DONE, job)
+                exited = True
+                worker.join()
+                break
+            if exited:
+                if job not in failed and not os.path.exists(self._path(SharedQueueExecutor.DONE, job)):
+                    failed.add(job)
+                    self._dump(("", "Job name: " + job + " :: the worker exited with code " + str(worker.exitcode),
+                                []), SharedQueueExecutor.FAILED, job)
+                os.remove(self._path(SharedQueueExecutor.RUNNING, job))
+                del running[job]
+                reaped = True
+        return reaped
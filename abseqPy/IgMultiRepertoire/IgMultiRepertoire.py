@@ -1,14 +1,15 @@
 from __future__ import print_function
 import os
 import sys
-import math
 
 from multiprocessing import Queue, cpu_count
 
 from abseqPy.config import AUX_FOLDER
-from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker, AbSeqWorkerException, ResourcePool
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorkerException
+from abseqPy.IgMultiRepertoire.Executor import LocalExecutor, SharedQueueExecutor, hostThreads
 from abseqPy.IgRepertoire.IgRepertoire import IgRepertoire
 from abseqPy.argsParser import parseYAML, parseArgs
+from abseqPy.utilities import memoryBudget
 
 
 class IgMultiRepertoire:
@@ -28,28 +29,46 @@ class IgMultiRepertoire:
             args.log = os.path.join(args.outdir, AUX_FOLDER, args.name, "{}.log".format(args.name))
             self.buffer.append(IgRepertoire(**vars(args)))
         self.sampleCount = len(self.buffer)
+        self.queue = args.queue
+        self.cpuSlots = None
+        # every host working the queue fits the samples it claims to its own CPUs and memory (see
+        # SharedQueueExecutor), local samples are fitted to this host's now
+        if self.queue is None:
+            self._fitToHost(args.memory)
+
+    def _fitToHost(self, memory=None):
+        """
+        shares the CPUs and the memory budget of this host between the samples, which all run at the same time
+
+        :param memory: int. memory budget of the run in bytes, defaults to utilities.memoryBudget()
+        :return: None
+        """
         availCPUs = cpu_count()
         requestedCPU = sum([s.threads for s in self.buffer])
+        self.cpuSlots = requestedCPU
 
         if availCPUs and  requestedCPU > availCPUs:
             # only use 80% of max CPU please
-            cappedCPU = math.floor(availCPUs * 0.8)
+            cappedCPU = hostThreads()
 
             print("Detected {} available CPUs but jobs are running {}"
                   " processes in total.".format(availCPUs, requestedCPU))
-            print("Capping total processes to {}.".format(cappedCPU))
+            print("Capping the chunks analysed at once, across all samples, to {}.".format(cappedCPU))
             print("Please refer to abseqPy's README, under the 'Gotcha' section to learn more about this message.")
 
-            perSampleProcess = int(math.floor((cappedCPU * 1.0) / len(self.buffer)))
-
+            # rather than splitting the CPUs between the samples up front, every sample keeps its workers and the
+            # chunks of all samples take turns on cappedCPU slots (see utilities.setCpuSlots), so the slots small
+            # samples no longer need go to the large ones as soon as their chunks are done
             for sample in self.buffer:
-                sample.threads = max(perSampleProcess, 1)
+                sample.threads = min(sample.threads, cappedCPU)
                 sample.args['threads'] = sample.threads
+            self.cpuSlots = cappedCPU
 
-            # make sure that we're not going over the capped value unless there's already more samples than there
-            # are CPU counts, in that occasion, the code snippet above should've assigned (1) to sample.threads for
-            # all samples.
-            assert sum([s.threads for s in self.buffer]) <= cappedCPU or all([s.threads == 1 for s in self.buffer])
+        # all samples run at the same time, they share the memory budget of the run evenly
+        perSampleMem = int((memory if memory is not None else memoryBudget()) // self.sampleCount)
+        for sample in self.buffer:
+            sample.memory = perSampleMem if sample.memory is None else min(sample.memory, perSampleMem)
+            sample.args['memory'] = sample.memory
 
     def __enter__(self):
         return self
@@ -60,29 +79,14 @@ class IgMultiRepertoire:
         self.result.join_thread()
 
     def start(self):
-
-        # resource pool - initially all consumed by repertoire objects
-        resourcePool = ResourcePool(0)
-
-        # initialize workers
-        workers = [AbSeqWorker(rep, self.result, resourcePool) for rep in self.buffer]
+        if self.queue is not None:
+            # the samples are spread over every host working the queue
+            executor = SharedQueueExecutor(self.queue)
+        else:
+            executor = LocalExecutor(self.result, cpuSlots=self.cpuSlots)
 
         try:
-            # start workers
-            for w in workers:
-                w.start()
-
-            # wait for all workers to complete
-            for i in range(self.sampleCount):
-                res = self.result.get()
-                if isinstance(res, tuple):
-                    # XXX: encountered an exception! - here, decide to raise it immediately.
-                    # all accompanying processes will halt immediately due to this raise.
-                    raise AbSeqWorkerException(*res)
-                self.buffer.append(res)
-
-            for w in workers:
-                w.join()
+            self.buffer.extend(executor.run(self.buffer[:self.sampleCount]))
             # done
 
         except AbSeqWorkerException as e:
@@ -97,7 +101,4 @@ class IgMultiRepertoire:
         # catch-all exception
         except Exception as e:
             raise e
-        finally:
-            for w in workers:
-                w.terminate()
 
@@ -0,0 +1,94 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+
+
+class Task(object):
+    def __init__(self, method, kwargs, requires, produces):
+        """
+        :param method: string. name of the IgRepertoire method that runs the task
+        :param kwargs: dict. keyword arguments of method
+        :param requires: tuple of the resources the task reads
+        :param produces: tuple of the resources the task writes, including the required resources that it has to
+        produce on demand because no earlier task does
+        """
+        self.method = method
+        self.kwargs = kwargs
+        self.requires = requires
+        self.produces = produces
+        self.deps = set()
+
+    def __repr__(self):
+        return self.method + ("(" + ", ".join("{}={}".format(k, v) for k, v in sorted(self.kwargs.items())) + ")"
+                              if self.kwargs else "")
+
+
+class TaskGraph(object):
+    """
+    the tasks of a sample, with the dependencies between them made explicit. Tasks share resources (the merged reads,
+    the sequence store, the clone annotation dataframes, ...) through the IgRepertoire object and its output
+    directory. Every task declares the resources it requires and the ones it produces, a task depends on the
+    latest earlier task that produces one of the resources it requires or produces.
+
+    A required resource that no earlier task produces is either produced by the provider task of that resource,
+    which is then added to the graph right before the task, or, if the resource has no provider, on demand by the
+    task itself (e.g. analyzeAbundance annotates the clones if no annotation task was requested).
+
+    Tasks that do not depend on each other (directly or not) can run at the same time
+    """
+
+    def __init__(self, todo, io, providers):
+        """
+        :param todo: list of the requested tasks, in order. A task is either the name of an IgRepertoire method or
+        a (name, kwargs) tuple
+        :param io: dict of task name -> (requires, produces) tuple of resources
+        :param providers: dict of resource -> name of the task that produces it (and nothing else) on its own
+        """
+        self.tasks = []
+        self._io = io
+        self._providers = providers
+        self._producers = {}
+        for pack in todo:
+            method, kwargs = (pack, {}) if isinstance(pack, str) else pack
+            self._add(method, kwargs)
+        self._done = set()
+
+    def _add(self, method, kwargs):
+        requires, produces = self._io[method]
+        onDemand = []
+        for res in requires:
+            if res not in self._producers:
+                if res in self._providers and self._providers[res] != method:
+                    self._add(self._providers[res], {})
+                else:
+                    onDemand.append(res)
+        task = Task(method, kwargs, tuple(requires), tuple(produces) + tuple(onDemand))
+        task.deps = set(self._producers[res] for res in set(requires) | set(produces) if res in self._producers)
+        for res in task.produces:
+            self._producers[res] = task
+        self.tasks.append(task)
+        return task
+
+    def __len__(self):
+        return len(self.tasks) - len(self._done)
+
+    def ready(self, running=()):
+        """
+        :param running: tasks that have been started but are not done yet
+        :return: list of the tasks, in request order, that have not been started and whose dependencies are done
+        """
+        return [task for task in self.tasks if task not in self._done and task not in running and
+                task.deps <= self._done]
+
+    def hasDependents(self, task):
+        """
+        :param task: Task
+        :return: True if a task that is not done yet depends on task
+        """
+        return any(task in other.deps for other in self.tasks if other not in self._done)
+
+    def done(self, task):
+        self._done.add(task)
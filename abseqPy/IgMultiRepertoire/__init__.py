@@ -1,5 +1,7 @@
 __all__ = [
     'AbSeqWorker',
+    'Executor',
     'IgMultiRepertoire',
-    'PlotManager'
+    'PlotManager',
+    'TaskGraph'
 ]
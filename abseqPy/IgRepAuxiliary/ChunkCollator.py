@@ -0,0 +1,108 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+
+import sys
+
+from itertools import chain
+from pandas import concat
+from pandas.core.frame import DataFrame
+
+from abseqPy.logger import printto, LEVEL
+
+
+class ChunkCollator(object):
+    """
+    gathers the results that workers computed for numbered chunks of sequences. Results can arrive in any order,
+    they are kept aside (keyed by their chunk index) and only stitched together once all of them are in, so that
+    the collated result follows the order of the reads in the input file, regardless of which worker finished first
+    """
+
+    def __init__(self, noSeqs, desc="records", stream=None):
+        """
+        :param noSeqs: int. total number of sequences expected across all chunks (used for progress messages)
+        :param desc: string. what the sequences should be called in progress messages
+        :param stream: logging stream
+        """
+        self.noSeqs = noSeqs
+        self.desc = desc
+        self.stream = stream
+        self.chunks = {}
+        self.failed = []
+        self.collected = 0
+
+    def add(self, index, payload, size=0):
+        """
+        registers the result of a chunk
+
+        :param index: chunk index, as assigned when the chunk was handed to a worker
+        :param payload: the worker's result for this chunk, None if the worker failed to process the chunk
+        :param size: number of sequences this payload accounts for
+        :return: None
+        """
+        if payload is None:
+            self.failed.append(index)
+            return
+        if index in self.chunks:
+            raise ValueError("Chunk {} has been collated more than once".format(index))
+        self.chunks[index] = payload
+        before = self.collected
+        self.collected += size
+        if self.collected // 50000 > before // 50000:
+            printto(self.stream, "\t{:,}/{:,} {} have been collected ... "
+                    .format(self.collected, self.noSeqs, self.desc))
+            sys.stdout.flush()
+
+    def collect(self, queue, totalChunks, sizeOf=len):
+        """
+        blocks until totalChunks (index, payload) tuples have been read from the queue
+
+        :param queue: multiprocessing queue the workers put their (index, payload) results in
+        :param totalChunks: int. number of chunks that were handed out
+        :param sizeOf: callable that returns the number of sequences a payload accounts for
+        :return: self
+        """
+        for _ in range(totalChunks):
+            index, payload = queue.get()
+            self.add(index, payload, size=(sizeOf(payload) if payload is not None else 0))
+        return self
+
+    def payloads(self):
+        """
+        :return: list of payloads, in ascending chunk index order. Failed chunks are left out
+        """
+        if self.failed:
+            printto(self.stream, "\t{:,} chunk(s) could not be processed and were left out"
+                    .format(len(self.failed)), LEVEL.WARN)
+        printto(self.stream, "\t{:,}/{:,} {} have been collected ... "
+                .format(self.collected, self.noSeqs, self.desc))
+        return [self.chunks[i] for i in sorted(self.chunks)]
+
+    def concatLists(self, payloads=None):
+        """
+        :param payloads: list of lists. Defaults to self.payloads()
+        :return: a single list holding the elements of every payload, in chunk order
+        """
+        if payloads is None:
+            payloads = self.payloads()
+        return list(chain.from_iterable(payloads))
+
+    def concatFrames(self, payloads=None):
+        """
+        concatenates dataframe payloads in one go (rather than growing a dataframe chunk by chunk, which copies the
+        collated rows every time)
+
+        :param payloads: list of dataframes. Defaults to self.payloads()
+        :return: a single dataframe holding the rows of every payload, in chunk order
+        """
+        if payloads is None:
+            payloads = self.payloads()
+        frames = [df for df in payloads if not df.empty]
+        if not frames:
+            return DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return concat(frames, copy=False)
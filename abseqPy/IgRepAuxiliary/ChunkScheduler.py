@@ -0,0 +1,119 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import time
+
+from math import ceil
+
+from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import memoryBudget
+
+# share of the memory budget that chunks handed out but not collated yet may hold
+IN_FLIGHT_FRACTION = 0.25
+
+
+class ChunkScheduler(object):
+    """
+    hands out contiguous row ranges of the sequences to analyse to a pool of workers, one chunk at a time, instead of
+    queueing fixed-size chunks up front. Workers take the next chunk off the shared tasks queue as soon as they are
+    done with their current one, so a slow chunk never holds up the chunks queued behind it on another worker.
+
+    The size of every new chunk is tuned on the throughput measured so far, so that a chunk keeps a worker busy for
+    about targetSeconds. Chunks get smaller towards the end of the run so that all the workers finish together.
+    The number of sequences handed out but not yet collated is bounded by maxInFlightBytes.
+
+    Tasks are (index, start, stop) tuples where index numbers the chunks in row order, workers are expected to
+    answer every task with an (index, payload) tuple on the results queue (payload is None if the chunk failed)
+    """
+
+    def __init__(self, noSeqs, noWorkers, maxChunkSize=50000, minChunkSize=20, targetSeconds=2.0,
+                 bytesPerSeq=4096, maxInFlightBytes=None, stream=None):
+        """
+        :param noSeqs: int. number of sequences (rows) to analyse
+        :param noWorkers: int. number of workers consuming the tasks queue
+        :param maxChunkSize: int. largest chunk handed out
+        :param minChunkSize: int. smallest chunk handed out (except for the very last one). The first chunks are
+        this small, until the throughput of the workers is known
+        :param targetSeconds: float. how long a worker should spend on a chunk
+        :param bytesPerSeq: int. estimate of the memory held by a sequence while it is in flight (the sequence, its
+        annotation and its results)
+        :param maxInFlightBytes: int. bound of the memory held by all chunks in flight. Defaults to a quarter of
+        the memory budget (see utilities.memoryBudget)
+        :param stream: logging stream
+        """
+        self.noSeqs = noSeqs
+        self.noWorkers = max(1, noWorkers)
+        self.maxChunkSize = max(1, maxChunkSize)
+        self.minChunkSize = max(1, min(minChunkSize, self.maxChunkSize))
+        self.targetSeconds = targetSeconds
+        self.bytesPerSeq = max(1, bytesPerSeq)
+        if maxInFlightBytes is None:
+            maxInFlightBytes = int(memoryBudget() * IN_FLIGHT_FRACTION)
+        self.maxInFlightSeqs = max(1, maxInFlightBytes // self.bytesPerSeq)
+        self.stream = stream
+        self.pending = {}
+        self.inFlight = 0
+        self.handedOut = 0
+        self.completed = 0
+        self.chunkSizes = []
+        self.started = None
+
+    def nextChunkSize(self):
+        """
+        :return: number of sequences the next chunk should have
+        """
+        remaining = self.noSeqs - self.handedOut
+        elapsed = time.time() - self.started
+        if self.completed and elapsed > 0:
+            # sequences a single worker gets through in targetSeconds
+            size = int(self.completed / elapsed / self.noWorkers * self.targetSeconds)
+        else:
+            size = self.minChunkSize
+        # leave enough chunks for every worker to get a share of what is left
+        size = min(size, self.maxChunkSize, int(ceil(remaining / (2 * self.noWorkers))))
+        size = min(size, self.maxInFlightSeqs)
+        return max(1, min(remaining, max(size, self.minChunkSize)))
+
+    def _canDispatch(self):
+        if self.handedOut >= self.noSeqs:
+            return False
+        if not self.pending:
+            return True
+        # every worker has one chunk to work on and one to pick up next, as long as memory allows it
+        return len(self.pending) < 2 * self.noWorkers and self.inFlight < self.maxInFlightSeqs
+
+    def run(self, tasksQueue, resultsQueue, collator, sizeOf=len):
+        """
+        feeds the tasks queue until all the sequences have been handed out and collects the results as they arrive
+
+        :param tasksQueue: multiprocessing queue the workers take their (index, start, stop) tasks from
+        :param resultsQueue: multiprocessing queue the workers put their (index, payload) results in
+        :param collator: ChunkCollator the results are added to
+        :param sizeOf: callable that returns the number of sequences a payload accounts for
+        :return: collator
+        """
+        self.started = time.time()
+        while self.handedOut < self.noSeqs or self.pending:
+            while self._canDispatch():
+                size = self.nextChunkSize()
+                index = len(self.chunkSizes)
+                tasksQueue.put((index, self.handedOut, self.handedOut + size))
+                self.pending[index] = size
+                self.chunkSizes.append(size)
+                self.handedOut += size
+                self.inFlight += size
+            index, payload = resultsQueue.get()
+            size = self.pending.pop(index)
+            self.inFlight -= size
+            self.completed += size
+            collator.add(index, payload, size=(sizeOf(payload) if payload is not None else 0))
+        if self.chunkSizes:
+            printto(self.stream, "\t{:,} sequences were analysed in {:,} chunks of {:,} to {:,} sequences"
+                    .format(self.noSeqs, len(self.chunkSizes), min(self.chunkSizes), max(self.chunkSizes)),
+                    LEVEL.INFO)
+        return collator
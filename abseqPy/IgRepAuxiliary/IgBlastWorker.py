@@ -6,13 +6,18 @@
 '''
 
 import os
+import hashlib
 import numpy as np
 
+from collections import OrderedDict
 from multiprocessing import Process
-from pandas.core.frame import DataFrame
+from threading import Thread
+from pandas import DataFrame, Index, Series, read_hdf
 
 from abseqPy.IgRepertoire.igRepUtils import runIgblastn, runIgblastp
 from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import cpuSlot
+from abseqPy.instrumentation import StageTimer
 
 ANNOTATION_FIELDS = ['queryid', 'vgene', 'vqstart', 'vstart', 'vmismatches', 'vgaps',
                      'identity', 'alignlen', 'bitscore', 'chain',
@@ -29,28 +34,27 @@ ANNOTATION_FIELDS = ['queryid', 'vgene', 'vqstart', 'vstart', 'vmismatches', 'vg
                      ]
 
 
+# fields that IgBLAST reports as free text, every other annotation field is numeric
+_STRING_FIELDS = frozenset(['queryid', 'vgene', 'dgene', 'jgene', 'chain', 'strand', 'stopcodon', 'v-jframe'])
+# numeric fields that are not integral (positions, mismatches and gaps are)
+_FLOAT_FIELDS = frozenset(['identity', 'bitscore'])
+
+# bump this whenever the parsed annotation of a chunk changes, so that stale cache entries are never reused
+_CHUNK_CACHE_VERSION = '1'
+
+
 def getAnnotationFields(chain):
     if chain == 'hv':
         return ANNOTATION_FIELDS
     elif chain in ['kv', 'lv', 'klv']:
-        return filter(lambda x: not x.startswith("d"), ANNOTATION_FIELDS)
+        return [field for field in ANNOTATION_FIELDS if not field.startswith("d")]
     else:
         # should never happen (argparse takes care of this for us)
         raise ValueError("Unsupported chain type")
 
 
-def createCloneRecord(chain):
-    cdrRecord = {}
-    for field in getAnnotationFields(chain):
-        cdrRecord[field] = np.nan
-    return cdrRecord
-
-
 def convertCloneRecordToOrderedList(cdrRecord, chain):
-    orderedList = []
-    for field in getAnnotationFields(chain):
-        orderedList.append(cdrRecord[field])
-    return orderedList
+    return [cdrRecord[field] for field in getAnnotationFields(chain)]
 
 
 def to_int(x):
@@ -60,12 +64,77 @@ def to_int(x):
         return None
 
 
-def extractCDRInfo(blastOutput, chain, stream=None):
+class CloneAnnotBuilder:
+    """
+    accumulates fixed-schema clone records column by column. Every chunkSize records, the buffered python values
+    are packed into typed numpy arrays so that the memory held by a large IgBLAST output stays proportional to
+    the number of records rather than the number of python objects created while parsing it
+    """
+
+    def __init__(self, fields, chunkSize=10000):
+        """
+        :param fields: list of field names, the first field is used as the index of the resulting dataframe
+        :param chunkSize: number of records to buffer before packing them into numpy arrays
+        """
+        self.fields = list(fields)
+        self.chunkSize = chunkSize
+        self._buffers = [[] for _ in self.fields]
+        self._chunks = [[] for _ in self.fields]
+        self._buffered = 0
+
+    def append(self, record):
+        """
+        :param record: list of values ordered according to self.fields
+        :return: None
+        """
+        for buf, value in zip(self._buffers, record):
+            buf.append(value)
+        self._buffered += 1
+        if self._buffered >= self.chunkSize:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        for field, buf, chunks in zip(self.fields, self._buffers, self._chunks):
+            chunks.append(np.array(buf, dtype=object if field in _STRING_FIELDS else np.float64))
+            del buf[:]
+        self._buffered = 0
+
+    def toDataFrame(self):
+        """
+        builds the clone annotation dataframe indexed by the first field. Integral columns without missing values
+        are returned as int64, mirroring the dtypes pandas would have inferred from the raw records
+
+        :return: DataFrame, or an empty DataFrame if no records were appended
+        """
+        self._flush()
+        if not self._chunks[0]:
+            return DataFrame()
+        columns = []
+        for field, chunks in zip(self.fields, self._chunks):
+            column = np.concatenate(chunks)
+            if field not in _STRING_FIELDS and field not in _FLOAT_FIELDS and not np.isnan(column).any():
+                column = column.astype(np.int64)
+            columns.append(column)
+        index = Index(columns[0], name=self.fields[0])
+        return DataFrame(OrderedDict(zip(self.fields[1:], columns[1:])), index=index, columns=self.fields[1:])
+
+
+def iterCloneRecords(blastOutput, chain, stream=None):
+    """
+    lazily parses an IgBLAST output file (-outfmt 7), one query at a time
+
+    :param blastOutput: path to IgBLAST output
+    :param chain: chain type, one of hv, kv, lv or klv
+    :param stream: logging stream
+    :return: generator of (queryid, record) tuples. record is a list of values ordered according to
+            getAnnotationFields(chain), or None if IgBLAST could not annotate the query (i.e. it should be filtered)
+    """
     # Extract the top hits  
     printto(stream, '\tExtracting top hit tables ... ' + os.path.basename(blastOutput))
-    # process igblast output and extract top hit 
-    cloneAnnot = []
-    filteredIDs = []
+    fields = getAnnotationFields(chain)
+    emptyRecord = dict.fromkeys(fields, np.nan)
     line = ""
 
     warning = False
@@ -92,7 +161,7 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                     if not line:
                         break
                     continue
-                cloneRecord = createCloneRecord(chain)
+                cloneRecord = emptyRecord.copy()
                 cloneRecord['queryid'] = line.split()[2].strip()
                 # parse  V-(D)-J rearrangement   
                 line = blast.readline()
@@ -101,10 +170,10 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                        not line.startswith('# V-(D)-J rearrangement')):
                     line = blast.readline()
                 if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     break
                 if line.startswith('# Query'):
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     continue
                 line = blast.readline().strip().split('\t')
                 cloneRecord['strand'] = 'forward' if line[-1] == '+' else 'reversed'
@@ -137,12 +206,12 @@ def extractCDRInfo(blastOutput, chain, stream=None):
 
                 # EOF
                 if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     break
 
                 # there's no # Sub-region, nor is there # Alignment.
                 if line.startswith("# Query"):
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     continue
 
                 # this implies that IGBLAST successfully classified a CDR3 sequence
@@ -165,10 +234,10 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                        not line.startswith("# Alignment")):
                     line = blast.readline()
                 if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     break
                 if line.startswith('# Query'):
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     continue
                 line = blast.readline()
                 for i in range(1, 4):
@@ -203,21 +272,21 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                        not line.startswith("# Fields")):
                     line = blast.readline()
                 if not line:
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     break
                 if line.startswith('# Query'):
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     continue
                 line = blast.readline()
                 noHits = to_int(line.split()[1])
                 if noHits == 0:
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     continue
                     # retrieve the top hit
                 # parse the top V gene info
                 line = blast.readline()
                 if not line.startswith("V"):
-                    filteredIDs.append(cloneRecord['queryid'])
+                    yield cloneRecord['queryid'], None
                     continue
                 hit = line.split()
                 score = float(hit[-1])
@@ -238,10 +307,10 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                        not line.startswith("J")):
                     line = blast.readline()
                 if not line:
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
+                    yield cloneRecord['queryid'], [cloneRecord[field] for field in fields]
                     break
                 if line.startswith('# Query'):
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
+                    yield cloneRecord['queryid'], [cloneRecord[field] for field in fields]
                     continue
                 if line.startswith("D"):
                     hit = line.split()
@@ -256,10 +325,10 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                        not line.startswith("J")):
                     line = blast.readline()
                 if not line:
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
+                    yield cloneRecord['queryid'], [cloneRecord[field] for field in fields]
                     break
                 if line.startswith('# Query'):
-                    cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
+                    yield cloneRecord['queryid'], [cloneRecord[field] for field in fields]
                     continue
                 if line.startswith("J"):
                     hit = line.split()
@@ -270,34 +339,143 @@ def extractCDRInfo(blastOutput, chain, stream=None):
                     cloneRecord['jend'] = to_int(hit[11])
                     cloneRecord['jmismatches'] = to_int(hit[5])
                     cloneRecord['jgaps'] = to_int(hit[7])
-                cloneAnnot.append(convertCloneRecordToOrderedList(cloneRecord, chain))
+                yield cloneRecord['queryid'], [cloneRecord[field] for field in fields]
             except Exception:
                 warning = True
                 continue
-    if len(cloneAnnot) > 0:
-        # productive = no stop and in-frame
-        # v-jframe: in-frame, out-of-frame, N/A (no J gene) 
-        # stopcodon: yes, no
-        cloneAnnot = DataFrame(cloneAnnot, columns=getAnnotationFields(chain))
-        cloneAnnot.set_index('queryid', drop=True, inplace=True)
-    else:
-        cloneAnnot = DataFrame()
     if warning:
         printto(stream, "WARNING: something went wrong while parsing {}".format(blastOutput), LEVEL.WARN)
-    return cloneAnnot, filteredIDs
 
 
-def analyzeSmallFile(fastaFile, chain, igBlastDB, seqType='dna', threads=8,
-                     outdir="", domainSystem='imgt', stream=None):
-    # Run igblast
+def extractCDRInfo(blastOutput, chain, stream=None):
+    """
+    parses an IgBLAST output file into a clone annotation dataframe
+
+    :param blastOutput: path to IgBLAST output
+    :param chain: chain type, one of hv, kv, lv or klv
+    :param stream: logging stream
+    :return: tuple of (DataFrame indexed by queryid, list of query ids that were not annotated)
+    """
+    # productive = no stop and in-frame
+    # v-jframe: in-frame, out-of-frame, N/A (no J gene)
+    # stopcodon: yes, no
+    builder = CloneAnnotBuilder(getAnnotationFields(chain))
+    filteredIDs = []
+    for queryid, record in iterCloneRecords(blastOutput, chain, stream=stream):
+        if record is None:
+            filteredIDs.append(queryid)
+        else:
+            builder.append(record)
+    return builder.toDataFrame(), filteredIDs
+
+
+def alignChunk(fastaFile, chain, igBlastDB, seqType='dna', threads=8,
+               outdir="", domainSystem='imgt', overwrite=False, stream=None):
+    """
+    runs igblastn (or igblastp) on a FASTA file
+
+    :param overwrite: bool. align the chunk even if its IgBLAST output already exists
+    :return: path to the IgBLAST output file
+    """
     if seqType.lower() == 'dna':
-        blastOutput = runIgblastn(fastaFile, chain, threads, igBlastDB,
-                                  domainSystem=domainSystem, outputDir=outdir, stream=stream)
-    else:
-        # argparse already checks that it's ether dna or protein, so nothing fishy can pass into else statement here
-        blastOutput = runIgblastp(fastaFile, chain, threads, igBlastDB,
-                                  domainSystem=domainSystem, outputDir=outdir, stream=stream)
-    return extractCDRInfo(blastOutput, chain, stream=stream)
+        return runIgblastn(fastaFile, chain, threads, igBlastDB,
+                           domainSystem=domainSystem, outputDir=outdir, overwrite=overwrite, stream=stream)
+    # argparse already checks that it's ether dna or protein, so nothing fishy can pass into else statement here
+    return runIgblastp(fastaFile, chain, threads, igBlastDB,
+                       domainSystem=domainSystem, outputDir=outdir, overwrite=overwrite, stream=stream)
+
+
+def chunkCacheDigest(chain, igBlastDB, seqType='dna', domainSystem='imgt'):
+    """
+    starts the digest of a chunk's cache key. The key covers everything that goes into the IgBLAST command line
+    and the parser, the caller is expected to feed the chunk's FASTA content into the returned digest
+
+    :param chain: chain type, one of hv, kv, lv, or klv
+    :param igBlastDB: path to the germline database directory
+    :param seqType: dna or protein
+    :param domainSystem: imgt or kabat
+    :return: hashlib sha1 object
+    """
+    digest = hashlib.sha1()
+    params = [_CHUNK_CACHE_VERSION, chain, os.path.abspath(os.path.expandvars(igBlastDB)), seqType.lower(),
+              domainSystem]
+    digest.update("\t".join(params).encode("utf-8") + b"\n")
+    return digest
+
+
+def loadCachedChunk(cacheFile):
+    """
+    :param cacheFile: path to a chunk cache file written by cacheChunk
+    :return: (cloneAnnot, filteredIDs) tuple, as returned by extractCDRInfo
+    """
+    cloneAnnot = read_hdf(cacheFile, "cloneAnnot")
+    filteredIDs = read_hdf(cacheFile, "filteredIDs").tolist()
+    return cloneAnnot, filteredIDs
+
+
+def cacheChunk(cacheFile, cloneAnnot, filteredIDs):
+    """
+    saves the annotation of a chunk. The file is written under a temporary name and then renamed, so that a crash
+    never leaves a partially written cache entry behind
+
+    :param cacheFile: destination path
+    :param cloneAnnot: dataframe, as returned by extractCDRInfo
+    :param filteredIDs: list of ids, as returned by extractCDRInfo
+    :return: None
+    """
+    cacheDir = os.path.dirname(cacheFile)
+    if cacheDir and not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            # another worker got there first
+            if not os.path.isdir(cacheDir):
+                raise
+    tmpFile = cacheFile + "." + str(os.getpid()) + ".tmp"
+    try:
+        cloneAnnot.to_hdf(tmpFile, "cloneAnnot", mode='w')
+        Series(filteredIDs, dtype=object).to_hdf(tmpFile, "filteredIDs")
+        os.rename(tmpFile, cacheFile)
+    finally:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+
+class _AlignmentThread(Thread):
+    """
+    aligns a single chunk in the background, leaving the owning worker free to parse the previous chunk
+    """
+
+    def __init__(self, task, worker):
+        super(_AlignmentThread, self).__init__()
+        self.index, self.fastaFile, self.cacheFile, self.noSeqs = task
+        self.worker = worker
+        self.blastOutput = None
+        self.cached = False
+
+    def run(self):
+        w = self.worker
+        try:
+            if self.cacheFile is not None and os.path.exists(self.cacheFile):
+                # this chunk was annotated by a previous run, no need to align it again
+                self.cached = True
+                os.remove(self.fastaFile)
+                return
+            # only the alignment holds CPU slots, one per IgBLAST thread. The worker parses the previous chunk in the
+            # meantime, if parsing held a slot too, workers holding slots and waiting for more could block each other
+            with cpuSlot(w.threads), StageTimer('igblast', records=self.noSeqs) as timer:
+                # chunk files are named after their position in the reads, not their content: an output left behind
+                # by a previous run may belong to different reads, so a chunk without a cache entry (or any chunk, if
+                # caching is off) is always aligned again
+                self.blastOutput = alignChunk(self.fastaFile, w.chain, w.igBlastDB, w.seqType, w.threads,
+                                              domainSystem=w.domainSystem, overwrite=True, stream=w.stream)
+                # IgBLAST runs in its own process, its I/O is not counted in this one's
+                timer.addRead(self.fastaFile)
+                timer.addWritten(self.blastOutput)
+            # the chunk was cut by the reader for this alignment only
+            os.remove(self.fastaFile)
+        except Exception:
+            printto(w.stream, "An error occurred while aligning " + os.path.basename(self.fastaFile), LEVEL.EXCEPT)
 
 
 class IgBlastWorker(Process):
@@ -315,21 +493,54 @@ class IgBlastWorker(Process):
         self.domainSystem = domainSystem
 
     def run(self):
+        # tasks are (chunk index, chunk FASTA file, chunk cache file, number of sequences) tuples. IgBLAST aligns
+        # chunk N + 1 in a background thread while this process parses the output of chunk N
+        pending = None
         while True:
             nextTask = self.tasksQueue.get()
+            aligner = None
+            if nextTask is not None:
+                aligner = _AlignmentThread(nextTask, self)
+                aligner.start()
+            if pending is not None:
+                self._parse(pending)
             # poison pill check
-            if nextTask is None:
+            if aligner is None:
                 printto(self.stream, "process has stopped ... " + self.name)
                 self.exitQueue.put("exit")
-                #                 self.terminate()
                 break
+            aligner.join()
+            pending = aligner
+        return
+
+    def _parse(self, aligner):
+        if aligner.cached:
             try:
-                result = analyzeSmallFile(nextTask, self.chain, self.igBlastDB,
-                                          self.seqType, self.threads, domainSystem=self.domainSystem,
-                                          stream=self.stream)
-                self.resultsQueue.put(result)
+                self.resultsQueue.put((aligner.index, loadCachedChunk(aligner.cacheFile)))
             except Exception:
-                printto(self.stream, "An error occurred while processing " + os.path.basename(nextTask), LEVEL.EXCEPT)
-                self.resultsQueue.put(None)
-                continue
-        return
+                printto(self.stream, "An error occurred while loading " + os.path.basename(aligner.cacheFile),
+                        LEVEL.EXCEPT)
+                self.resultsQueue.put((aligner.index, None))
+            return
+        if aligner.blastOutput is None:
+            self.resultsQueue.put((aligner.index, None))
+            return
+        try:
+            with StageTimer('parse', worker=self.name) as timer:
+                result = extractCDRInfo(aligner.blastOutput, self.chain, stream=self.stream)
+                timer.records = len(result[0]) + len(result[1])
+        except Exception:
+            printto(self.stream, "An error occurred while processing " + os.path.basename(aligner.blastOutput),
+                    LEVEL.EXCEPT)
+            self.resultsQueue.put((aligner.index, None))
+            return
+        if aligner.cacheFile is not None:
+            try:
+                cacheChunk(aligner.cacheFile, *result)
+            except Exception:
+                # the annotation itself is fine, the chunk will simply be aligned again next time
+                printto(self.stream, "Failed to cache the annotation of " + os.path.basename(aligner.blastOutput),
+                        LEVEL.WARN)
+            # the cache entry supersedes the output, which is never reused (see _AlignmentThread)
+            os.remove(aligner.blastOutput)
+        self.resultsQueue.put((aligner.index, result))
@@ -0,0 +1,65 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from collections import OrderedDict
+
+from abseqPy.IgRepertoire.igRepUtils import findBestMatchedPattern
+
+# windows remembered per cache, the least recently used ones are forgotten first
+MATCH_CACHE_SIZE = 1 << 16
+
+
+class MatchCache(object):
+    """
+    findBestMatchedPattern of a list of patterns, memoized by sequence. Reads mostly carry one of a few dozen
+    primers, so the primer windows of a sample repeat: a window that was already matched costs a lookup. The
+    cache is bounded, it forgets the least recently used windows first. An exception raised by
+    findBestMatchedPattern for a window is remembered by its type and arguments, and raised again, as well
+
+    >>> cache = MatchCache([('p1', 'ACGT', 20), ('p2', 'ARGT', 20)], maxSize=2)
+    >>> cache.match('AGGT'), cache.match('AGGT')
+    (('p2', 0, 0, 0, 4), ('p2', 0, 0, 0, 4))
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+
+    def __init__(self, patterns, extend5end=False, maxSize=MATCH_CACHE_SIZE):
+        """
+        :param patterns: list of (pattern_id, pattern_seq, pattern_max_IUPAC_score), see findBestMatchedPattern
+        :param extend5end: see findBestMatchedPattern
+        :param maxSize: int. number of windows remembered
+        """
+        self.patterns = list(patterns)
+        self.extend5end = extend5end
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        # window -> (result, (exception type, exception args)). The exceptions themselves are not kept, their
+        # tracebacks would keep the frames of the failed match alive
+        self._results = OrderedDict()
+
+    def match(self, seq):
+        """
+        :param seq: nucleotide sequence
+        :return: see findBestMatchedPattern
+        """
+        try:
+            result, error = self._results.pop(seq)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            result = error = None
+            try:
+                result = findBestMatchedPattern(seq, self.patterns, self.extend5end)
+            except Exception as e:
+                error = (type(e), e.args)
+            if len(self._results) >= self.maxSize:
+                self._results.popitem(last=False)
+        # most recently used last
+        self._results[seq] = (result, error)
+        if error is not None:
+            raise error[0](*error[1])
+        return result
@@ -0,0 +1,275 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import re
+import itertools
+
+import numpy as np
+
+# nucleotides a IUPAC code stands for, as a 4 bit mask (A, C, G, T)
+IUPAC_BITS = {
+    'A': 1, 'C': 2, 'G': 4, 'T': 8,
+    'R': 1 | 4, 'Y': 2 | 8, 'S': 2 | 4, 'W': 1 | 8, 'K': 4 | 8, 'M': 1 | 2,
+    'B': 2 | 4 | 8, 'D': 1 | 4 | 8, 'H': 1 | 2 | 8, 'V': 1 | 2 | 4, 'N': 1 | 2 | 4 | 8
+}
+
+# scores of the IUPAC substitution matrix (igRepUtils.subMatIUPAC) and of its gaps (open and extension alike)
+MATCH, MISMATCH, GAP = 5, -4, -5
+
+# length of the seeds (k-mers) of the patterns index
+SEED_LENGTH = 6
+
+# windows of a pattern whose IUPAC codes expand to more seeds than this are not indexed, e.g. NNNNNN
+MAX_EXPANSION = 256
+
+_BASES = 'ACGT'
+_NOT_BASE = re.compile('[^ACGT]')
+_NOT_IUPAC = re.compile('[^' + ''.join(sorted(IUPAC_BITS)) + ']')
+
+try:
+    _HEX = str.maketrans('ACGT', '1248')
+except AttributeError:
+    # python 2
+    import string
+    _HEX = string.maketrans('ACGT', '1248')
+
+
+class PatternMatcher(object):
+    """
+    IUPAC patterns (primers) compiled for matching nucleotide sequences against them, the engine behind
+    igRepUtils.findBestMatchedPattern. It scores exactly as the local alignment (Bio.pairwise2.align.localds)
+    of a sequence and a pattern with igRepUtils.subMatIUPAC and a gap penalty of 5 does, in two ways:
+
+        * intact matches: a pattern packs into an integer of 4 bits per position (the mask of its IUPAC code), and
+          so does a sequence (one bit per position, its nucleotide). The sequence is an intact match of the
+          pattern, i.e. scores the maximum, if it is as long and (sequence & pattern) == sequence
+        * local alignment scores: Smith-Waterman over all the patterns of the same length at once, a sequence
+          position at a time. Because the gap penalty is linear, the gaps along a row come out of a running
+          maximum (numpy.maximum.accumulate) rather than a loop over the pattern positions
+
+    and looks the patterns a sequence may match up in an index of their seeds (the k-mers of their IUPAC
+    expansions), so that bestPattern only scores a few of them:
+
+        * an intact match of a pattern starts with one of the seeds at the start of the pattern
+        * the alignment of a sequence and a pattern it shares no seed with has no run of SEED_LENGTH matches,
+          there is a mismatch or a gap (-4 or less) between runs of SEED_LENGTH - 1 matches at most. Its score is
+          bounded (see seedlessBound), a pattern is only scored if its bound reaches the best score of the patterns
+          that share seeds with the sequence
+
+    Only sequences of A, C, G and T, and patterns of (uppercase) IUPAC codes whose maximum score is a match at
+    every position, are supported, see encode and supported
+
+    >>> matcher = PatternMatcher([('p1', 'ACGT', 20), ('p2', 'ARGT', 20)])
+    >>> query = matcher.encode('AGGT')
+    >>> matcher.isIntact(0, query), matcher.isIntact(1, query)
+    (False, True)
+    >>> [int(s) for s in matcher.scores(matcher.encode('TTACGTTT'))]
+    [20, 11]
+    >>> matcher.bestPattern(query), matcher.bestPattern(matcher.encode('TTACGTTT'))
+    ((1, True), (0, False))
+    """
+
+    # compiled pattern lists, see compile
+    _compiled = {}
+
+    def __init__(self, patterns):
+        """
+        :param patterns: list of (pattern_id, pattern_seq, pattern_max_IUPAC_score) tuples
+        """
+        self.ids = [p[0] for p in patterns]
+        self.seqs = [p[1] for p in patterns]
+        self.supported = all(isinstance(ptn, str) and not _NOT_IUPAC.search(ptn) and maxScore == MATCH * len(ptn)
+                             for _, ptn, maxScore in patterns)
+        self.masks = []
+        self.unions = []
+        # pattern length -> (indices of the patterns, match score tables, gap offsets), see scores
+        self.blocks = {}
+        # index of a pattern -> (length, row in its block)
+        self.rows = {}
+        # seed -> indices of the patterns that start with it, and of the patterns that have it anywhere
+        self.startSeeds = {}
+        self.seeds = {}
+        # indices of the patterns that are not (completely) indexed, always looked at
+        self.unindexed = []
+        if not self.supported:
+            return
+        for i, ptn in enumerate(self.seqs):
+            bits = [IUPAC_BITS[c] for c in ptn]
+            self.masks.append(_pack(bits))
+            self.unions.append(_union(bits))
+            self._index(i, ptn)
+        # nucleotides mask of a sequence -> first pattern without any of them
+        self.firstDisjoint = [next((i for i, u in enumerate(self.unions) if not u & mask), None)
+                              for mask in range(16)]
+        self.bounds = np.array([MATCH * len(ptn) if i in self.unindexed else seedlessBound(len(ptn))
+                                for i, ptn in enumerate(self.seqs)], dtype=np.int64)
+        lengths = sorted(set(len(ptn) for ptn in self.seqs))
+        for length in lengths:
+            indices = [i for i, ptn in enumerate(self.seqs) if len(ptn) == length]
+            # tables[b][i][j] is the score of nucleotide b against position j of the i-th pattern of the block
+            tables = np.array([[[MATCH if IUPAC_BITS[c] & IUPAC_BITS[b] else MISMATCH for c in self.seqs[i]]
+                                for i in indices] for b in _BASES], dtype=np.int64).reshape(4, len(indices), length)
+            offsets = -GAP * np.arange(1, length + 1, dtype=np.int64)
+            self.blocks[length] = (np.array(indices, dtype=np.intp), tables, offsets)
+            for row, i in enumerate(indices):
+                self.rows[i] = (length, row)
+
+    def _index(self, index, ptn):
+        expansions = []
+        for start in range(len(ptn) - SEED_LENGTH + 1):
+            window = ptn[start:start + SEED_LENGTH]
+            size = 1
+            for c in window:
+                size *= bin(IUPAC_BITS[c]).count('1')
+            if size > MAX_EXPANSION:
+                break
+            expansions.append(set(''.join(seed) for seed in
+                                  itertools.product(*[[b for b in _BASES if IUPAC_BITS[b] & IUPAC_BITS[c]]
+                                                      for c in window])))
+        if not expansions or len(expansions) < len(ptn) - SEED_LENGTH + 1:
+            # too short, or too degenerate
+            self.unindexed.append(index)
+            return
+        for seed in expansions[0]:
+            self.startSeeds.setdefault(seed, []).append(index)
+        for seed in set().union(*expansions):
+            self.seeds.setdefault(seed, []).append(index)
+
+    @classmethod
+    def compile(cls, patterns):
+        """
+        :param patterns: list of (pattern_id, pattern_seq, pattern_max_IUPAC_score) tuples
+        :return: PatternMatcher of patterns, compiled once per process
+        """
+        key = tuple(patterns)
+        matcher = cls._compiled.get(key)
+        if matcher is None:
+            matcher = cls._compiled[key] = cls(patterns)
+        return matcher
+
+    @staticmethod
+    def encode(seq):
+        """
+        :param seq: string. uppercase nucleotide sequence
+        :return: (packed sequence, nucleotides mask, nucleotide codes, first seed, seeds) tuple of seq as expected
+        by isIntact, scores and bestPattern. None if seq has anything other than A, C, G and T
+        """
+        if not isinstance(seq, str) or _NOT_BASE.search(seq):
+            return None
+        codes = [_BASES.index(c) for c in seq]
+        seeds = set(seq[i:i + SEED_LENGTH] for i in range(len(seq) - SEED_LENGTH + 1))
+        return int(seq.translate(_HEX) or '0', 16), _union([1 << b for b in codes]), codes, seq[:SEED_LENGTH], seeds
+
+    def isIntact(self, index, query):
+        """
+        :param index: int. index of the pattern
+        :param query: encoded sequence, see encode
+        :return: bool. True if the sequence is an intact match of the pattern (matches its whole length, without
+        mismatches or indels)
+        """
+        return len(query[2]) == len(self.seqs[index]) and query[0] & self.masks[index] == query[0]
+
+    def scores(self, query, indices=None):
+        """
+        :param query: encoded sequence, see encode
+        :param indices: iterable of the indices of the patterns to score, all of them if None
+        :return: numpy array of the local alignment scores of the sequence against each pattern, -1 for the
+        patterns that were not scored
+        """
+        if indices is None:
+            best = np.zeros(len(self.seqs), dtype=np.int64)
+            for blockIndices, tables, offsets in self.blocks.values():
+                best[blockIndices] = _localScores(query[2], tables, offsets)
+            return best
+        best = np.full(len(self.seqs), -1, dtype=np.int64)
+        rows = {}
+        for i in indices:
+            length, row = self.rows[i]
+            rows.setdefault(length, []).append((i, row))
+        for length, members in rows.items():
+            blockIndices, tables, offsets = self.blocks[length]
+            best[[i for i, _ in members]] = _localScores(query[2], tables[:, [r for _, r in members], :], offsets)
+        return best
+
+    def bestPattern(self, query):
+        """
+        the pattern a sequence matches best, as aligning it against every pattern in order would find it: the
+        first intact pattern, unless the sequence has no nucleotide in common with a pattern before it, otherwise
+        the first of the patterns of the best local alignment score
+
+        :param query: encoded sequence, see encode
+        :return: (index of the pattern, bool. True if the match is intact) tuple, (None, False) if there is no
+        match
+        """
+        disjoint = self.firstDisjoint[query[1]] if self.seqs else None
+        intact = [i for i in itertools.chain(self.startSeeds.get(query[3], ()), self.unindexed)
+                  if (disjoint is None or i < disjoint) and self.isIntact(i, query)]
+        if intact:
+            return min(intact), True
+        if disjoint is not None or not self.seqs:
+            return None, False
+
+        seeded = set(self.unindexed)
+        for seed in query[4]:
+            seeded.update(self.seeds.get(seed, ()))
+        scores = self.scores(query, seeded)
+        # the patterns without seeds that may score as high as the best seeded ones
+        best = scores.max() if seeded else 0
+        seedless = [i for i in np.flatnonzero(self.bounds >= best) if i not in seeded]
+        if seedless:
+            scores = np.maximum(scores, self.scores(query, seedless))
+        return int(scores.argmax()), False
+
+
+def seedlessBound(length):
+    """
+    :param length: int. pattern length
+    :return: int. highest local alignment score of a pattern of this length against a sequence it shares no seed
+    with: its matches come in runs of SEED_LENGTH - 1 at most, separated by a mismatch or a gap
+
+    >>> seedlessBound(20) < 20 * MATCH
+    True
+    """
+    runs = -(-length // (SEED_LENGTH - 1))
+    return MATCH * length + MISMATCH * (runs - 1)
+
+
+def _localScores(codes, tables, offsets):
+    """
+    :param codes: list of the nucleotide codes of a sequence
+    :param tables: numpy array of the match scores of the nucleotides against the positions of some patterns of the
+    same length, 4 x patterns x length
+    :param offsets: numpy array of the gap penalties of the horizontal gaps, see PatternMatcher.scores
+    :return: numpy array of the local alignment scores of the sequence against each pattern
+    """
+    size, length = tables.shape[1], tables.shape[2]
+    # H[i][j] = max(0, H[i-1][j-1] + s(i, j), H[i-1][j] + GAP, H[i][j-1] + GAP)
+    prev = np.zeros((size, length + 1), dtype=np.int64)
+    best = np.zeros(size, dtype=np.int64)
+    for b in codes:
+        cells = np.maximum(np.maximum(prev[:, :-1] + tables[b], prev[:, 1:] + GAP), 0)
+        row = np.zeros_like(prev)
+        # the horizontal gaps: H[i][j] = max over k <= j of (cells[k] + GAP * (j - k))
+        row[:, 1:] = np.maximum.accumulate(cells + offsets, axis=1) - offsets
+        np.maximum(best, row.max(axis=1), out=best)
+        prev = row
+    return best
+
+
+def _pack(bits):
+    value = 0
+    for b in bits:
+        value = (value << 4) | b
+    return value
+
+
+def _union(bits):
+    value = 0
+    for b in bits:
+        value |= b
+    return value
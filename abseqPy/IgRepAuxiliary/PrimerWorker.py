@@ -5,16 +5,23 @@ from multiprocessing import Process
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 
-from abseqPy.IgRepertoire.igRepUtils import findBestMatchedPattern, calMaxIUPACAlignScores
+from abseqPy.IgRepertoire.igRepUtils import calMaxIUPACAlignScores
+from abseqPy.IgRepAuxiliary.MatchCache import MatchCache
 from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import cpuSlot
+from abseqPy.instrumentation import StageTimer
 
 
 class PrimerWorker(Process):
     def __init__(self, procCounter, fr4cut, trim5end,
                  trim3end, actualQstart, end5, end3,
-                 end5offset, tasks, exitQueue, resultsQueue, stream=None):
+                 end5offset, tasks, exitQueue, resultsQueue, cloneAnnot=None, seqStore=None, stream=None):
         super(PrimerWorker, self).__init__()
         self.procCounter = procCounter
+        # the clone annotation and its sequence store are shared with the worker when it starts, tasks only
+        # carry the (start, stop) row range of the chunk to analyse
+        self.cloneAnnot = cloneAnnot
+        self.seqStore = seqStore
         self.fr4cut = fr4cut
         self.trim5end = trim5end
         self.trim3end = trim3end
@@ -31,37 +38,52 @@ class PrimerWorker(Process):
         self.stream = stream
 
     def run(self):
-        while True:
-            nextTask = self.taskQueue.get()
-            if nextTask is None:
-                printto(self.stream, self.name + " process has stopped.")
-                self.exitQueue.put("exit")
-                break
-
-            try:
-                recs = []
-                if not self.firstJobTaken:
-                    printto(self.stream, self.name + " process commenced a new task ... ")
-                    self.firstJobTaken = True
-                for record, qsRec in zip(nextTask[0], nextTask[1]):
-                    qsRec['queryid'] = record.id
-                    recs.append(_matchClosestPrimer(qsRec, record, self.actualQstart, self.trim5end,
-                                                    self.trim3end, self.end5offset, self.fr4cut, self.maxPrimer5Length,
-                                                    self.maxPrimer3Length, self.primer5sequences,
-                                                    self.primer3sequences))
-                self.resultsQueue.put(recs)
-                self.procCounter.increment(len(recs))
-            except Exception as e:
-                printto(self.stream, "An error as occurred while processing " + self.name + " with error {}".format(
-                    str(e)
-                ), LEVEL.EXCEPT)
-                self.resultsQueue.put(None)
-                continue
+        # windows already matched by this worker, 5' and 3' primers apart
+        primer5cache = MatchCache(self.primer5sequences) if self.primer5sequences else None
+        primer3cache = MatchCache(self.primer3sequences) if self.primer3sequences else None
+        with StageTimer('primer', worker=self.name, records=0) as timer:
+            while True:
+                nextTask = self.taskQueue.get()
+                timer.observeQueue(self.taskQueue)
+                if nextTask is None:
+                    printto(self.stream, self.name + " process has stopped.")
+                    break
+
+                index, start, stop = nextTask
+                try:
+                    recs = []
+                    if not self.firstJobTaken:
+                        printto(self.stream, self.name + " process commenced a new task ... ")
+                        self.firstJobTaken = True
+                    with cpuSlot():
+                        annot = self.cloneAnnot.iloc[start:stop]
+                        records = self.seqStore.records(annot.index)
+                        qsRecords = annot.to_dict('records')
+                        for record, qsRec in zip(records, qsRecords):
+                            qsRec['queryid'] = record.id
+                            recs.append(_matchClosestPrimer(qsRec, record, self.actualQstart, self.trim5end,
+                                                            self.trim3end, self.end5offset, self.fr4cut,
+                                                            self.maxPrimer5Length, self.maxPrimer3Length,
+                                                            primer5cache, primer3cache))
+                    self.resultsQueue.put((index, recs))
+                    self.procCounter.increment(len(recs))
+                    timer.records += len(recs)
+                except Exception as e:
+                    printto(self.stream, "An error as occurred while processing " + self.name + " with error {}".format(
+                        str(e)
+                    ), LEVEL.EXCEPT)
+                    self.resultsQueue.put((index, None))
+                    continue
+            for cache in (primer5cache, primer3cache):
+                if cache is not None:
+                    timer.countCache(cache.hits, cache.misses)
+        # the statistics of this worker are written before it tells the main process it is done
+        self.exitQueue.put("exit")
         return
 
 
 def _matchClosestPrimer(qsRec, record, actualQstart, trim5end, trim3end, end5offset, fr4cut,
-                        maxPrimer5Length, maxPrimer3Length, primer5seqs, primer3seqs):
+                        maxPrimer5Length, maxPrimer3Length, primer5cache, primer3cache):
     if qsRec['strand'] == 'reversed':
         record = SeqRecord(record.seq.reverse_complement(), id=record.id, name="", description="")
 
@@ -69,21 +91,21 @@ def _matchClosestPrimer(qsRec, record, actualQstart, trim5end, trim3end, end5off
 
     unexpected5 = unexpected3 = 0
 
-    if primer5seqs:
+    if primer5cache is not None:
         primer = str(vh[max(0, end5offset):max(0, end5offset) + maxPrimer5Length])
         try:
             qsRec['5endPrimer'], qsRec['5endMismatchIndex'], qsRec['5endIndelIndex'], _, _ = \
-                findBestMatchedPattern(primer, primer5seqs)
+                primer5cache.match(primer)
         except Exception as e:
             # print("ARGH: something went wrong!" + str(e.message))
             unexpected5 += 1
             pass
 
-    if primer3seqs:
+    if primer3cache is not None:
         primer = str(vh[-1 * maxPrimer3Length:])
         try:
             qsRec['3endPrimer'], qsRec['3endMismatchIndex'], qsRec['3endIndelIndex'], _, _ = \
-                findBestMatchedPattern(primer, primer3seqs)
+                primer3cache.match(primer)
         except Exception as e:
             # print("DEBUG: something went wrong! {}".format(str(e.message)))
             unexpected3 += 1
@@ -5,16 +5,37 @@
     Changes log: check git commits. 
 '''
 
+import numpy as np
+
 from multiprocessing import Process
-from Bio.SeqRecord import SeqRecord
-from collections import defaultdict
+from Bio.Seq import Seq
+from collections import defaultdict, Counter
+from itertools import repeat
 from numpy import isnan, nan
+from pandas import Series
 
 from abseqPy.config import FR4_CONSENSUS, FR4_CONSENSUS_DNA
 from abseqPy.IgRepertoire.igRepUtils import extractProteinFrag, \
-    findBestAlignment, extractCDRsandFRsProtein, calMaxIUPACAlignScores, findBestMatchedPattern
-from abseqPy.IgRepAuxiliary.IgBlastWorker import convertCloneRecordToOrderedList
+    findBestAlignment, calMaxIUPACAlignScores, findBestMatchedPattern
+from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields
 from abseqPy.logger import LEVEL, printto
+from abseqPy.utilities import cpuSlot
+from abseqPy.instrumentation import StageTimer
+
+# fields read and updated by _refineFR4
+_FR4_FIELDS = ('fr3.end', 'jqend', 'cdr3.start', 'cdr3.end', 'fr4.start', 'fr4.end')
+
+# fields read by _recordFRLength
+_FR_LENGTH_FIELDS = ('vgene', 'jgene', 'fr1.start', 'fr1.end', 'fr2.start', 'fr2.end',
+                     'fr3.start', 'fr3.end', 'fr4.start', 'fr4.end')
+
+# the regions that extractCDRsandFRsProtein partitions the protein into, in order
+_PROTEIN_REGIONS = (('fr1.start', 'fr1.end'), ('cdr1.start', 'cdr1.end'), ('fr2.start', 'fr2.end'),
+                    ('cdr2.start', 'cdr2.end'), ('fr3.start', 'fr3.end'), ('cdr3.start', 'cdr3.end'),
+                    ('fr4.start', 'fr4.end'))
+
+# amino acid (as a byte) of every codon translated so far, keyed by the codon's 3 bytes packed into an int
+_CODON_TABLE = {}
 
 
 class RefineWorker(Process):
@@ -28,6 +49,11 @@ class RefineWorker(Process):
         self.trim5End = trim5End
         self.trim3End = trim3End if isinstance(trim3End, int) else _parse3EndSeqs(trim3End)
         self.refineFlagNames = refineFlagNames
+        # the clone annotation, its sequence store and the weight of every clone (or None) are shared with the
+        # workers when they start; tasks only carry the (start, stop) row range of the chunk to refine
+        self.cloneAnnot = None
+        self.seqStore = None
+        self.weights = None
         self.tasksQueue = None
         self.exitQueue = None
         self.resultsQueue = None
@@ -36,264 +62,378 @@ class RefineWorker(Process):
 
     def run(self):
         printto(self.stream, self.name + " process is now ready to start a new job ...")
-        while True:
-            nextTask = self.tasksQueue.get()
-            # poison pill check            
-            if nextTask is None:
-                printto(self.stream, self.name + " process has stopped.")
-                self.exitQueue.put("exit")
-                break
-            try:
-                if not self.firstJobTaken:
-                    printto(self.stream, self.name + " process commenced a new task ... ")
-                    self.firstJobTaken = True
-                qsRecs = []
-                seqsAll = []
-                recordLengths = defaultdict(_defaultdefaultInt)
-                flags = {}
-                for f in self.refineFlagNames:
-                    flags[f] = []
-                for (record, qsRec) in zip(nextTask[0], nextTask[1]):
-                    seqs = refineCloneAnnotation(qsRec, record,
-                                                 self.actualQstart, self.chain, self.fr4cut,
-                                                 self.trim5End, self.trim3End, flags, stream=self.stream)
-                    # out-of-frame clones are excluded
-                    if qsRec['v-jframe'] != 'Out-of-frame':
-                        stillInFrame = refineInFramePrediction(qsRec, record, self.actualQstart,
-                                                               flags, stream=self.stream)
-                        if stillInFrame:
-                            _recordFRLength(qsRec, recordLengths)
-
-                    # append the FR and CDR protein clones
-                    qsRec['queryid'] = record.id
-                    qsRecs.append(convertCloneRecordToOrderedList(qsRec, self.chain))
-                    seqsAll.append(seqs)
-                self.procCounter.increment(len(qsRecs))
-                self.resultsQueue.put((qsRecs, seqsAll, flags, recordLengths))
-            except Exception as e:
-                printto(self.stream, "An error occurred while processing " + self.name, LEVEL.EXCEPT)
-                self.resultsQueue.put(None)
-                continue
+        with StageTimer('refine', worker=self.name, records=0) as timer:
+            while True:
+                nextTask = self.tasksQueue.get()
+                timer.observeQueue(self.tasksQueue)
+                # poison pill check
+                if nextTask is None:
+                    printto(self.stream, self.name + " process has stopped.")
+                    break
+                index, start, stop = nextTask
+                try:
+                    if not self.firstJobTaken:
+                        printto(self.stream, self.name + " process commenced a new task ... ")
+                        self.firstJobTaken = True
+                    with cpuSlot():
+                        annot = self.cloneAnnot.iloc[start:stop]
+                        records = list(self.seqStore.records(annot.index))
+                        weights = self.weights[start:stop] if self.weights is not None else None
+                        flags = {}
+                        for f in self.refineFlagNames:
+                            flags[f] = []
+                        qsRecs, seqsAll, recordLengths = refineChunk(annot, records, self.actualQstart, self.chain,
+                                                                     self.fr4cut, self.trim5End, self.trim3End, flags,
+                                                                     weights=weights, stream=self.stream)
+                    self.procCounter.increment(len(qsRecs))
+                    timer.records += len(qsRecs)
+                    self.resultsQueue.put((index, (qsRecs, seqsAll, flags, recordLengths)))
+                except Exception as e:
+                    printto(self.stream, "An error occurred while processing " + self.name, LEVEL.EXCEPT)
+                    self.resultsQueue.put((index, None))
+                    continue
+        # the statistics of this worker are written before it tells the main process it is done
+        self.exitQueue.put("exit")
         return
 
 
-def refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut,
-                          trim5End, trim3End, flags, stream=None):
-    seqs = [record.id, qsRec['vgene']]
+def refineChunk(annot, records, actualQstart, chain, fr4cut, trim5End, trim3End, flags, weights=None,
+                stream=None):
+    """
+    refines the clone annotations of a chunk, as the former clone by clone refinement did (it is kept as the
+    reference of tests/IgRepAuxiliary/test_RefineWorker.py). The offset arithmetic, the translation, the FR1 start,
+    gap and mismatch corrections, the partitioning boundaries and the in-frame checks are computed on whole columns;
+    only the search for the FR4 consensus of clones without an annotated FR4 and the final string slicing are done
+    one clone at a time
+
+    :param annot: dataframe of clone annotations (as produced by IgBLAST) indexed by query id
+    :param records: list of SeqRecord objects, one per row of annot, in the same order
+    :param flags: dict of refinement flag name -> list of clone ids, updated in place
+    :param weights: list of ints, one per row of annot. Number of reads each clone stands for, used to weigh the
+    framework length tallies. Defaults to 1 for every clone
+    :return: (rows, seqs, frameworkLengths) tuple. rows is a list of refined annotation rows ordered as
+    getAnnotationFields(chain), seqs is a list of [queryid, vgene, fr1, cdr1, fr2, cdr2, fr3, cdr3, fr4] protein
+    sequences (only [queryid, vgene] if the clone could not be partitioned) and frameworkLengths is the tally of
+    framework lengths of the clones that are still in-frame after refinement
+    """
+    noClones = len(annot)
+    ids = np.array(annot.index, dtype=object)
+    # python scalars (rather than numpy ones), exactly what row-by-row dictionaries would hold
+    cols = dict((c, annot[c].values.astype(object)) for c in annot.columns)
+
+    def numeric(c):
+        return np.asarray(cols[c], dtype=float)
+
+    chains = _cloneChains(annot, chain, stream=stream)
 
-    if qsRec['chain'] in ['VH', 'VK', 'VL']:
-        chain = qsRec['chain']
+    # the sequences, strand-corrected and trimmed
+    seqs = []
+    for record, strand in zip(records, cols['strand']):
+        seq = record.seq.reverse_complement() if strand == "reversed" else record.seq
+        seq = str(seq)[trim5End:]
+        # if trim3End was a user provided int, use it to cut the sequence, or else it will be a list of seqs
+        if isinstance(trim3End, int):
+            seq = seq[:(len(seq) - trim3End)]
+        seqs.append(seq)
+
+    # grab the beginning of the VH clone
+    vqstart, vstart = numeric('vqstart'), numeric('vstart')
+    if actualQstart > -1:
+        # if user specified an actualQstart, use it. (parse args already converted it into 0-based)
+        offsets = np.full(noClones, actualQstart, dtype=int)
+        translated = np.ones(noClones, dtype=bool)
     else:
-        # convert hv, kv, lv and klv to VH, VK, or VL
+        # else, we find the offset by subtracting V query start with IgBLAST's v germline start position (1-index)
+        translated = ~isnan(vqstart - vstart)
+        offsets = np.where(translated, vqstart - vstart, 0).astype(int)
+    offsets = np.maximum(offsets, 0)
+
+    # only whole codons are translated
+    vhs = []
+    for seq, offset, ok in zip(seqs, offsets.tolist(), translated):
+        vh = seq[offset:] if ok else ""
+        vhs.append(vh[:len(vh) - len(vh) % 3])
+    proteins = _translateBatch(vhs)
+    translated &= np.array([p is not None for p in proteins], dtype=bool)
+
+    # check whether the start of the V gene is the same as the start of FR1
+    flags['fr1NotAtBegin'] += ids[translated & ~(vqstart == numeric('fr1.start'))].tolist()
+    _assign(cols['fr1.start'], translated, offsets + 1)
+
+    # Identification of FR4 so that CDR3 can be defined
+    located = translated.copy()
+    for i in np.flatnonzero(translated & isnan(numeric('fr4.end'))):
+        qsRec = dict((c, cols[c][i]) for c in _FR4_FIELDS)
+        try:
+            _refineFR4(qsRec, seqs[i], ids[i], proteins[i], int(offsets[i]), chains[i], fr4cut, trim3End, flags,
+                       stream=stream)
+        except Exception:
+            located[i] = False
+        finally:
+            for c in _FR4_FIELDS:
+                cols[c][i] = qsRec[c]
+
+    # Extract the CDR and FR protein sequences, see extractProteinFrag
+    proteinLengths = np.array([len(p) if p is not None else 0 for p in proteins], dtype=float)
+    bounds = []
+    for start, end in _PROTEIN_REGIONS:
+        start, end = numeric(start), numeric(end)
+        empty = isnan(start) | isnan(end) | ((start != -1) & (end != -1) & (end - start < 1))
+        first = np.where(empty, 0, np.where(start != -1, np.trunc((start - offsets - 1) / 3.0), 0)).astype(int)
+        last = np.where(empty, 0, np.where(end != -1, np.trunc((end - offsets) / 3.0), proteinLengths)).astype(int)
+        bounds.append(((~empty & (first + 1 < last)).tolist(), (~empty & (first + 1 == last)).tolist(),
+                       first.tolist(), last.tolist()))
+    partitioned = np.zeros(noClones, dtype=bool)
+    regions = [None] * noClones
+    for i in np.flatnonzero(located):
+        protein = proteins[i]
+        try:
+            frags = [protein[s[i]:e[i]] if span[i] else (protein[s[i]] if single[i] else '')
+                     for span, single, s, e in bounds]
+        except IndexError:
+            continue
+        # check whether FR and CDR sequences were extracted correctly
+        if ''.join(frags) in protein:
+            regions[i] = frags
+            partitioned[i] = True
+    flags['partitioning'] += ids[located & ~partitioned].tolist()
+
+    stopCodon = np.zeros(noClones, dtype=bool)
+    for i in np.flatnonzero(partitioned):
+        fr4 = regions[i][-1]
+        if fr4[:4] != FR4_CONSENSUS[chains[i]][:4]:
+            flags['fr4NotAsExpected'] += [ids[i]]
+        if fr4 == '':
+            flags['noFR4'] += [ids[i]]
+        stopCodon[i] = any('*' in frag for frag in regions[i])
+    flags['endsWithStopCodon'] += ids[stopCodon].tolist()
+    # update the StopCodon value if it was set to No
+    updated = stopCodon & (cols['stopcodon'] == 'No')
+    flags['updatedStopCodon'] += ids[updated].tolist()
+    cols['stopcodon'][updated] = 'Yes'
+
+    # update the annotation fields with the new calculated values
+    gaps = np.abs(vqstart - vstart) - offsets
+    corrected = partitioned & ~isnan(gaps)
+    gaps = np.where(corrected, np.trunc(gaps), 0).astype(int)
+    # Only update gaps if the actual query start position is known
+    withGaps = corrected & (gaps > 0)
+    for c in ('fr1.gaps', 'vgaps'):
+        cols[c][withGaps] = cols[c][withGaps] + gaps[withGaps]
+    # if igblast ignores mismatches at the beginning ==> update
+    mismatches = cols['vstart'] - 1
+    mismatches = np.where((vstart > vqstart) & (gaps > 0), mismatches - gaps, mismatches)
+    withMismatches = corrected & (np.asarray(mismatches, dtype=float) > 0)
+    for c, sign in (('fr1.mismatches', 1), ('vmismatches', 1), ('vstart', -1), ('vqstart', -1)):
+        cols[c][withMismatches] = cols[c][withMismatches] + sign * mismatches[withMismatches]
+
+    # out-of-frame clones are excluded from the in-frame refinement
+    frame = cols['v-jframe']
+    inframe = frame != 'Out-of-frame'
+    candidates = inframe.copy()
+
+    def drop(mask, flag):
+        flags[flag] += ids[mask].tolist()
+        inframe[mask] = False
+
+    # NaN positions are expected, they fail the checks (comparisons with NaN are False)
+    with np.errstate(invalid='ignore'):
+        # check the the v-jframe value is not NA
+        drop(inframe & ((frame == 'N/A') | Series(frame).isnull().values), 'updatedInFrameNA')
+        # the query clone is not in concordance with the start of the germline gene
+        offset = np.trunc(numeric('vqstart') - numeric('vstart')) + 1
+        drop(inframe & ((offset < 1) | ((actualQstart != -1) & ((offset - 1 - actualQstart) % 3 != 0))),
+             'updatedInFrameConc')
+        # if no CDR3 or FR4 ==> Out-of-frame
+        fr4start, fr4end = numeric('fr4.start'), numeric('fr4.end')
+        cdr3start, cdr3end = numeric('cdr3.start'), numeric('cdr3.end')
+        drop(inframe & (isnan(fr4start) | isnan(fr4end) | isnan(cdr3start) | (cdr3start >= cdr3end)),
+             'updatedInFrameNo3or4')
+        # doesn't start/end properly .. not multiple of 3
+        drop(inframe & (((fr4end - numeric('fr1.start') + 1) % 3 != 0) |
+                        ((actualQstart != -1) & ((fr4end - actualQstart) % 3 != 0))), 'updatedInFrame3x')
+        # indels (gaps) in FRs or CDRs cause frame-shift ==> out-of-frame
+        cdr3gaps = numeric('cdr3g.gaps')
+        indels = ~isnan(cdr3gaps) & (cdr3gaps % 3 != 0)
+        for c in ('fr1.gaps', 'fr2.gaps', 'fr3g.gaps', 'cdr1.gaps', 'cdr2.gaps'):
+            indels |= numeric(c) % 3 != 0
+        drop(inframe & indels, 'updatedInFrameIndel')
+
+    outOfFrame = candidates & ~inframe
+    frame[outOfFrame] = 'Out-of-frame'
+    flags['updatedInFrame'] += ids[outOfFrame].tolist()
+
+    recordLengths = defaultdict(_defaultdefaultInt)
+    weights = repeat(1) if weights is None else weights
+    for i, weight in zip(range(noClones), weights):
+        if inframe[i]:
+            _recordFRLength(dict((c, cols[c][i]) for c in _FR_LENGTH_FIELDS), recordLengths, weight)
+
+    cols['queryid'] = ids
+    rows = [list(row) for row in zip(*[cols[f] for f in getAnnotationFields(chain)])]
+    seqsAll = [[ids[i], cols['vgene'][i]] + (regions[i] if partitioned[i] else []) for i in range(noClones)]
+    return rows, seqsAll, recordLengths
+
+
+def _cloneChains(annot, chain, stream=None):
+    """
+    :param annot: dataframe of clone annotations
+    :param chain: string. hv, kv, lv or klv, as provided by the user
+    :return: numpy array of VH, VK or VL, one per clone. Clones with an unknown chain type fall back to the chain
+    deduced from the user provided chain (and the V gene name for klv)
+    """
+    chains = annot['chain'].values.astype(object)
+    known = annot['chain'].isin(['VH', 'VK', 'VL']).values
+    if not known.all():
         if chain == 'klv':
-            if 'K' in qsRec['vgene']:
-                chain = "VK"
-            else:
-                # we run a risk that it's not VL, but we honestly have no other clue to deduce what chain this is
-                chain = "VL"
+            # we run a risk that it's not VL, but we honestly have no other clue to deduce what chain this is
+            fallback = np.where(annot['vgene'].str.contains('K', regex=False).values, "VK", "VL")
         else:
             # if user provided a chain type, just use it as-is, although we will need to convert it to VH, VK, or VL
             # instead of hv, kv, lv
-            chain = chain[::-1].upper()
+            fallback = np.full(len(chains), chain[::-1].upper(), dtype=object)
+        for unknown, count in Counter(chains[~known].tolist()).items():
+            printto(stream, "Chain had unknown type {} ({:,} clones)".format(unknown, count), LEVEL.WARN)
+        chains[~known] = fallback[~known]
+    return chains
 
-        printto(stream, "Chain had unknown type {}".format(qsRec['chain']), LEVEL.WARN)
 
-    try:
-        if qsRec['strand'] == "reversed":
-            record = SeqRecord(record.seq.reverse_complement(), id=record.id, name="", description="")
+def _assign(column, mask, values):
+    """
+    sets column[mask] to values[mask], keeping the elements of the object array column python scalars
 
-        record = record[trim5End:]
-        # if trim3End was a user provided int, use it to cut the sequence, or else it will be a list of seqs
-        if isinstance(trim3End, int):
-            record = record[:(len(record) - trim3End)]
+    :param column: numpy object array
+    :param mask: numpy boolean array
+    :param values: numpy array
+    :return: None
+    """
+    column[mask] = np.array(values[mask].tolist(), dtype=object)
 
-        # grab the beginning of the VH clone
-        if actualQstart > -1:
-            # if user specified an actualQstart, use it. (parse args already converted it into 0-based)
-            offset = actualQstart  # zero-based
-        else:
-            # else, we find the offset by subtracting V query start with IgBLAST's v germline start position (1-index)
-            offset = int(qsRec['vqstart'] - qsRec['vstart'])  # zero-based
-        if offset < 0:
-            offset = 0
-        vh = record.seq[offset:]
 
-        # check whether the VH sequence can be translated successfully
-        if len(vh) % 3 != 0:
-            vh = vh[:-1 * (len(vh) % 3)]
-        protein = str(vh.translate())
+def _translateBatch(seqs):
+    """
+    translates a batch of nucleotide sequences in one go: the codons of all the sequences are mapped to amino
+    acids through a table of the distinct codons in the batch. Every distinct codon is translated by Biopython only
+    once (and remembered), hence ambiguous codons translate exactly as they would with Seq.translate
 
-        # check whether the start of the V gene is the same as the start of FR1
-        if qsRec['vqstart'] != qsRec['fr1.start']:
-            flags['fr1NotAtBegin'] += [record.id]
-        qsRec['fr1.start'] = offset + 1
+    :param seqs: list of strings whose lengths are multiples of 3
+    :return: list of protein strings, None for the sequences that contain a codon that cannot be translated
+    """
+    data = "".join(seqs)
+    if not data:
+        return ["" for _ in seqs]
+    if not isinstance(data, bytes):
+        data = data.encode('latin-1')
+    codons = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+    keys = (codons[:, 0] << 16) | (codons[:, 1] << 8) | codons[:, 2]
+    uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+    aminoAcids = np.zeros(len(uniqueKeys), dtype=np.uint8)
+    for i, key in enumerate(uniqueKeys.tolist()):
+        if key not in _CODON_TABLE:
+            codon = bytes(bytearray([key >> 16, (key >> 8) & 0xFF, key & 0xFF]))
+            try:
+                _CODON_TABLE[key] = ord(str(Seq(codon if isinstance(codon, str) else codon.decode('latin-1'))
+                                            .translate()))
+            except Exception:
+                # untranslatable codon
+                _CODON_TABLE[key] = 0
+        aminoAcids[i] = _CODON_TABLE[key]
+    translation = aminoAcids[inverse]
+    # number of untranslatable codons before each codon
+    failures = np.concatenate(([0], np.cumsum(translation == 0)))
+    translation = translation.tobytes()
+    if not isinstance(translation, str):
+        translation = translation.decode('latin-1')
+    proteins = []
+    start = 0
+    for seq in seqs:
+        end = start + len(seq) // 3
+        proteins.append(translation[start:end] if failures[end] == failures[start] else None)
+        start = end
+    return proteins
+
+
+def _refineFR4(qsRec, seq, readId, protein, offset, chain, fr4cut, trim3End, flags, stream=None):
+    """
+    identifies FR4 (and therefore the end of CDR3) of a clone whose FR4 was not annotated by IgBLAST. The FR4
+    consensus is searched for in the translated sequence first and in the nucleotide sequence if that fails. This
+    is the only part of the refinement that needs a per-read alignment
+
+    :param qsRec: dict-like. clone annotation, its cdr3.start, cdr3.end, fr4.start and fr4.end are updated in place
+    :param seq: string. nucleotide sequence of the clone (strand-corrected and trimmed)
+    :param readId: string. id of the clone
+    :param protein: string. translation of seq[offset:]
+    :param offset: int. 0-based position of the start of the V gene in seq
+    :param chain: string. VH, VK or VL
+    :param flags: dict of refinement flag name -> list of clone ids
+    :return: None
+    """
+    searchRegion = extractProteinFrag(protein, qsRec['fr3.end'] + 1, -1, offset, trimAtStop=False,
+                                      stream=stream)
+    if searchRegion is None:
+        raise Exception("ERROR: undefined search region to find FR4 consensus.")
 
-        # Identification of FR4 so that CDR3 can be defined
-        if isnan(qsRec['fr4.end']):
-            searchRegion = extractProteinFrag(protein, qsRec['fr3.end'] + 1, -1, offset, trimAtStop=False,
-                                              stream=stream)
-            if searchRegion is None:
-                raise Exception("ERROR: undefined search region to find FR4 consensus.")
+    qsRec['cdr3.start'] = qsRec['fr3.end'] + 1
 
-            qsRec['cdr3.start'] = qsRec['fr3.end'] + 1
+    fr4start, fr4end, gapped = findBestAlignment(searchRegion, FR4_CONSENSUS[chain], dna=False)
 
-            fr4start, fr4end, gapped = findBestAlignment(searchRegion, FR4_CONSENSUS[chain], dna=False)
+    if not gapped and fr4start != -1 and fr4end != -1 and fr4end > fr4start:
 
-            if not gapped and fr4start != -1 and fr4end != -1 and fr4end > fr4start:
+        qsRec['fr4.start'] = (fr4start - 1) * 3 + qsRec['fr3.end'] + 1
 
-                qsRec['fr4.start'] = (fr4start - 1) * 3 + qsRec['fr3.end'] + 1
+        qsRec['cdr3.end'] = qsRec['fr4.start'] - 1
 
-                qsRec['cdr3.end'] = qsRec['fr4.start'] - 1
+        # FR4end here is amino acid indexing, change to nt
+        fr4end = qsRec['fr3.end'] + fr4end * 3
 
-                # FR4end here is amino acid indexing, change to nt
-                fr4end = qsRec['fr3.end'] + fr4end * 3
+    else:
+        # try to use the DNA consensus
+        searchRegion = seq[int(qsRec['fr3.end']):]
+        fr4start, fr4end, gapped = findBestAlignment(searchRegion, FR4_CONSENSUS_DNA[chain], dna=True)
 
-            else:
-                # try to use the DNA consensus
-                searchRegion = str(record.seq)[int(qsRec['fr3.end']):]
-                fr4start, fr4end, gapped = findBestAlignment(searchRegion, FR4_CONSENSUS_DNA[chain], dna=True)
-
-                if fr4start != -1 and fr4end != -1 and fr4end > fr4start:
-                    qsRec['fr4.start'] = qsRec['fr3.end'] + fr4start
-
-                    qsRec['cdr3.end'] = qsRec['fr4.start'] - 1
-                    flags['CDR3dna'] += [record.id]
-
-                    # FR4end is already in nt counts (don't need to * 3)
-                    fr4end = qsRec['fr3.end'] + fr4end
-                else:
-                    # TODO: check this case
-                    qsRec['cdr3.end'] = qsRec['jqend']
-
-                    # Can't deduce FR4 !
-                    fr4end = nan
-                    # qsRec['fr4.end'] = len(record.seq)
-                    # qsRec['fr4.start'] =  len(record.seq)
-
-            # FR4 end
-            # Check whether to cut the Ig sequence after FR4 or not
-            if not fr4cut:
-                # if trim3End wasn't of type int, it was a file with seqs to match
-                if not isinstance(trim3End, int):
-                    _, _, _, relativeFR4EndPosition, _ = \
-                        findBestMatchedPattern(str(record.seq)[int(qsRec['cdr3.end']):], trim3End, extend5end=True)
-                    if relativeFR4EndPosition == -1:
-                        # bad alignment - flag it and fall back to consensus FR4end
-                        flags['FR4endless'] += [record.id]
-                        qsRec['fr4.end'] = fr4end
-                    else:
-                        qsRec['fr4.end'] = qsRec['cdr3.end'] + relativeFR4EndPosition
-                        if qsRec['fr4.end'] < qsRec['jqend']:
-                            # if FR4 is somehow misaligned, flag it and fall back to consensus FR4end
-                            # this may happen if: for example, the provided sequence happen to also appear
-                            # before J germline ends, and it matches that first.
-                            flags['FR4cutEarly'] += [record.id]
-                            qsRec['fr4.end'] = fr4end
-                else:
-                    # trim3End is int, use sliced string from earlier as FR4end
-                    qsRec['fr4.end'] = len(record.seq)
-            else:
-                if isnan(fr4end):
-                    qsRec['FR4PredictedError'] += [record.id]
-                qsRec['fr4.end'] = fr4end
+        if fr4start != -1 and fr4end != -1 and fr4end > fr4start:
+            qsRec['fr4.start'] = qsRec['fr3.end'] + fr4start
 
-        # Extract the CDR and FR protein sequences
-        (protein, tmp) = extractCDRsandFRsProtein(protein, qsRec, offset, stream=stream)
-        seqs += tmp
-        if seqs[-1][:4] != FR4_CONSENSUS[chain][:4]:
-            flags['fr4NotAsExpected'] += [record.id]
-        if seqs[-1] == '':
-            flags['noFR4'] += [record.id]
-
-        # Extract the CDR and FR nucleotide sequences
-        # COMMENTED OUT ON:  Fri Feb 16 10:36:41 AEDT 2018 BY JIAHONG - REASON: tmp var not used
-        # is also generating "clones not partitioned correctly although the protein seqs are"
-        # tmp = extractCDRsandFRsDNA(str(record.seq), qsRec)
-        # TODO: consider adding the DNA sequences
-        if '*' in protein:
-            flags['endsWithStopCodon'] += [record.id]
-            # update the StopCodon value if it was set to No
-            if qsRec['stopcodon'] == 'No':
-                flags['updatedStopCodon'] += [record.id]
-                qsRec['stopcodon'] = 'Yes'
-
-                # update the annotation fields with the new calculated values
-        gaps = int(abs(qsRec['vqstart'] - qsRec['vstart']) - offset)
-        mismatches = qsRec['vstart'] - 1
-        if qsRec['vstart'] > qsRec['vqstart'] and gaps > 0:
-            mismatches -= gaps
-
-        # Only update gaps if the actual query start position is known 
-        if gaps > 0:
-            qsRec['fr1.gaps'] += gaps
-            qsRec['vgaps'] += gaps
-
-        # if igblast ignores mismatches at the beginning ==> update
-        if mismatches > 0:
-            qsRec['fr1.mismatches'] += mismatches
-            qsRec['vmismatches'] += mismatches
-            qsRec['vstart'] -= mismatches
-            qsRec['vqstart'] -= mismatches
-        # TODO: update gaps and mismatches in FR4 and CDR3 based on D and J germlines
-        # TODO: update the start and end fields based on the trim5End
-    except Exception as e:
-        if "partitioning" in str(e):
-            flags['partitioning'] += [record.id]
-    return seqs
-
-
-def refineInFramePrediction(qsRec, record, actualQstart, flags, stream=None):
-    inframe = True
-
-    # check the the v-jframe value is not NA
-    if (qsRec['v-jframe'] == 'N/A' or
-            (not isinstance(qsRec['v-jframe'], str) and isnan(qsRec['v-jframe']))):
-        flags['updatedInFrameNA'] += [record.id]
-        inframe = False
-
-    # the query clone is not in concordance with the start of the germline gene
-    offset = int(qsRec['vqstart'] - qsRec['vstart']) + 1  # 1-based
-    if (inframe and (offset < 1 or
-                     (actualQstart != -1 and (offset - 1 - actualQstart) % 3 != 0))):
-        inframe = False
-        flags['updatedInFrameConc'] += [record.id]
-
-    # if no CDR3 or FR4 ==> Out-of-frame
-    if (inframe and (isnan(qsRec['fr4.start']) or
-                     isnan(qsRec['fr4.end']) or isnan(qsRec['cdr3.start']) or
-                     qsRec['cdr3.start'] >= qsRec['cdr3.end'])):
-        inframe = False
-        flags['updatedInFrameNo3or4'] += [record.id]
-
-    # doesn't start/end properly .. not multiple of 3
-    if (inframe and ((qsRec['fr4.end'] - qsRec['fr1.start'] + 1) % 3 != 0 or
-                     (actualQstart != -1 and
-                      ((qsRec['fr4.end'] - actualQstart) % 3 != 0)))):
-        inframe = False
-        flags['updatedInFrame3x'] += [record.id]
-    # print(str(record.seq))
-
-    # indels (gaps) in FRs or CDRs cause frame-shift ==> out-of-frame
-    if (inframe and (
-            qsRec['fr1.gaps'] % 3 != 0 or
-            qsRec['fr2.gaps'] % 3 != 0 or
-            qsRec['fr3g.gaps'] % 3 != 0 or
-            qsRec['cdr1.gaps'] % 3 != 0 or
-            qsRec['cdr2.gaps'] % 3 != 0 or
-            (not isnan(qsRec['cdr3g.gaps']) and qsRec['cdr3g.gaps'] % 3 != 0)
-    )):
-        inframe = False
-        flags['updatedInFrameIndel'] += [record.id]
-
-    # FR1 start is not aligned with query start
-    #             if (not inframe or qsRec['vqstart'] != qsRec['fr1.start']):
-    #                 inframe = False
-
-    if not inframe:
-        qsRec['v-jframe'] = 'Out-of-frame'
-        flags['updatedInFrame'] += [record.id]
-
-    return inframe
+            qsRec['cdr3.end'] = qsRec['fr4.start'] - 1
+            flags['CDR3dna'] += [readId]
+
+            # FR4end is already in nt counts (don't need to * 3)
+            fr4end = qsRec['fr3.end'] + fr4end
+        else:
+            # TODO: check this case
+            qsRec['cdr3.end'] = qsRec['jqend']
+
+            # Can't deduce FR4 !
+            fr4end = nan
+            # qsRec['fr4.end'] = len(seq)
+            # qsRec['fr4.start'] =  len(seq)
+
+    # FR4 end
+    # Check whether to cut the Ig sequence after FR4 or not
+    if not fr4cut:
+        # if trim3End wasn't of type int, it was a file with seqs to match
+        if not isinstance(trim3End, int):
+            _, _, _, relativeFR4EndPosition, _ = \
+                findBestMatchedPattern(seq[int(qsRec['cdr3.end']):], trim3End, extend5end=True)
+            if relativeFR4EndPosition == -1:
+                # bad alignment - flag it and fall back to consensus FR4end
+                flags['FR4endless'] += [readId]
+                qsRec['fr4.end'] = fr4end
+            else:
+                qsRec['fr4.end'] = qsRec['cdr3.end'] + relativeFR4EndPosition
+                if qsRec['fr4.end'] < qsRec['jqend']:
+                    # if FR4 is somehow misaligned, flag it and fall back to consensus FR4end
+                    # this may happen if: for example, the provided sequence happen to also appear
+                    # before J germline ends, and it matches that first.
+                    flags['FR4cutEarly'] += [readId]
+                    qsRec['fr4.end'] = fr4end
+        else:
+            # trim3End is int, use sliced string from earlier as FR4end
+            qsRec['fr4.end'] = len(seq)
+    else:
+        if isnan(fr4end):
+            qsRec['FR4PredictedError'] += [readId]
+        qsRec['fr4.end'] = fr4end
 
 
 def _parse3EndSeqs(seqs):
@@ -307,7 +447,7 @@ def _parse3EndSeqs(seqs):
     return zip(targetids, seqs, maxScores)
 
 
-def _recordFRLength(qsRec, germlineConsensusLength):
+def _recordFRLength(qsRec, germlineConsensusLength, weight=1):
     vgene = qsRec['vgene'].split('*')[0]
     jgene = qsRec['jgene'].split('*')[0]
     for region in ('fr1', 'fr2', 'fr3', 'fr4'):
@@ -316,7 +456,7 @@ def _recordFRLength(qsRec, germlineConsensusLength):
         length = qsRec[end] - qsRec[start] + 1
         gene = vgene if region != 'fr4' else jgene
         if not isnan(length):
-            germlineConsensusLength[gene][region][length] += 1
+            germlineConsensusLength[gene][region][length] += weight
     return germlineConsensusLength
 
 
@@ -8,21 +8,40 @@
 
 from multiprocessing import Process
 from numpy import isnan
-from Bio.Seq import Seq
 from collections import Counter
 
 import abseqPy.IgRepAuxiliary.restrictionAuxiliary
+from abseqPy.IgRepAuxiliary.SitesAutomaton import SitesAutomaton
 from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import cpuSlot
+from abseqPy.instrumentation import StageTimer
 
 
 class RestrictionSitesScanner(Process):
-    # todo(RSA): remove cloneAnnot. using (xthreads) expensive memory multiplier
-    def __init__(self, records, cloneAnnot, procCounter, sites, simpleScan=True, stream=None):
+    def __init__(self, seqStore, positions, coords, procCounter, sites, vgenes=None, simpleScan=True, stream=None):
+        """
+        :param seqStore: SeqStore of the sample
+        :param positions: numpy array of the positions in seqStore of the sequences to scan, tasks are row ranges
+        of this array
+        :param coords: dict of cloneAnnot column -> numpy array of its values, in the order of positions. Requires
+        vqstart, vstart and fr4.end, and the start and end of the regions (see restrictionAuxiliary.findHitsRegion)
+        if simpleScan is False
+        :param procCounter: ProcCounter
+        :param sites: dict of site name -> compiled regex
+        :param vgenes: (codes, names) tuple of the V germlines of the sequences, in the order of positions. Required
+        if simpleScan is False
+        :param simpleScan: bool. simple or detailed analysis
+        :param stream: logging stream
+        """
         super(RestrictionSitesScanner, self).__init__()
-        self.records = records
-        self.cloneAnnot = cloneAnnot
+        self.seqStore = seqStore
+        self.positions = positions
+        self.coords = coords
+        self.vgenes = vgenes
         self.procCounter = procCounter
         self.sites = sites
+        # all the sites, scanned in a single pass over each sequence
+        self.automaton = SitesAutomaton(sites)
         self.simpleScan = simpleScan
         self.tasksQueue = None
         self.exitQueue = None
@@ -31,45 +50,47 @@ class RestrictionSitesScanner(Process):
 
     def run(self):
         printto(self.stream, self.name + " process is now ready to start a new job ...")
-        while True:
-            nextTask = self.tasksQueue.get()
-            if nextTask is None:
-                printto(self.stream, self.name + " process has stopped.")
-                self.exitQueue.put("exit")
-                break
-            try:
-                if self.simpleScan:
-                    self.runSimple(nextTask)
-                else:
-                    self.runDetailed(nextTask)
-            except Exception as e:
-                printto(self.stream, "An error occurred while processing " + self.name + " error: {}".format(
-                    str(e)
-                ), LEVEL.ERR)
-                self.resultsQueue.put(None)
-                continue
+        with StageTimer('rsa', worker=self.name, records=0) as timer:
+            while True:
+                nextTask = self.tasksQueue.get()
+                timer.observeQueue(self.tasksQueue)
+                if nextTask is None:
+                    printto(self.stream, self.name + " process has stopped.")
+                    break
+                index, start, stop = nextTask
+                try:
+                    with cpuSlot():
+                        if self.simpleScan:
+                            stats = self.runSimple(range(start, stop))
+                        else:
+                            stats = self.runDetailed(range(start, stop))
+                    self.procCounter.increment(stop - start)
+                    timer.records += stop - start
+                    self.resultsQueue.put((index, stats))
+                except Exception as e:
+                    printto(self.stream, "An error occurred while processing " + self.name + " error: {}".format(
+                        str(e)
+                    ), LEVEL.ERR)
+                    self.resultsQueue.put((index, None))
+                    continue
+        # the statistics of this worker are written before it tells the main process it is done
+        self.exitQueue.put("exit")
         return
     
     def runSimple(self, nextTask):
         """
         Runs Restriction sites simple analysis
 
-        :param nextTask: iterable of sequence ids that should exist in self.records
-        :return: None
+        :param nextTask: range of rows of self.positions and self.coords
+        :return: RSA statistics of the sequences in nextTask, see restrictionAuxiliary.initRSAStats
         """
         stats = abseqPy.IgRepAuxiliary.restrictionAuxiliary.initRSAStats(simple=True)
         stats['total'] = len(nextTask)
-        for id_ in nextTask:
-            # record = raw sequence (taken from m.dict())
-            record = self.records[id_]
-            qsRec = self.cloneAnnot.loc[id_].to_dict()
+        for row in nextTask:
+            id_, record, qsRec = self._row(row)
             seq = sliceRecord(record, qsRec)
             cut = False
-            for site, siteRegex in self.sites.items():
-                hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seq, siteRegex)
-                if len(hits) == 0:
-                    seqRC = str(Seq(seq).reverse_complement())
-                    hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seqRC, siteRegex)
+            for site, hits, _ in self.automaton.scan(seq):
                 if len(hits) > 0:
                     # how many times has this site found a match on this sequence (seq / seqRC)
                     stats["siteHitsCount"][site] += len(hits)
@@ -84,25 +105,20 @@ class RestrictionSitesScanner(Process):
             # total number of sequences that are cut by *at least* one site
             stats["seqsCutByAny"] += cut
 
-        self.procCounter.increment(len(nextTask))                         
-        self.resultsQueue.put(stats)
+        return stats
         
     def runDetailed(self, nextTask):
         stats = abseqPy.IgRepAuxiliary.restrictionAuxiliary.initRSAStats(simple=False)
         stats['total'] = len(nextTask)
-        for id_ in nextTask:
-            # record = raw sequence (taken from m.dict())
-            record = self.records[id_]
-            qsRec = self.cloneAnnot.loc[id_].to_dict()
+        for row in nextTask:
+            id_, record, qsRec = self._row(row)
             seq = sliceRecord(record, qsRec)
             strand = "forward"
             cut = False
-            for site, siteRegex in self.sites.items():
-                hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seq, siteRegex)
-                if len(hits) == 0:
-                    seqRC = str(Seq(seq).reverse_complement())
+            for site, hits, siteStrand in self.automaton.scan(seq):
+                if siteStrand == "reversed":
+                    # once a site missed the forward strand, the following sites are recorded as reversed too
                     strand = "reversed"
-                    hits = abseqPy.IgRepAuxiliary.restrictionAuxiliary.findHits(seqRC, siteRegex)
                 if len(hits) > 0:
                     # how many times has this site found a match on this sequence (seq / seqRC)
                     stats["siteHitsCount"][site] += len(hits)
@@ -117,17 +133,29 @@ class RestrictionSitesScanner(Process):
                     if len(set(hitsRegion).intersection({'fr1', 'cdr1', 'fr2', 'cdr2', 'fr3'})) and \
                             len(stats["siteHitSeqsGermline"][site]) < 10000:
                         stats["siteHitSeqsGermline"][site].append((strand, record))
-                        stats["siteHitsSeqsIGV"][site].add(qsRec['vgene'].split('*')[0])
+                        stats["siteHitsSeqsIGV"][site].add(self._vgene(row).split('*')[0])
                     stats["hitRegion"][site] += Counter(hitsRegion)
                     cut = True
 
             # total number of sequences that are cut by *at least* one site
             stats["seqsCutByAny"] += cut
 
-        self.procCounter.increment(len(nextTask))
-        self.resultsQueue.put(stats)
+        return stats
+
+    def _row(self, row):
+        """
+        :param row: int. row of self.positions and self.coords
+        :return: (read id, raw sequence, dict of the coords of the sequence) tuple
+        """
+        position = self.positions[row]
+        qsRec = dict((col, values[row]) for col, values in self.coords.items())
+        return self.seqStore.ids[position], self.seqStore.seqAt(position), qsRec
+
+    def _vgene(self, row):
+        codes, names = self.vgenes
+        return names[codes[row]]
+
 
-  
 def sliceRecord(rec, qsRec):
     """
     given a string of nucleotides denoted by 'rec', return a sliced string with starting index at
@@ -0,0 +1,239 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+import json
+import shutil
+import numpy as np
+
+from array import array
+from collections import Counter
+from pandas import Index
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from abseqPy.IgRepertoire.igRepUtils import iterSeqFile
+from abseqPy.logger import printto, LEVEL
+
+
+class SeqStore(object):
+    """
+    read-only, memory-mapped store of the sequences of a sample, indexed by read id. The sequences are kept
+    (byte-packed, one byte per nucleotide) back to back in a single file, next to an array of offsets and the list
+    of read ids, so that fetching the sequence of a read is an O(1) slice of the memory map rather than a seek
+    followed by parsing the record out of the FASTA/FASTQ file.
+
+    The store is built once per sample (see SeqStore.build) and lives in its own directory::
+
+        <storeDir>/sequences.bin    concatenated sequences
+        <storeDir>/offsets.npy      int64, sequence i spans sequences.bin[offsets[i]:offsets[i + 1]]
+        <storeDir>/ids.txt          read ids, one per line, in the order of the reads in the input file
+        <storeDir>/source.json      fingerprint (size and modification time) of the input file
+
+    A store whose input file no longer has the same fingerprint is rebuilt when it is opened (see SeqStore.open)
+    """
+
+    SEQUENCES = "sequences.bin"
+    OFFSETS = "offsets.npy"
+    IDS = "ids.txt"
+    SOURCE = "source.json"
+
+    def __init__(self, storeDir):
+        """
+        opens an existing store
+
+        :param storeDir: string. directory the store was built in
+        """
+        self.storeDir = storeDir
+        self.offsets = np.load(os.path.join(storeDir, SeqStore.OFFSETS), mmap_mode='r')
+        with open(os.path.join(storeDir, SeqStore.IDS)) as fp:
+            self.ids = Index(fp.read().splitlines(), dtype=object)
+        if len(self.ids) != len(self.offsets) - 1:
+            raise ValueError("Sequence store {} is inconsistent, rebuild it by removing the directory"
+                             .format(storeDir))
+        if not self.ids.is_unique:
+            raise ValueError("Sequence store {} has duplicate read ids".format(storeDir))
+        # numpy refuses to memory map empty files
+        if self.offsets[-1] > 0:
+            self.sequences = np.memmap(os.path.join(storeDir, SeqStore.SEQUENCES), dtype=np.uint8, mode='r')
+        else:
+            self.sequences = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        # memory maps are not shipped to other processes, they re-open the store instead
+        return {'storeDir': self.storeDir}
+
+    def __setstate__(self, state):
+        self.__init__(state['storeDir'])
+
+    @staticmethod
+    def exists(storeDir):
+        """
+        :param storeDir: string. directory of the store
+        :return: True if a complete store was built in storeDir
+        """
+        return all(os.path.exists(os.path.join(storeDir, f))
+                   for f in (SeqStore.SEQUENCES, SeqStore.OFFSETS, SeqStore.IDS, SeqStore.SOURCE))
+
+    @staticmethod
+    def fingerprint(readFile):
+        """
+        :param readFile: string. path to FASTA/FASTQ file
+        :return: dict of the size and modification time of readFile
+        """
+        stat = os.stat(readFile)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @staticmethod
+    def source(storeDir):
+        """
+        :param storeDir: string. directory of the store
+        :return: fingerprint of the input file the store was built from, None if it cannot be read
+        """
+        try:
+            with open(os.path.join(storeDir, SeqStore.SOURCE)) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def build(readFile, fmt, storeDir, stream=None):
+        """
+        builds the store of readFile in a single pass over the file. The store is written to a temporary directory
+        that is only renamed to storeDir once it is complete, so that an interrupted build is never picked up
+
+        :param readFile: string. path to FASTA/FASTQ file (may be gzipped)
+        :param fmt: string. fasta or fastq
+        :param storeDir: string. directory of the store, it must not exist yet
+        :param stream: logging stream
+        :return: SeqStore object
+        """
+        printto(stream, "\tSequence store is being built for " + os.path.basename(readFile) + " ... ")
+        tmpDir = storeDir.rstrip(os.path.sep) + ".tmp"
+        if os.path.exists(tmpDir):
+            shutil.rmtree(tmpDir)
+        os.makedirs(tmpDir)
+        # taken before reading, a file that changes while the store is built does not match it afterwards
+        fingerprint = SeqStore.fingerprint(readFile)
+        lengths = array('l')
+        with open(os.path.join(tmpDir, SeqStore.SEQUENCES), 'wb') as seqFp, \
+                open(os.path.join(tmpDir, SeqStore.IDS), 'w') as idFp:
+            for title, seq in iterSeqFile(readFile, fmt):
+                idFp.write((title.split(None, 1) or [""])[0] + "\n")
+                seqFp.write(seq if isinstance(seq, bytes) else seq.encode('ascii'))
+                lengths.append(len(seq))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(tmpDir, SeqStore.OFFSETS), offsets)
+        with open(os.path.join(tmpDir, SeqStore.SOURCE), 'w') as fp:
+            json.dump(fingerprint, fp)
+        os.rename(tmpDir, storeDir)
+        printto(stream, "\t{:,} sequences were stored".format(len(lengths)))
+        return SeqStore(storeDir)
+
+    @staticmethod
+    def open(readFile, fmt, storeDir, stream=None):
+        """
+        opens the store in storeDir, building it from readFile first if needed. A store built from another
+        version of readFile (its size or modification time differ) is rebuilt
+
+        :return: SeqStore object
+        """
+        if SeqStore.exists(storeDir):
+            if SeqStore.source(storeDir) == SeqStore.fingerprint(readFile):
+                return SeqStore(storeDir)
+            printto(stream, "\tSequence store of " + os.path.basename(readFile) + " is out of date, it will be rebuilt",
+                    LEVEL.WARN)
+        if os.path.exists(storeDir):
+            # out of date, or built by a version that did not fingerprint its input
+            shutil.rmtree(storeDir)
+        try:
+            return SeqStore.build(readFile, fmt, storeDir, stream=stream)
+        except Exception as e:
+            printto(stream, "Failed to build the sequence store of " + os.path.basename(readFile), LEVEL.EXCEPT)
+            raise e
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, readId):
+        return readId in self.ids
+
+    def __getitem__(self, readId):
+        """
+        :param readId: string. read id
+        :return: SeqRecord of the read (without quality scores)
+        """
+        return SeqRecord(Seq(self.seq(readId)), id=readId, name=readId, description=readId)
+
+    def view(self, readId):
+        """
+        :param readId: string. read id
+        :return: numpy uint8 array of the read's sequence (ASCII codes). This is a view into the memory map,
+        nothing is copied
+        """
+        return self.viewAt(self.ids.get_loc(readId))
+
+    def viewAt(self, position):
+        """
+        :param position: int. position of the read in the store (see positions)
+        :return: see view
+        """
+        return self.sequences[self.offsets[position]:self.offsets[position + 1]]
+
+    def seq(self, readId):
+        """
+        :param readId: string. read id
+        :return: sequence of the read as a string
+        """
+        return self.seqAt(self.ids.get_loc(readId))
+
+    def seqAt(self, position):
+        """
+        :param position: int. position of the read in the store (see positions)
+        :return: sequence of the read as a string
+        """
+        seq = self.viewAt(position).tobytes()
+        return seq if isinstance(seq, str) else seq.decode('ascii')
+
+    def positions(self, readIds):
+        """
+        :param readIds: iterable of read ids
+        :return: numpy array of the positions of the reads in the store, in the order of readIds. Raises KeyError
+        if a read is not in the store
+        """
+        positions = self.ids.get_indexer(Index(list(readIds), dtype=object))
+        if (positions < 0).any():
+            raise KeyError("{:,} read(s) are not in the sequence store {}"
+                           .format(int((positions < 0).sum()), self.storeDir))
+        return positions
+
+    def records(self, readIds):
+        """
+        :param readIds: iterable of read ids
+        :return: generator of SeqRecord objects, in the order of readIds
+        """
+        for readId in readIds:
+            yield self[readId]
+
+    def lengths(self, readIds=None):
+        """
+        :param readIds: iterable of read ids. Defaults to all the reads in the store
+        :return: numpy array of sequence lengths, in the order of readIds
+        """
+        lengths = np.diff(self.offsets)
+        if readIds is None:
+            return lengths
+        return lengths[self.positions(readIds)]
+
+    def lengthDist(self, readIds=None):
+        """
+        :param readIds: iterable of read ids. Defaults to all the reads in the store
+        :return: Counter of sequence length -> number of reads, same as the one returned by igRepUtils.scanSeqFile
+        """
+        return Counter(self.lengths(readIds).tolist())
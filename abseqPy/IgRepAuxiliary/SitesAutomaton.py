@@ -0,0 +1,191 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+import re
+import itertools
+
+from collections import deque
+from Bio.Seq import Seq
+
+_BASES = 'ACGT'
+_COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+_NOT_BASE = re.compile('[^ACGT]')
+# a position of a site, as written by restrictionAuxiliary.replaceIUPACLetters
+_TOKEN = re.compile(r'[ACGT]|\.|\[([ACGT]+)\]')
+
+# sites that expand to more sequences than this are scanned with their regex, e.g. NNNNNNNN
+MAX_EXPANSION = 4096
+
+
+class SitesAutomaton(object):
+    """
+    restriction sites compiled into a single automaton (Aho-Corasick, as a DFA over A, C, G and T) of every
+    sequence their IUPAC codes expand to, and of the reverse complements of these. A sequence is scanned once, in
+    one pass, whatever the number of sites: a site found on the reverse complement of the sequence is the reverse
+    complement of the site found on the sequence.
+
+    The hits of a site are the same as restrictionAuxiliary.findHits of its regex on the sequence, or on the reverse
+    complement of the sequence if there are none (leftmost, non-overlapping, starts on the strand they were found
+    on). Sequences with letters other than A, C, G and T, and sites that are not IUPAC codes, are scanned with the
+    regexes
+
+    >>> import re
+    >>> automaton = SitesAutomaton({'BamHI': re.compile('GGATCC'), 'BsaI': re.compile('GGTCTC')})
+    >>> sorted(automaton.scan('TTGGATCCGGTCTCAA'))
+    [('BamHI', [2], 'forward'), ('BsaI', [8], 'forward')]
+    >>> sorted(automaton.scan('GAGACCAA'))
+    [('BamHI', [], 'reversed'), ('BsaI', [2], 'reversed')]
+    """
+
+    FORWARD, REVERSED = 'forward', 'reversed'
+
+    def __init__(self, sites):
+        """
+        :param sites: dict of site name -> compiled regex, see restrictionAuxiliary.loadRestrictionSites. The
+        hits of scan come in the order of its keys
+        """
+        self.names = list(sites)
+        self.regexes = sites
+        self.lengths = []
+        # index of the sites scanned with their regexes
+        self.fallback = []
+        # goto[state][letter] -> state, out[state] -> list of (site index, reversed) ending in state
+        self.goto = [{}]
+        self.out = [[]]
+        for i, name in enumerate(self.names):
+            positions = _parse(sites[name].pattern)
+            size = 1
+            for bases in positions or []:
+                size *= len(bases)
+            self.lengths.append(len(positions) if positions else 0)
+            if not positions or size > MAX_EXPANSION:
+                self.fallback.append(i)
+                continue
+            complement = [''.join(_COMPLEMENT[b] for b in bases) for bases in reversed(positions)]
+            for rev, strand in ((False, positions), (True, complement)):
+                for word in itertools.product(*strand):
+                    self._add(''.join(word), (i, rev))
+        self._link()
+
+    def _add(self, word, output):
+        state = 0
+        for c in word:
+            nxt = self.goto[state].get(c)
+            if nxt is None:
+                nxt = self.goto[state][c] = len(self.goto)
+                self.goto.append({})
+                self.out.append([])
+            state = nxt
+        if output not in self.out[state]:
+            self.out[state].append(output)
+
+    def _link(self):
+        # failure links, breadth first, folded into the transitions so that every state has one per base
+        fail = [0] * len(self.goto)
+        queue = deque()
+        for c in _BASES:
+            nxt = self.goto[0].get(c)
+            if nxt is None:
+                self.goto[0][c] = 0
+            else:
+                queue.append(nxt)
+        while queue:
+            state = queue.popleft()
+            self.out[state] = self.out[state] + [o for o in self.out[fail[state]] if o not in self.out[state]]
+            for c in _BASES:
+                nxt = self.goto[state].get(c)
+                if nxt is None:
+                    self.goto[state][c] = self.goto[fail[state]][c]
+                else:
+                    fail[nxt] = self.goto[fail[state]][c]
+                    queue.append(nxt)
+
+    def scan(self, seq):
+        """
+        :param seq: nucleotide sequence
+        :return: list of (site name, hits, strand) tuples, one per site in order. hits is the list of start indices
+        of the site on the strand ("forward" or "reversed") it was found on, see SitesAutomaton. The strand is
+        "reversed" whenever there are no hits on the forward strand, even if there are none on the reverse either
+        """
+        seq = seq.upper()
+        if _NOT_BASE.search(seq):
+            return self._scanRegexes(seq, range(len(self.names)))
+        n = len(seq)
+        forward = [[] for _ in self.names]
+        reverse = [[] for _ in self.names]
+        state = 0
+        goto, out = self.goto, self.out
+        for end, c in enumerate(seq):
+            state = goto[state][c]
+            if out[state]:
+                for i, rev in out[state]:
+                    if rev:
+                        # start of the site on the reverse complement
+                        reverse[i].append(n - 1 - end)
+                    else:
+                        forward[i].append(end - self.lengths[i] + 1)
+        results = []
+        regexResults = dict((name, (hits, strand)) for name, hits, strand in self._scanRegexes(seq, self.fallback))
+        for i, name in enumerate(self.names):
+            if name in regexResults:
+                hits, strand = regexResults[name]
+            elif forward[i]:
+                hits, strand = _nonOverlapping(forward[i], self.lengths[i]), SitesAutomaton.FORWARD
+            else:
+                hits, strand = _nonOverlapping(reverse[i][::-1], self.lengths[i]), SitesAutomaton.REVERSED
+            results.append((name, hits, strand))
+        return results
+
+    def _scanRegexes(self, seq, indices):
+        results = []
+        seqRC = None
+        for i in indices:
+            name = self.names[i]
+            hits = _findHits(seq, self.regexes[name])
+            strand = SitesAutomaton.FORWARD
+            if not hits:
+                if seqRC is None:
+                    seqRC = str(Seq(seq).reverse_complement())
+                hits = _findHits(seqRC, self.regexes[name])
+                strand = SitesAutomaton.REVERSED
+            results.append((name, hits, strand))
+        return results
+
+
+def _parse(pattern):
+    """
+    :param pattern: string. regex of a site
+    :return: list of the bases each position of the site stands for, None if pattern is not a translated IUPAC
+    sequence
+    """
+    positions = []
+    at = 0
+    while at < len(pattern):
+        token = _TOKEN.match(pattern, at)
+        if token is None:
+            return None
+        text = token.group(0)
+        positions.append(_BASES if text == '.' else (token.group(1) or text))
+        at = token.end()
+    return positions
+
+
+def _nonOverlapping(starts, length):
+    """
+    :param starts: sorted list of the starts of the occurrences of a site
+    :param length: int. site length
+    :return: list of the starts of the leftmost non overlapping occurrences, as re.finditer finds them
+    """
+    hits = []
+    for s in starts:
+        if not hits or s >= hits[-1] + length:
+            hits.append(s)
+    return hits
+
+
+def _findHits(seq, site):
+    # restrictionAuxiliary.findHits, which imports this module
+    return [match.start() for match in site.finditer(seq)]
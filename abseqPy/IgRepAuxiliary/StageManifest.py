@@ -0,0 +1,241 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+import glob
+import json
+import hashlib
+
+from abseqPy.logger import printto, LEVEL
+
+# path -> [size, mtime, sha1] of the files fingerprinted by this process, so that files shared by several stages (the
+# reads of the sample) are only read once
+_fingerprinted = {}
+
+
+class StageManifest(object):
+    """
+    record of a run of an analysis stage of a sample: the parameters it ran with, fingerprints of its input files,
+    digests of the stages it builds on and checksums of the files it wrote. A stage whose manifest no longer
+    matches (a parameter or an input changed, an upstream stage was redone, an output was changed or removed) is
+    out of date, its outputs are removed before it runs again so that it recomputes them rather than picking up
+    stale ones.
+
+    The outputs of a stage are the files it writes to its output paths: directories it owns entirely, or glob
+    patterns of the files it writes to directories it shares with other stages. Stages may run at the same time,
+    their output paths must therefore never overlap.
+
+    The manifest is written twice per run: when the stage starts (status "running", along with the state of its
+    output paths at that time) and when it completes (status "complete", along with its outputs). If the
+    manifest of a stage is still "running" when it starts, the previous run was interrupted and every file it
+    created or modified is removed, partially written files included.
+
+    Fingerprints are (size, mtime, sha1) triples, the sha1 of a file is only computed again if its size or mtime
+    changed since it was recorded
+    """
+
+    RUNNING, COMPLETE = 'running', 'complete'
+
+    def __init__(self, filename, root, ignore=('cache',)):
+        """
+        :param filename: string. path to the manifest (JSON) file
+        :param root: string. directory output paths are recorded relative to
+        :param ignore: names of the files and sub-directories of the output paths that are never outputs (e.g.
+        caches whose entries are written atomically and stay valid across runs, or records of the last run shared
+        by several stages)
+        """
+        self.filename = filename
+        self.root = root
+        self.ignore = frozenset(ignore)
+        self.data = None
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fp:
+                    self.data = json.load(fp)
+            except ValueError:
+                # written by a run that was killed before the rename in _write, treat as missing
+                self.data = None
+
+    @property
+    def status(self):
+        return self.data['status'] if self.data is not None else None
+
+    def digest(self):
+        """
+        :return: string. digest of the outputs of the completed stage, None if the stage never completed
+        """
+        if self.status != StageManifest.COMPLETE:
+            return None
+        outputs = sorted((path, fp[2]) for path, fp in self.data['outputs'].items())
+        return hashlib.sha1(json.dumps(outputs).encode('utf-8')).hexdigest()
+
+    def isUpToDate(self, params, inputs, upstream):
+        """
+        :param params: dict of parameter name -> value
+        :param inputs: list of paths to the input files of the stage
+        :param upstream: dict of stage name -> digest of the stages this one builds on
+        :return: bool. True if the stage completed with the same parameters, inputs and upstream stages, and its
+        outputs are unchanged
+        """
+        if self.status != StageManifest.COMPLETE:
+            return False
+        if self.data['params'] != _normalize(params) or self.data['upstream'] != _normalize(upstream):
+            return False
+        if self.data['inputs'] != _normalize(self._fingerprints(inputs, self.data['inputs'], relative=False)):
+            return False
+        outputs = self.data['outputs']
+        return all(os.path.exists(self._abs(path)) for path in outputs) and \
+            self._fingerprints([self._abs(path) for path in outputs], outputs) == outputs
+
+    def clean(self, paths, stream=None):
+        """
+        removes the outputs of the stage: the files recorded by the last completed run, or, if the last run was
+        interrupted, the files it created or modified
+
+        :param paths: list of the output paths of the stage (directories or glob patterns of files)
+        :param stream: logging stream
+        :return: None
+        """
+        if self.status == StageManifest.COMPLETE:
+            stale = [self._abs(path) for path in self.data['outputs']]
+        elif self.status == StageManifest.RUNNING:
+            before = self.data['before']
+            stale = [path for path, state in self._snapshot(paths).items() if before.get(self._rel(path)) != state]
+        else:
+            return
+        stale = [path for path in stale if os.path.exists(path)]
+        if stale:
+            printto(stream, "\t{:,} output file(s) of an {} run of this stage are being removed ..."
+                    .format(len(stale), "out of date" if self.status == StageManifest.COMPLETE else "interrupted"),
+                    LEVEL.WARN)
+        for path in stale:
+            os.remove(path)
+
+    def begin(self, params, inputs, upstream, paths):
+        """
+        records the start of a run of the stage
+
+        :param params: dict of parameter name -> value
+        :param inputs: list of paths to the input files of the stage
+        :param upstream: dict of stage name -> digest of the stages this one builds on
+        :param paths: list of the output paths of the stage (directories or glob patterns of files)
+        :return: None
+        """
+        known = self.data['inputs'] if self.data is not None else {}
+        previous = self.data['outputs'] if self.status == StageManifest.COMPLETE else {}
+        self.data = {
+            'status': StageManifest.RUNNING,
+            'params': _normalize(params),
+            'inputs': _normalize(self._fingerprints(inputs, known, relative=False)),
+            'upstream': _normalize(upstream),
+            'before': dict((self._rel(path), state) for path, state in self._snapshot(paths).items()),
+            'outputs': previous
+        }
+        self._write()
+
+    def complete(self, paths, upstream):
+        """
+        records the completion of the run started by begin. The outputs of the stage are the files of paths that
+        were created or modified by the run, and the outputs of the previous run that are still there
+
+        :param paths: list of the output paths of the stage (directories or glob patterns of files)
+        :param upstream: dict of stage name -> digest of the stages this one builds on, as they are now (they may
+        have run during this stage)
+        :return: None
+        """
+        before = self.data.pop('before')
+        self.data['upstream'] = _normalize(upstream)
+        previous = self.data['outputs']
+        outputs = [path for path, state in self._snapshot(paths).items()
+                   if before.get(self._rel(path)) != state or self._rel(path) in previous]
+        self.data['outputs'] = _normalize(self._fingerprints(outputs, previous))
+        self.data['status'] = StageManifest.COMPLETE
+        self._write()
+
+    def _write(self):
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # a stage running in another process got there first
+                if not os.path.isdir(directory):
+                    raise
+        tmpFile = self.filename + "." + str(os.getpid()) + ".tmp"
+        with open(tmpFile, 'w') as fp:
+            json.dump(self.data, fp, indent=1, sort_keys=True)
+        os.rename(tmpFile, self.filename)
+
+    def _snapshot(self, paths):
+        """
+        :param paths: list of directories and glob patterns of files
+        :return: dict of path -> [size, mtime] of the files in paths (and in the sub-directories of the directories),
+        except ignored ones
+        """
+        files = []
+        for pattern in paths:
+            for match in glob.glob(pattern):
+                if not os.path.isdir(match):
+                    files.append(match)
+                    continue
+                for dirpath, dirnames, filenames in os.walk(match):
+                    dirnames[:] = [d for d in dirnames if d not in self.ignore]
+                    files.extend(os.path.join(dirpath, f) for f in filenames)
+        state = {}
+        for path in files:
+            if os.path.basename(path) in self.ignore or path == self.filename or path.endswith('.tmp'):
+                continue
+            stat = os.stat(path)
+            state[path] = [stat.st_size, stat.st_mtime]
+        return state
+
+    def _fingerprints(self, paths, known, relative=True):
+        """
+        :param paths: list of paths to files, missing files are left out
+        :param known: dict of recorded path -> [size, mtime, sha1], the sha1 of a file is taken from there if its
+        size and mtime did not change
+        :param relative: bool. record the paths relative to root
+        :return: dict of recorded path -> [size, mtime, sha1]
+        """
+        fingerprints = {}
+        for path in paths:
+            if path is None or not os.path.isfile(path):
+                continue
+            key = self._rel(path) if relative else path
+            stat = os.stat(path)
+            for recorded in (known.get(key), _fingerprinted.get(os.path.abspath(path))):
+                if recorded is not None and recorded[0] == stat.st_size and recorded[1] == stat.st_mtime:
+                    fingerprints[key] = list(recorded)
+                    break
+            else:
+                fingerprints[key] = [stat.st_size, stat.st_mtime, _sha1(path)]
+            _fingerprinted[os.path.abspath(path)] = fingerprints[key]
+        return fingerprints
+
+    def _rel(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _abs(self, path):
+        return os.path.join(self.root, path)
+
+
+def _sha1(path, blockSize=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(blockSize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _normalize(obj):
+    """
+    :param obj: JSON serializable object
+    :return: obj as it reads back from JSON (tuples become lists, keys strings, ...), so that it can be compared
+    with the content of a manifest
+    """
+    return json.loads(json.dumps(obj, sort_keys=True))
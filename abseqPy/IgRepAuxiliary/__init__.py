@@ -7,13 +7,22 @@
 
 __all__ = [
     'annotateAuxiliary',
+    'ChunkCollator',
+    'ChunkScheduler',
+    'dedupAuxiliary',
     'diversityAuxiliary',
     'IgBlastWorker',
+    'MatchCache',
+    'PatternMatcher',
     'primerAuxiliary',
     'productivityAuxiliary',
     'RefineWorker',
     'restrictionAuxiliary',
     'RestrictionSitesScanner',
+    'schemaAuxiliary',
+    'SeqStore',
+    'SitesAutomaton',
+    'StageManifest',
     'seqUtils.py',
     'upstreamAuxiliary'
 ]
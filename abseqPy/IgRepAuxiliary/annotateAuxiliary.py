@@ -7,29 +7,133 @@
 from __future__ import division
 import os
 import sys
-import glob
-import gc
 
 from multiprocessing import Queue
+from threading import Thread
 from collections import Counter
-from Bio import SeqIO
-from pandas.core.frame import DataFrame
 from math import ceil
 
-from abseqPy.IgRepAuxiliary.IgBlastWorker import analyzeSmallFile, IgBlastWorker
-from abseqPy.IgRepertoire.igRepUtils import splitFastaFile, safeOpen
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from abseqPy.IgRepAuxiliary.IgBlastWorker import IgBlastWorker, chunkCacheDigest
+from abseqPy.IgRepAuxiliary.ChunkCollator import ChunkCollator
+from abseqPy.IgRepertoire.igRepUtils import safeOpen
 from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import stopWorkers
+from abseqPy.instrumentation import StageTimer
+
+
+class FastaChunkReader(Thread):
+    """
+    cuts a FASTA file into chunks of seqsPerFile sequences while the file is being read. Every chunk is written
+    to filesDir and handed to the IgBLAST workers through tasksQueue as soon as it is complete. If cacheDir is
+    given, every chunk is also assigned a cache file in cacheDir, named after the digest of the chunk's content
+    (see IgBlastWorker.chunkCacheDigest)
+    """
+
+    def __init__(self, fastaFile, seqsPerFile, filesDir, prefix, ext, tasksQueue, noWorkers,
+                 cacheDir=None, cacheDigest=None, stream=None):
+        super(FastaChunkReader, self).__init__()
+        self.fastaFile = fastaFile
+        self.seqsPerFile = seqsPerFile
+        self.filesDir = filesDir
+        self.prefix = prefix
+        self.ext = ext
+        self.tasksQueue = tasksQueue
+        self.noWorkers = noWorkers
+        self.cacheDir = cacheDir
+        self.cacheDigest = cacheDigest
+        self.stream = stream
+        self.daemon = True
+        # number of chunks handed out so far, and the exception that stopped the reader (if any)
+        self.chunks = 0
+        self.timer = None
+        self.cacheHits = 0
+        self.error = None
+        self.stopped = False
+
+    def run(self):
+        try:
+            if not os.path.isdir(self.filesDir):
+                os.makedirs(self.filesDir)
+            out = digest = None
+            seqs = 0
+            with StageTimer('split', records=0) as self.timer, safeOpen(self.fastaFile) as fp:
+                for line in fp:
+                    if line.startswith(">"):
+                        if self.stopped:
+                            break
+                        if seqs == self.seqsPerFile:
+                            self._emit(out, digest, seqs)
+                            out, seqs = None, 0
+                        if out is None:
+                            out = open(os.path.join(self.filesDir, self.prefix + "part" + str(self.chunks + 1) +
+                                                    self.ext), 'w')
+                            if self.cacheDir is not None:
+                                digest = self.cacheDigest.copy()
+                        seqs += 1
+                    if out is not None:
+                        out.write(line)
+                        if digest is not None:
+                            line = line.rstrip()
+                            digest.update((line if isinstance(line, bytes) else line.encode("utf-8")) + b"\n")
+                if out is not None:
+                    if self.stopped:
+                        out.close()
+                    else:
+                        self._emit(out, digest, seqs)
+        except Exception as e:
+            printto(self.stream, "Something went wrong while distributing " + os.path.basename(self.fastaFile),
+                    LEVEL.EXCEPT)
+            self.error = e
+        finally:
+            # Add a poison pill for each worker
+            for _ in range(self.noWorkers):
+                self.tasksQueue.put(None)
+
+    def stop(self):
+        """
+        stops cutting chunks, the chunk being cut is dropped
+        """
+        self.stopped = True
+
+    def _emit(self, out, digest, seqs):
+        out.close()
+        self.chunks += 1
+        self.timer.records += seqs
+        # how far ahead of the IgBLAST workers the reader is
+        self.timer.observeQueue(self.tasksQueue)
+        cacheFile = None
+        if digest is not None:
+            cacheFile = os.path.join(self.cacheDir, digest.hexdigest() + ".h5")
+            if os.path.exists(cacheFile):
+                self.cacheHits += 1
+        # blocks if the workers are lagging behind, so that only a handful of chunks are ever on disk
+        self.tasksQueue.put((self.chunks, out.name, cacheFile, seqs))
 
 
 def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
-                      seqType='dna', outdir="", domainSystem='imgt', stream=None):
+                      seqType='dna', outdir="", domainSystem='imgt', cacheDir=None, noSeqs=None, stream=None):
+        """
+        annotates the sequences in fastaFile with IgBLAST
+
+        :param noSeqs: int. Number of sequences in fastaFile, counted here if not provided
+        :param cacheDir: string. If provided, the annotation of every chunk is cached in this directory, keyed by the
+        content of the chunk and the IgBLAST parameters. Chunks that were annotated by a previous run are loaded from
+        the cache instead of being aligned again
+        :return: (cloneAnnot, filteredIDs) tuple
+        """
         if fastaFile is None:
             return Counter()
 
         # Estimate the IGV diversity in a library from igblast output 
         printto(stream, 'The IGV clones of ' + os.path.basename(fastaFile) + ' are being annotated ...')
-        with open(fastaFile) as f:
-            noSeqs = sum(1 for line in f if line.startswith(">"))
+        if noSeqs is None:
+            with safeOpen(fastaFile) as f:
+                noSeqs = sum(1 for line in f if line.startswith(">"))
         totalFiles = int(ceil(noSeqs / seqsPerFile))
         if totalFiles < noWorkers:
             seqsPerFile = int(noSeqs / noWorkers) if noSeqs >= noWorkers else noSeqs
@@ -56,81 +160,71 @@ def annotateIGSeqRead(fastaFile, chain, db, noWorkers, seqsPerFile,
         # else:
         #     newFastFile = fastaFile
 
-        newFastFile = fastaFile
-
-        # if we only asked for one worker or if the sequences within the fasta file is smaller than the threshold in
-        # in seqsPerFile, we can just analyze the file without splitting it
-        if noWorkers == 1 or noSplit:
-            cloneAnnot, filteredIDs = analyzeSmallFile(newFastFile, chain, db,
-                                                       seqType, noWorkers, outdir,
-                                                       domainSystem=domainSystem, stream=stream)
-        else:
-            # split FASTA file into smaller files
-            prefix, ext = os.path.splitext(os.path.basename(fastaFile))
-            filesDir = os.path.join(outdir,  "tmp")
-            prefix = prefix[prefix.find("_R")+1:prefix.find("_R")+3] + "_" if (prefix.find("_R") != -1) else ""
-            splitFastaFile(fastaFile, totalFiles, seqsPerFile, filesDir, prefix, ext, stream=stream)
-
-            # Prepare the multiprocessing queues
-            tasks = Queue()    
-            outcomes = Queue()   
-            exitQueue = Queue()              
-            cloneAnnot = DataFrame()
-            filteredIDs = []
-            workers = []
-            try:
-                # Initialize workers
-                for _ in range(noWorkers):
-                    w = IgBlastWorker(chain, db,
-                                      seqType, int(ceil(noWorkers / totalFiles)),
-                                      domainSystem=domainSystem, stream=stream)
-                    w.tasksQueue = tasks
-                    w.resultsQueue = outcomes
-                    w.exitQueue = exitQueue      
-                    workers.append(w)
-                    w.start()       
-                    sys.stdout.flush()
-
-                # initialize tasks queue with file names     
-                for i in range(totalFiles):
-                    tasks.put(os.path.join(filesDir, prefix + "part" + str(i + 1) + ext))
-
-                # Add a poison pill for each worker
-                for _ in range(noWorkers + 10):
-                    tasks.put(None)                  
-               
-                # Wait all process workers to terminate    
-                i = 0 
-                while i < noWorkers:    
-                    m = exitQueue.get()
-                    if m == "exit":
-                        i += 1
-                
-                # Collect results
-                printto(stream, "Results are being collated from all workers ...")
+        # the reader thread cuts chunks from the FASTA file on the fly, each worker aligns a chunk with IgBLAST
+        # while parsing the output of the chunk it aligned before, so parsing overlaps with the alignment
+        prefix, ext = os.path.splitext(os.path.basename(fastaFile))
+        filesDir = os.path.join(outdir,  "tmp")
+        prefix = prefix[prefix.find("_R")+1:prefix.find("_R")+3] + "_" if (prefix.find("_R") != -1) else ""
+        igBlastThreads = int(ceil(noWorkers / max(totalFiles, 1)))
+        noWorkers = max(min(noWorkers, totalFiles), 1)
+
+        # Prepare the multiprocessing queues
+        tasks = Queue(noWorkers)
+        outcomes = Queue()
+        exitQueue = Queue()
+        collator = ChunkCollator(noSeqs, stream=stream)
+        workers = []
+        cacheDigest = chunkCacheDigest(chain, db, seqType, domainSystem) if cacheDir is not None else None
+        reader = FastaChunkReader(fastaFile, seqsPerFile, filesDir, prefix, ext, tasks, noWorkers,
+                                  cacheDir=cacheDir, cacheDigest=cacheDigest, stream=stream)
+        try:
+            # Initialize workers
+            for _ in range(noWorkers):
+                w = IgBlastWorker(chain, db,
+                                  seqType, igBlastThreads,
+                                  domainSystem=domainSystem, stream=stream)
+                w.tasksQueue = tasks
+                w.resultsQueue = outcomes
+                w.exitQueue = exitQueue
+                workers.append(w)
+                w.start()
                 sys.stdout.flush()
-                while totalFiles:
-                    outcome = outcomes.get()
-                    totalFiles -= 1                    
-                    if outcome is None:
-                        continue                    
-                    (cloneAnnoti, fileteredIDsi) = outcome
-                    cloneAnnot = cloneAnnot.append(cloneAnnoti)
-                    filteredIDs += fileteredIDsi
-                    sys.stdout.flush()
-                    gc.collect()
-                printto(stream, "\tResults were collated successfully.")
-                    
-            except Exception:
-                printto(stream, "Something went wrong during the annotation process!", LEVEL.EXCEPT)
-                raise
-            finally:
-                for w in workers:
-                    w.terminate()
-
-            # Clean folders to save space
-            # TODO: remove .fasta and .out files
-            if noSeqs > seqsPerFile and os.path.exists(filesDir + os.path.sep + prefix + "part1" + ext):
-                map(os.remove, glob.glob(filesDir + os.path.sep + "*" + ext))
+
+            # start handing out chunks
+            reader.start()
+
+            # Collect results as soon as they are parsed, they are put back in read order once all chunks are in
+            printto(stream, "Results are being collated from all workers ...")
+            collated = 0
+            while reader.is_alive() or collated < reader.chunks:
+                try:
+                    index, outcome = outcomes.get(timeout=1)
+                except Empty:
+                    continue
+                collated += 1
+                collator.add(index, outcome, size=(len(outcome[0]) + len(outcome[1])) if outcome is not None else 0)
+            if reader.error is not None:
+                raise reader.error
+            if reader.cacheHits:
+                printto(stream, "\t{:,}/{:,} chunk(s) were loaded from the annotation cache"
+                        .format(reader.cacheHits, reader.chunks))
+            results = collator.payloads()
+            cloneAnnot = collator.concatFrames([cloneAnnoti for cloneAnnoti, _ in results])
+            filteredIDs = collator.concatLists([filteredIDsi for _, filteredIDsi in results])
+            printto(stream, "\tResults were collated successfully.")
+
+            # Wait all process workers to terminate
+            i = 0
+            while i < noWorkers:
+                m = exitQueue.get()
+                if m == "exit":
+                    i += 1
+
+        except Exception:
+            printto(stream, "Something went wrong during the annotation process!", LEVEL.EXCEPT)
+            raise
+        finally:
+            reader.stop()
+            stopWorkers(workers, tasks, outcomes)
 
         return cloneAnnot, filteredIDs
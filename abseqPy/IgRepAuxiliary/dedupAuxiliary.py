@@ -0,0 +1,121 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+from collections import Counter
+from pandas import Series, Index
+
+from abseqPy.IgRepertoire.igRepUtils import iterSeqFile
+from abseqPy.logger import printto, LEVEL
+
+
+def collapseDuplicateReads(readFile, fmt, uniqueFile=None, stream=None):
+    """
+    finds reads that have exactly the same sequence. The first read of every group of identical reads is its
+    representative, the remaining reads are its duplicates. IgBLAST and the refinement step yield the same result
+    for identical sequences, so only the representatives need to go through them
+
+    :param readFile: string. path to FASTA/FASTQ file (may be gzipped)
+    :param fmt: string. fasta or fastq
+    :param uniqueFile: string. If provided, the representatives are written to this FASTA file, in read order
+    :param stream: logging stream
+    :return: Series indexed by read id (in read order) whose values are the id of the read's representative.
+    """
+    printto(stream, "Identical reads are being collapsed ... ")
+    representatives = {}
+    readIds = []
+    repIds = []
+    out = open(uniqueFile, 'w') if uniqueFile is not None else None
+    try:
+        for title, seq in iterSeqFile(readFile, fmt):
+            readId = (title.split(None, 1) or [""])[0]
+            rep = representatives.get(seq)
+            if rep is None:
+                rep = representatives[seq] = readId
+                if out is not None:
+                    out.write(">" + title + "\n" + seq + "\n")
+            readIds.append(readId)
+            repIds.append(rep)
+    finally:
+        if out is not None:
+            out.close()
+    noReads, noUnique = len(readIds), len(representatives)
+    if noReads:
+        printto(stream, "\t{:,}/{:,} ({:.2%}) reads are unique".format(noUnique, noReads, noUnique / noReads),
+                LEVEL.INFO)
+    return Series(repIds, index=Index(readIds, name='queryid'), dtype=object)
+
+
+def representativesOf(index, representatives):
+    """
+    restricts the representatives to the reads in index. Every group of identical reads is represented by its
+    first member that appears in index, so that each representative is guaranteed to be a member of index.
+    Reads that representatives does not know about represent themselves
+
+    :param index: iterable of read ids, e.g. cloneAnnot.index
+    :param representatives: Series, as returned by collapseDuplicateReads
+    :return: Series indexed by index whose values are the representative id of each read
+    """
+    reps = representatives.reindex(index)
+    unknown = reps.isnull()
+    if unknown.any():
+        reps[unknown] = reps.index[unknown]
+    # the first member of a group (in index order) becomes the group's representative
+    firstMember = Series(reps.index, index=reps.index).groupby(reps.values, sort=False).transform('first')
+    return firstMember
+
+
+def representativeCounts(reps):
+    """
+    :param reps: Series, as returned by representativesOf
+    :return: dict of representative id -> number of reads (itself included) it represents
+    """
+    return dict(Counter(reps.values))
+
+
+def expandRepresentatives(df, reps):
+    """
+    gives every read the row of its representative
+
+    :param df: dataframe indexed by representative ids
+    :param reps: Series indexed by read id whose values are representative ids (see collapseDuplicateReads and
+    representativesOf). Reads whose representative is not in df are left out
+    :return: dataframe indexed by read id, in the order of reps
+    """
+    if df.empty:
+        return df
+    reps = reps[reps.isin(df.index)]
+    expanded = df.loc[reps.values]
+    expanded.index = Index(reps.index, name=df.index.name)
+    return expanded
+
+
+def expandRepresentativeIDs(ids, reps):
+    """
+    replaces every representative id in ids by the ids of all the reads it represents. A read appears as many
+    times as its representative does in ids
+
+    :param ids: list of representative ids
+    :param reps: Series indexed by read id whose values are representative ids
+    :return: list of read ids, in the order of reps
+    """
+    multiplicity = Counter(ids)
+    if not multiplicity:
+        return []
+    return [readId for readId, rep in zip(reps.index, reps.values) for _ in range(multiplicity.get(rep, 0))]
+
+
+def expandRepresentativeRows(rows, reps):
+    """
+    list flavour of expandRepresentatives; the first element of every row is the representative's id
+
+    :param rows: list of lists, one per representative
+    :param reps: Series indexed by read id whose values are representative ids
+    :return: list of lists, one per read (in the order of reps) with the read's id as the first element
+    """
+    byRep = dict((row[0], row) for row in rows)
+    return [[readId] + byRep[rep][1:] for readId, rep in zip(reps.index, reps.values) if rep in byRep]
@@ -7,53 +7,50 @@
 
 import os
 import gc
-import sys
 import numpy as np
 
-from math import ceil
 from multiprocessing import Queue
-from Bio import SeqIO
 from collections import Counter
 from pandas import DataFrame
 
-from abseqPy.IgRepAuxiliary.productivityAuxiliary import ProcCounter
+from abseqPy.IgRepAuxiliary.productivityAuxiliary import ProcCounter, affordableWorkers
 from abseqPy.IgRepReporting.igRepPlots import plotDist, plotVenn
 from abseqPy.IgRepAuxiliary.PrimerWorker import PrimerWorker
-from abseqPy.IgRepertoire.igRepUtils import gunzip, compressCountsGeneLevel
-from abseqPy.utilities import hasLargeMem
+from abseqPy.IgRepAuxiliary.ChunkCollator import ChunkCollator
+from abseqPy.IgRepAuxiliary.ChunkScheduler import ChunkScheduler
+from abseqPy.IgRepAuxiliary.schemaAuxiliary import compactCloneAnnot, fillMissing, restoreMissing
+from abseqPy.IgRepertoire.igRepUtils import compressCountsGeneLevel
 from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import stopWorkers
 
 
-def addPrimerData(cloneAnnot, readFile, format, fr4cut, trim5end,
+def addPrimerData(cloneAnnot, seqStore, fr4cut, trim5end,
                   trim3end, actualQstart, end5, end3, end5offset, threads, stream=None):
     printto(stream, "Primer specificity analysis has begun ...")
     queryIds = cloneAnnot.index
-    seqsPerFile = 100
+    # the primer columns are added to a shallow copy, cloneAnnot may be shared with other tasks
+    cloneAnnot = cloneAnnot.copy(deep=False)
     _addPrimerColumns(cloneAnnot, end5, end3)
     workers = []
-    records = SeqIO.index(gunzip(readFile), format)
+    tasks = Queue()
+    exitQueue = Queue()
+    resultsQueue = Queue()
     newColumns = ['queryid'] + list(cloneAnnot.columns)
     try:
-        printto(stream, "\t " + format + " index created and primer analysis started ...")
+        printto(stream, "\tPrimer analysis started ...")
         noSeqs = len(queryIds)
-        totalTasks = int(ceil(noSeqs * 1.0 / seqsPerFile))
-        tasks = Queue()
-        exitQueue = Queue()
-        resultsQueue = Queue()
         procCounter = ProcCounter(noSeqs, stream=stream)
-        threads = min(threads, totalTasks)
-        if not hasLargeMem():
-            threads = 2
+        threads = affordableWorkers(min(threads, noSeqs), cloneAnnot, stream=stream)
         for _ in range(threads):
             w = PrimerWorker(procCounter, fr4cut, trim5end, trim3end, actualQstart, end5,
-                             end3, end5offset, tasks, exitQueue, resultsQueue, stream=stream)
+                             end3, end5offset, tasks, exitQueue, resultsQueue, cloneAnnot=cloneAnnot,
+                             seqStore=seqStore, stream=stream)
             workers.append(w)
             w.start()
-        for i in range(totalTasks):
-            ids = queryIds[i * seqsPerFile:(i + 1) * seqsPerFile]
-            recs = map(lambda x: records[x], ids)
-            qsRecs = map(lambda x: cloneAnnot.loc[x].to_dict(), ids)
-            tasks.put((recs, qsRecs))
+        # workers fetch the clones of a chunk themselves, given its row range. Chunks are handed out as workers
+        # become idle and their results are collated as they arrive
+        collator = ChunkScheduler(noSeqs, threads, stream=stream) \
+            .run(tasks, resultsQueue, ChunkCollator(noSeqs, stream=stream))
 
         # poison pills
         for _ in range(threads + 10):
@@ -65,41 +62,30 @@ def addPrimerData(cloneAnnot, readFile, format, fr4cut, trim5end,
             i += (m == 'exit')
         printto(stream, "All workers have completed their tasks successfully.")
         printto(stream, "Results are being collated from all workers ...")
-        cloneAnnotList = _collectPrimerResults(newColumns, resultsQueue, totalTasks, noSeqs, stream=stream)
+        cloneAnnotList = _collectPrimerResults(newColumns, collator, stream=stream)
         printto(stream, "Results were collated successfully.")
     except Exception as e:
         printto(stream, "Something went wrong during the primer specificity analysis!", LEVEL.EXCEPT)
         raise e
     finally:
-        for w in workers:
-            w.terminate()
-        records.close()
+        stopWorkers(workers, tasks, resultsQueue)
 
     primerAnnot = DataFrame(cloneAnnotList, columns=newColumns)
     primerAnnot.set_index('queryid', drop=True, inplace=True)
-    return primerAnnot
+    return compactCloneAnnot(primerAnnot)
 
 
-def _collectPrimerResults(columns, queue, totalTasks, noSeqs, stream=None):
-    processed = 0
+def _collectPrimerResults(columns, collator, stream=None):
     cloneAnnot = []
     totalUnexpected5 = totalUnexpected3 = 0
-    while totalTasks:
-        result = queue.get()
-        totalTasks -= 1
-        if result is None:
-            continue
+    # chunks are visited in read order, no matter which worker analysed them first
+    for result in collator.payloads():
         for entry, unexpected5, unexpected3 in result:
             totalUnexpected5 += unexpected5
             totalUnexpected3 += unexpected3
             # put them as a list (in the ordering specified by 'columns')
             cloneAnnot.append([entry[col] for col in columns])
-        processed = len(cloneAnnot)
-        if processed % 50000 == 0:
-            printto(stream, "\t{:,}/{:,} records have been collected ... ".format(processed, noSeqs))
-            sys.stdout.flush()
 
-    printto(stream, "\t{:,}/{:,} records have been collected ... ".format(processed, noSeqs))
     printto(stream, "\tThere were {} unexpected 5' alignment and {} unexpected 3' alignment"
             .format(totalUnexpected5, totalUnexpected3), LEVEL.WARN)
     return cloneAnnot
@@ -169,7 +155,7 @@ def writePrimerStats(end, name, cloneAnnot, fileprefix, category="All", stream=N
 def generatePrimerPlots(cloneAnnot, outDir, name, end5, end3, stream=None):
     nanString = 'NaN'
     # similar with productivity analysis etc ..
-    cloneAnnot.fillna(nanString, inplace=True)
+    fillMissing(cloneAnnot, nanString)
     NA = str(np.nan)
     PRIMER5 = '5endPrimer'
     PRIMER3 = '3endPrimer'
@@ -236,5 +222,5 @@ def generatePrimerPlots(cloneAnnot, outDir, name, end5, end3, stream=None):
                      os.path.join(outDir, name + "_productive_invalid_primers.png"),
                      "Intersection of indelled 5' and 3' sequences (productive)", stream=stream)
     # similar with abundance analysis etc ..
-    cloneAnnot.replace(nanString, np.nan, inplace=True)
+    restoreMissing(cloneAnnot, nanString)
     gc.collect()
@@ -9,18 +9,20 @@ import gc
 import sys
 import os
 
-from Bio import SeqIO
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 from pandas.core.frame import DataFrame
 from numpy import random, isnan
 from multiprocessing import Queue, Value, Lock
-from math import ceil
 
 from abseqPy.IgRepAuxiliary.RefineWorker import RefineWorker
-from abseqPy.IgRepertoire.igRepUtils import gunzip
+from abseqPy.IgRepAuxiliary.ChunkCollator import ChunkCollator
+from abseqPy.IgRepAuxiliary.ChunkScheduler import ChunkScheduler
+from abseqPy.IgRepAuxiliary.dedupAuxiliary import representativesOf, representativeCounts, \
+    expandRepresentativeRows, expandRepresentativeIDs
 from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields
+from abseqPy.IgRepAuxiliary.schemaAuxiliary import compactCloneAnnot, compactCloneSeqs, internStrings
 from abseqPy.logger import LEVEL, printto
-from abseqPy.utilities import hasLargeMem
+from abseqPy.utilities import ioBufferSize, workersWithinBudget, stopWorkers
 
 
 def loadRefineFlagInfo():
@@ -54,51 +56,62 @@ def loadRefineFlagInfo():
     return list(refineFlagMsgs.keys()), refineFlagMsgs
 
 
-def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, format,
+def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, seqStore,
                            actualQstart, chain, fr4cut,
                            trim5End, trim3End,
-                           seqsPerFile, threads, stream=None):
+                           seqsPerFile, threads, representatives=None, stream=None):
+    """
+    refines the IgBLAST annotation of every clone in cloneAnnotOriginal
+
+    :param seqStore: SeqStore object holding the sequences of the clones
+    :param seqsPerFile: int. largest number of clones a worker is handed at once, chunks are sized adaptively
+    :param representatives: Series, as returned by dedupAuxiliary.collapseDuplicateReads. If provided, only one
+    clone of every group of identical reads is refined, its refinement is copied to the rest of the group and the
+    framework length tallies are weighted by the size of the group
+    :return: (refined cloneAnnot, cloneSeqs) tuple
+    """
     printto(stream, "Clone annotation and in-frame prediction are being refined ...")
-    seqsPerFile = 100
     cloneAnnot = cloneAnnotOriginal.copy()
     queryIds = cloneAnnot.index
+    # the clones to be refined, the workers inherit them (rather than having them pickled chunk by chunk)
+    pendingAnnot = cloneAnnot
+    weights = None
+    if representatives is not None:
+        representatives = representativesOf(queryIds, representatives)
+        weights = representativeCounts(representatives)
+        queryIds = queryIds[queryIds.isin(list(weights.keys()))]
+        printto(stream, "\t{:,} unique clones represent all {:,} clones".format(len(queryIds), len(cloneAnnot)))
+        weights = [weights[x] for x in queryIds]
+        pendingAnnot = cloneAnnot.loc[queryIds]
     (refineFlagNames, refineFlagMsgs) = loadRefineFlagInfo()
-    records = None
-    workers = None
+    workers = []
+    tasks = Queue()
+    exitQueue = Queue()
+    resultsQueue = Queue()
     try:
-        # process clones from the FASTA/FASTQ file
-
-        # NOTE:
-        # if the readFile is gzipped, we need to unzip it in the same directory before passing into
-        # SeqIO.index because it doesn't accept gzipped nor opened files
-        records = SeqIO.index(gunzip(readFile), format)
-        printto(stream, "\t " + format + " index created and refinement started ...")
+        printto(stream, "\tRefinement started ...")
         # Parallel implementation of the refinement
         noSeqs = len(queryIds)
-        totalTasks = int(ceil(noSeqs / seqsPerFile))
-        tasks = Queue()
-        exitQueue = Queue()
-        resultsQueue = Queue()
+        assert noSeqs >= 1
         procCounter = ProcCounter(noSeqs, stream=stream)
-        threads = min(threads, totalTasks)
+        threads = affordableWorkers(min(threads, noSeqs), pendingAnnot, stream=stream)
         # Initialize workers
-        workers = []
         for i in range(threads):
             w = RefineWorker(procCounter, chain, actualQstart, fr4cut,
                              trim5End, trim3End, refineFlagNames, stream=stream)
+            w.cloneAnnot = pendingAnnot
+            w.seqStore = seqStore
+            w.weights = weights
             w.tasksQueue = tasks
             w.exitQueue = exitQueue
             w.resultsQueue = resultsQueue
             workers.append(w)
             w.start()
             sys.stdout.flush()
-            # adding jobs to the tasks queue with subsets of query IDs
-        assert (totalTasks >= 1)
-        for i in range(totalTasks):
-            ids = queryIds[i * seqsPerFile:(i + 1) * seqsPerFile]
-            recs = map(lambda x: records[x], ids)
-            qsRecs = map(lambda x: cloneAnnot.loc[x].to_dict(), ids)
-            tasks.put((recs, qsRecs))
+        # row ranges of the clones are handed out as workers become idle, workers fetch the rows themselves. The
+        # results are collated as they arrive
+        collator = ChunkScheduler(noSeqs, threads, maxChunkSize=seqsPerFile, stream=stream) \
+            .run(tasks, resultsQueue, ChunkCollator(noSeqs, stream=stream), sizeOf=lambda result: len(result[0]))
         # Add a poison pill for each worker
         for i in range(threads + 10):
             tasks.put(None)
@@ -115,11 +128,16 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
         sys.stdout.flush()
 
         # invoking the result collection method
-        cloneAnnotList, transSeqs, flags, frameworkLengths = collectRefineResults(resultsQueue, totalTasks,
-                                                                                  noSeqs, refineFlagNames,
-                                                                                  stream=stream)
+        cloneAnnotList, transSeqs, flags, frameworkLengths = collectRefineResults(collator, refineFlagNames)
         printto(stream, "\tResults were collated successfully.")
 
+        if representatives is not None:
+            # the refinement of a clone is shared with its identical clones
+            cloneAnnotList = expandRepresentativeRows(cloneAnnotList, representatives)
+            transSeqs = expandRepresentativeRows(transSeqs, representatives)
+            for f in refineFlagNames:
+                flags[f] = expandRepresentativeIDs(flags[f], representatives)
+
         # mark each clone as filtered=yes if its framework len is not the most common among the same V/J germline gene
         printto(stream, "Filtering clones according to framework lengths ... ")
         # display the tallies of all frameworks based on V/J germline gene to log file
@@ -138,33 +156,32 @@ def refineClonesAnnotation(outDir, sampleName, cloneAnnotOriginal, readFile, for
                         "and 4 lengths".format(filtered / cloneAnnot.shape[0], filtered, cloneAnnot.shape[0]))
 
         # print refine flags
-        printRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, stream=stream)
+        printRefineFlags(flags, seqStore, refineFlagNames, refineFlagMsgs, stream=stream)
         printto(stream, "Flagged sequences are being written to an output file ... ")
-        writeRefineFlags(flags, records, refineFlagNames, refineFlagMsgs,
+        writeRefineFlags(flags, seqStore, refineFlagNames, refineFlagMsgs,
                          outDir, sampleName)
     except Exception as e:
         printto(stream, "Something went wrong during the refinement process!", LEVEL.EXCEPT)
         raise e
     finally:
-        if workers:
-            for w in workers:
-                w.terminate()
-        if records:
-            records.close()
+        stopWorkers(workers, tasks, resultsQueue)
 
     # Create new data frame of clone annotation
     # add new column for filtering based on FR region
     newColumns = getAnnotationFields(chain) + ['filtered']
     cloneAnnot = DataFrame(cloneAnnotList, columns=newColumns)
     cloneAnnot.set_index('queryid', inplace=True, drop=True)
+    del cloneAnnotList
+    compactCloneAnnot(cloneAnnot)
     gc.collect()
 
     # Create data frame of FR and CDR sequences
     cols = ['queryid', 'germline', 'fr1', 'cdr1', 'fr2', 'cdr2', 'fr3', 'cdr3', 'fr4']
-    cloneSeqs = DataFrame(transSeqs, columns=cols)
-    for col in cols:
-        cloneSeqs.loc[:, col] = cloneSeqs[col].map(str)
+    cloneSeqs = DataFrame(OrderedDict((col, internStrings([str(seq[i]) if i < len(seq) else str(None)
+                                                            for seq in transSeqs]))
+                                      for i, col in enumerate(cols)), columns=cols)
     cloneSeqs.set_index('queryid', inplace=True, drop=True)
+    compactCloneSeqs(cloneSeqs)
 
     return cloneAnnot, cloneSeqs
 
@@ -183,8 +200,12 @@ def markClones(clone, frameworkLengths, annotationFields):
     return id_
 
 
-def collectRefineResults(resultsQueue, totalTasks, noSeqs, refineFlagNames, stream=None):
-    total = 0
+def collectRefineResults(collator, refineFlagNames):
+    """
+    :param collator: ChunkCollator holding the results of every refined chunk
+    :param refineFlagNames: list of refinement flag names
+    :return: (cloneAnnot rows, transSeqs rows, flags, frameworkLengths) tuple, rows are in read order
+    """
     cloneAnnot = []
     transSeqs = []
     frameworkLengths = defaultdict(_defaultCounter)
@@ -193,14 +214,8 @@ def collectRefineResults(resultsQueue, totalTasks, noSeqs, refineFlagNames, stre
     for f in refineFlagNames:
         flags[f] = []
 
-    while totalTasks:
-        result = resultsQueue.get()
-        totalTasks -= 1
-        if result is None:
-            continue
-
-        qsRecsOrdered, seqs, flagsi, recordLengths = result
-
+    # chunks are visited in read order, no matter which worker refined them first
+    for qsRecsOrdered, seqs, flagsi, recordLengths in collator.payloads():
         # convert dict to Counter object
         for keys, regions in recordLengths.items():
             for region in regions:
@@ -210,19 +225,14 @@ def collectRefineResults(resultsQueue, totalTasks, noSeqs, refineFlagNames, stre
         cloneAnnot += qsRecsOrdered
         transSeqs += seqs
 
-        # update flags 
+        # update flags
         for f in refineFlagNames:
             flags[f] += flagsi[f]
-        total += len(qsRecsOrdered)
-
-        if total % 50000 == 0:
-            printto(stream, '\t{}/{} records have been collected ... '.format(total, noSeqs))
 
-    printto(stream, '\t{}/{} records have been collected ... '.format(total, noSeqs))
     return cloneAnnot, transSeqs, flags, frameworkLengths
 
 
-def printRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, stream=None):
+def printRefineFlags(flags, seqStore, refineFlagNames, refineFlagMsgs, stream=None):
     # print statistics and a few of the flagged clones
     for f in refineFlagNames:
         if len(flags[f]) > 0:
@@ -230,13 +240,13 @@ def printRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, stream=Non
             examples = random.choice(range(len(flags[f])), min(3, len(flags[f])), replace=False)
             for i in examples:
                 printto(stream, ">" + flags[f][i], LEVEL.INFO)
-                printto(stream, str(records[flags[f][i]].seq), LEVEL.INFO)
+                printto(stream, seqStore.seq(flags[f][i]), LEVEL.INFO)
 
 
-def writeRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, outDir, sampleName):
-    # 8gb buffer size if system has large enough memory (-1 implies system buffer size)
+def writeRefineFlags(flags, seqStore, refineFlagNames, refineFlagMsgs, outDir, sampleName):
+    # 8mb buffer size if the memory budget is large enough (-1 implies system buffer size)
     with open(os.path.join(outDir, sampleName + "_refinement_flagged.txt"), 'w',
-              buffering=int(1 << 23) if hasLargeMem() else -1) as flaggedFp, \
+              buffering=ioBufferSize()) as flaggedFp, \
             open(os.path.join(outDir, sampleName + "_refinement_flagged_summary.txt"), "w") as summaryFp:
         for f in refineFlagNames:
             if len(flags[f]) > 0:
@@ -244,10 +254,28 @@ def writeRefineFlags(flags, records, refineFlagNames, refineFlagMsgs, outDir, sa
                 flaggedFp.write("# " + refineFlagMsgs[f].format(len(flags[f])) + "\n")
                 for i in range(len(flags[f])):
                     flaggedFp.write(">" + flags[f][i] + "\n")
-                    flaggedFp.write(str(records[flags[f][i]].seq) + "\n")
+                    flaggedFp.write(seqStore.seq(flags[f][i]) + "\n")
                 flaggedFp.write("\n")
 
 
+def affordableWorkers(threads, cloneAnnot, stream=None):
+    """
+    every worker holds its own copy of the clones' annotation, only start as many of them as the memory budget
+    allows
+
+    :param threads: int. number of workers requested
+    :param cloneAnnot: dataframe handed to every worker
+    :param stream: logging stream
+    :return: int. number of workers to start, between 1 and threads
+    """
+    threads = max(1, threads)
+    affordable = workersWithinBudget(threads, int(cloneAnnot.memory_usage(deep=True).sum()))
+    if affordable < threads:
+        printto(stream, "\tThe memory budget allows {} of the {} requested workers".format(affordable, threads),
+                LEVEL.WARN)
+    return affordable
+
+
 class ProcCounter(object):
     def __init__(self, noSeqs, initval=0, desc="records", stream=None):
         self.val = Value('i', initval)
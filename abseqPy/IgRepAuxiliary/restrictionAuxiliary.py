@@ -10,14 +10,21 @@ import re
 from collections import defaultdict, Counter
 
 from numpy import isnan, nan
-from multiprocessing import Queue, Manager
-from math import ceil
+from multiprocessing import Queue
+from pandas import Categorical
 from pandas.core.frame import DataFrame
 
-from abseqPy.IgRepAuxiliary.seqUtils import readSeqFileIntoDict
 from abseqPy.IgRepAuxiliary.RestrictionSitesScanner import RestrictionSitesScanner
 from abseqPy.IgRepAuxiliary.productivityAuxiliary import ProcCounter
+from abseqPy.IgRepAuxiliary.ChunkCollator import ChunkCollator
+from abseqPy.IgRepAuxiliary.ChunkScheduler import ChunkScheduler
 from abseqPy.logger import printto, LEVEL
+from abseqPy.utilities import stopWorkers
+
+# cloneAnnot columns the scanners need: the coordinates of the sequence, and of its regions in the detailed RSA
+RSA_COLUMNS = ['vqstart', 'vstart', 'fr4.end']
+RSA_REGION_COLUMNS = ['fr1.start', 'fr1.end', 'cdr1.start', 'cdr1.end', 'fr2.start', 'fr2.end', 'cdr2.start',
+                      'cdr2.end', 'fr3.start', 'fr3.end', 'cdr3.start', 'cdr3.end', 'fr4.start']
 
 
 def initRSAStats(simple):
@@ -68,13 +75,13 @@ def calcRSAOverlapOrder2(order1, sites, stream=None):
     return overlap
 
 
-def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=True, stream=None):
+def scanRestrictionSites(name, seqStore, cloneAnnot, sitesFile, threads, simple=True, stream=None):
     """
     :param name: string
             analysis name
 
-    :param readFile: string
-            raw FASTQ/FASTA file
+    :param seqStore: SeqStore
+            sequence store of the raw FASTQ/FASTA file
 
     :param cloneAnnot: dataframe
             IgRepertoire.cloneAnnot dataframe, depending on what the argument to 'simple' is, will require at least
@@ -113,39 +120,34 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
     )
     """
     sitesInfo = loadRestrictionSites(sitesFile, stream=stream)
-    seqsPerWorker = len(sitesInfo)
     workers = []
+    tasks = Queue()
+    exitQueue = Queue()
+    resultsQueue = Queue()
     try:
-        m = Manager()
-        records = m.dict()
-        readSeqFileIntoDict(readFile, records, stream=stream)
-        queryIds = cloneAnnot.index
-        noSeqs = len(queryIds)
+        # the scanners share the sequence store and a few numpy arrays of coordinates (read-only, never copied by
+        # the workers), rather than a copy of cloneAnnot each. Tasks are row ranges of these arrays
+        positions, coords, vgenes = _rsaAnnotation(seqStore, cloneAnnot, simple)
+        noSeqs = len(positions)
         printto(stream, "{:,} restriction sites are being scanned for {:,} sequences ..."
                 .format(len(sitesInfo), noSeqs))
-        totalTasks = int(ceil(noSeqs / seqsPerWorker))
-        tasks = Queue()
-        exitQueue = Queue()
-        resultsQueue = Queue()
         procCounter = ProcCounter(noSeqs, desc="sequences", stream=stream)
-        threads = min(threads, totalTasks)
+        threads = max(1, min(threads, noSeqs))
 
         # Initialize workers
         for _ in range(threads):
-            # pass in a minified cloneAnnot, the bare minimum of what's required in the runSimple() / runDetailed()
-            # method
-            w = RestrictionSitesScanner(records, cloneAnnot, procCounter,
-                                        sitesInfo.copy(), simpleScan=simple, stream=stream)
+            w = RestrictionSitesScanner(seqStore, positions, coords, procCounter, sitesInfo.copy(), vgenes=vgenes,
+                                        simpleScan=simple, stream=stream)
             w.tasksQueue = tasks
             w.exitQueue = exitQueue
             w.resultsQueue = resultsQueue
             workers.append(w)
             w.start()
 
-        assert totalTasks > 0
-
-        for i in range(totalTasks):
-            tasks.put(queryIds[i * seqsPerWorker:(i + 1) * seqsPerWorker])
+        # chunks are handed out as workers become idle, and collated in read order
+        collator = ChunkScheduler(noSeqs, threads, stream=stream) \
+            .run(tasks, resultsQueue, ChunkCollator(noSeqs, desc="sequences", stream=stream),
+                 sizeOf=lambda statsi: statsi["total"])
 
         # Add a poison pill for each worker
         for _ in range(threads + 10):
@@ -159,7 +161,7 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
         # Collect results
         printto(stream, "All workers have completed their tasks successfully.")
         printto(stream, "Results are being collated from all workers ...")
-        stats = collectRSAResults(sitesInfo, resultsQueue, totalTasks, noSeqs, simple=simple, stream=stream)
+        stats = collectRSAResults(sitesInfo, collator, noSeqs, simple=simple)
         (rsaResults, overlapResults) = postProcessRSA(stats, sitesInfo, simple=simple, stream=stream)
         printto(stream, "Results were collated successfully.")
 
@@ -167,21 +169,36 @@ def scanRestrictionSites(name, readFile, cloneAnnot, sitesFile, threads, simple=
         printto(stream, "Something went wrong during the RSA scanning process, error: {}".format(str(e)), LEVEL.EXCEPT)
         raise e
     finally:
-        for w in workers:
-            w.terminate()
+        stopWorkers(workers, tasks, resultsQueue)
 
     return rsaResults, overlapResults
 
 
-def collectRSAResults(sitesInfo, resultsQueue, totalTasks, noSeqs, simple=True, stream=None):
+def _rsaAnnotation(seqStore, cloneAnnot, simple=True):
+    """
+    :param seqStore: SeqStore of the sample
+    :param cloneAnnot: dataframe of the clones to scan
+    :param simple: bool. simple or detailed analysis
+    :return: (positions, coords, vgenes) tuple where positions is the numpy array of the positions of the clones in
+    seqStore, coords the dict of column name -> numpy float array of the RSA_COLUMNS of the clones (and
+    RSA_REGION_COLUMNS if simple is False), vgenes None, or if simple is False, the (codes, names) tuple of the V
+    germlines of the clones (a numpy array of codes in the list of names)
+    """
+    positions = seqStore.positions(cloneAnnot.index)
+    columns = RSA_COLUMNS + ([] if simple else RSA_REGION_COLUMNS)
+    coords = dict((col, cloneAnnot[col].values.astype(float)) for col in columns)
+    vgenes = None
+    if not simple:
+        germlines = Categorical(cloneAnnot['vgene'].astype(str))
+        vgenes = (germlines.codes, list(germlines.categories))
+    return positions, coords, vgenes
+
+
+def collectRSAResults(sitesInfo, collator, noSeqs, simple=True):
     stats = initRSAStats(simple=simple)
     total = 0
-    while totalTasks:
-        statsi = resultsQueue.get()
-        if statsi is None:
-            continue
-        totalTasks -= 1
-
+    # chunks are merged in read order, so that the recorded germline hits do not depend on worker scheduling
+    for statsi in collator.payloads():
         # -------- update relevant statistics -------  #
 
         # 1. total number of sequences that are cut by any sites at all (i.e. number of sequences that are cut by
@@ -214,10 +231,6 @@ def collectRSAResults(sitesInfo, resultsQueue, totalTasks, noSeqs, simple=True,
                 stats['siteHitsSeqsIGV'][site] = stats['siteHitsSeqsIGV'][site].union(statsi['siteHitsSeqsIGV'][site])
 
         total += statsi["total"]
-        if total % 50000 == 0:
-            printto(stream, '\t%d/%d records have been collected ... ' % (total, noSeqs))
-
-    printto(stream, '\t%d/%d sequences have been collected ... ' % (total, noSeqs))
 
     assert total == noSeqs
     stats["total"] = noSeqs
@@ -0,0 +1,274 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+
+import numpy as np
+
+from collections import OrderedDict
+from pandas import Categorical, DataFrame, HDFStore, Series
+
+try:
+    from pandas import CategoricalDtype
+except ImportError:
+    # pandas < 0.21 does not export it
+    from pandas.core.dtypes.dtypes import CategoricalDtype
+
+try:
+    from sys import intern
+except ImportError:
+    # python 2, intern is a builtin
+    pass
+
+# annotation columns that only take a handful of distinct strings: gene names, flags and primer names
+CATEGORICAL_FIELDS = frozenset(['vgene', 'dgene', 'jgene', 'chain', 'strand', 'stopcodon', 'v-jframe', 'filtered',
+                                '5endPrimer', '3endPrimer'])
+
+# float annotation columns that hold scores rather than positions or counts, they are left as float64
+SCORE_FIELDS = frozenset(['bitscore', 'identity'])
+
+# cloneSeqs columns that only take a handful of distinct strings
+SEQ_CATEGORICAL_FIELDS = frozenset(['germline'])
+
+# annotation columns the clones are filtered on (see IgRepertoire._cloneAnnotFilteredRows). They can be queried
+# in dataframes written by writeCloneFrame(..., queryable=True)
+FILTER_FIELDS = ('bitscore', 'alignlen', 'vstart', 'vqstart')
+
+# key suffix of the categories of the categorical columns of a dataframe written by writeCloneFrame
+CATEGORIES_SUFFIX = "Categories"
+
+
+def compactCloneAnnot(cloneAnnot):
+    """
+    converts the columns of a clone annotation dataframe to the compact schema, in place: gene names and flags
+    become categoricals, positions int32 and gap/mismatch counts int16. Numpy integers cannot hold NaN, so
+    positions and counts with missing values are float32 instead of float64 (every position or count a read can
+    have is exact in float32). Columns that are already compact are left untouched
+
+    :param cloneAnnot: dataframe, as produced by annotation, refinement or primer specificity analysis
+    :return: cloneAnnot
+    """
+    for col in cloneAnnot.columns:
+        column = cloneAnnot[col]
+        compact = _compactColumn(col, column)
+        if compact is not column:
+            cloneAnnot[col] = compact
+    return cloneAnnot
+
+
+def compactCloneSeqs(cloneSeqs):
+    """
+    converts the columns of a clone sequences dataframe to the compact schema, in place: the germline becomes
+    categorical and the protein sequences of the regions are interned, so that identical sequences (most FR4s, and
+    the regions of clones of the same clonotype) are held in memory only once
+
+    :param cloneSeqs: dataframe of [germline, fr1, cdr1, fr2, cdr2, fr3, cdr3, fr4] columns
+    :return: cloneSeqs
+    """
+    for col in cloneSeqs.columns:
+        column = cloneSeqs[col]
+        if col in SEQ_CATEGORICAL_FIELDS:
+            if not isinstance(column.dtype, CategoricalDtype):
+                cloneSeqs[col] = column.astype('category')
+        elif column.dtype == object:
+            cloneSeqs[col] = internStrings(column.values)
+    return cloneSeqs
+
+
+def fillMissing(df, value):
+    """
+    fills the missing values of every column with value, in place. Categorical columns get value as an extra
+    category first (pandas refuses to fill categoricals with anything but one of their categories)
+
+    :param df: dataframe
+    :param value: fill value
+    :return: df
+    """
+    for col in df.columns:
+        column = df[col]
+        if isinstance(column.dtype, CategoricalDtype) and value not in column.cat.categories:
+            df[col] = column.cat.add_categories([value])
+    df.fillna(value, inplace=True)
+    return df
+
+
+def restoreMissing(df, value):
+    """
+    reverses fillMissing, in place: value is replaced by NaN and the columns are brought back to the compact schema
+
+    :param df: dataframe that went through fillMissing
+    :param value: fill value given to fillMissing
+    :return: df
+    """
+    df.replace(value, np.nan, inplace=True)
+    for col in df.columns:
+        column = df[col]
+        if isinstance(column.dtype, CategoricalDtype) and value in column.cat.categories:
+            df[col] = column.cat.remove_categories([value])
+    return compactCloneAnnot(df)
+
+
+def internStrings(values):
+    """
+    :param values: iterable of strings (other values are left as they are)
+    :return: numpy object array of the interned strings
+    """
+    interned = np.empty(len(values), dtype=object)
+    interned[:] = [intern(v) if type(v) is str else v for v in values]
+    return interned
+
+
+def writeCloneFrame(df, filename, key, complib=None, queryable=False):
+    """
+    writes a dataframe of the compact schema to HDF5. HDF5 cannot hold categoricals, they are written as their
+    integer codes, alongside their categories (under key + "Categories")
+
+    :param df: dataframe
+    :param filename: string. path to HDF5 file, it is overwritten. The file is written next to its destination
+    first, so that a run that is interrupted never leaves a partially written file behind
+    :param key: string. key of the dataframe in the file
+    :param complib: string. compression library, see pandas.HDFStore
+    :param queryable: bool. If True, the dataframe is written in table format with the FILTER_FIELDS as data
+    columns, so that readCloneFrame can select columns and filter rows on those fields without loading the whole
+    dataframe. Otherwise, the (faster to read and write in full) fixed format is used
+    :return: None
+    """
+    categorical = [col for col in df.columns if isinstance(df[col].dtype, CategoricalDtype)]
+    if categorical:
+        encoded = DataFrame(OrderedDict((col, df[col].cat.codes if col in categorical else df[col])
+                                        for col in df.columns), index=df.index)
+        # one (column name, category) entry per category, empty categoricals get a single NaN entry
+        names, values = [], []
+        for col in categorical:
+            categories = list(df[col].cat.categories) or [np.nan]
+            names.extend([col] * len(categories))
+            values.extend(categories)
+        categories = Series(values, index=names, dtype=object)
+    else:
+        encoded, categories = df, None
+    tmpFile = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with HDFStore(tmpFile, mode='w', complib=complib) as store:
+            # pandas does not write empty tables
+            if queryable and len(encoded):
+                store.put(key, encoded, format='table', index=False,
+                          data_columns=[col for col in FILTER_FIELDS if col in encoded.columns])
+            else:
+                store.put(key, encoded)
+            if categories is not None:
+                store.put(key + CATEGORIES_SUFFIX, categories)
+        os.rename(tmpFile, filename)
+    finally:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+
+def readCloneFrame(filename, key, columns=None, ranges=None):
+    """
+    reads a dataframe written by writeCloneFrame (or by DataFrame.to_hdf). If the dataframe was written as
+    queryable, only the requested columns are read and the ranges of the FILTER_FIELDS are applied by the HDF5
+    query, rows that are out of range are never loaded. Otherwise, the whole dataframe is read and then
+    projected and filtered
+
+    :param filename: string. path to HDF5 file
+    :param key: string. key of the dataframe in the file
+    :param columns: list of column names to read. Defaults to all the columns
+    :param ranges: dict of column name -> (min, max) tuple. Only rows whose values lie within [min, max] in all
+    of these columns are read. Infinite bounds are ignored
+    :return: dataframe, with its categorical columns restored, in the order of the rows in the file
+    """
+    ranges = ranges or {}
+    with HDFStore(filename, mode='r') as store:
+        storer = store.get_storer(key)
+        if storer.is_table:
+            queryable = set(storer.data_columns)
+            where = [term for col, bounds in ranges.items() if col in queryable for term in _rangeTerms(col, bounds)]
+            ranges = dict((col, bounds) for col, bounds in ranges.items() if col not in queryable)
+            # columns that still have to be filtered in memory must be read too
+            wanted = None if columns is None else list(OrderedDict.fromkeys(list(columns) + list(ranges)))
+            df = store.select(key, where=(where or None), columns=wanted)
+        else:
+            df = store[key]
+        if (key + CATEGORIES_SUFFIX) in store:
+            categories = store[key + CATEGORIES_SUFFIX]
+            for col in OrderedDict.fromkeys(categories.index):
+                if col in df.columns:
+                    values = categories[categories.index == col]
+                    df[col] = Categorical.from_codes(df[col].values, values.dropna().values)
+    if ranges:
+        selected = np.ones(len(df), dtype=bool)
+        for col, (low, high) in ranges.items():
+            selected &= ((df[col] >= low) & (df[col] <= high)).values
+        df = df[selected]
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def countCloneFrame(filename, key):
+    """
+    :param filename: string. path to HDF5 file
+    :param key: string. key of the dataframe in the file
+    :return: int. number of rows of the dataframe, without reading it if it was written as queryable
+    """
+    with HDFStore(filename, mode='r') as store:
+        storer = store.get_storer(key)
+        return int(storer.nrows) if storer.is_table else len(store[key])
+
+
+def _rangeTerms(col, bounds):
+    """
+    :param col: column name
+    :param bounds: (min, max) tuple
+    :return: list of HDF5 query terms selecting min <= col <= max. Infinite bounds yield no term
+    """
+    low, high = bounds
+    terms = []
+    if not np.isinf(low):
+        terms.append("{} >= {!r}".format(col, float(low)))
+    if not np.isinf(high):
+        terms.append("{} <= {!r}".format(col, float(high)))
+    return terms
+
+
+def _compactColumn(name, column):
+    """
+    :param name: column name
+    :param column: Series
+    :return: the compact version of column, or column itself if it is already compact or cannot be made compact
+    """
+    dtype = column.dtype
+    if isinstance(dtype, CategoricalDtype):
+        return column
+    if dtype == object:
+        return column.astype('category') if name in CATEGORICAL_FIELDS else column
+    if dtype.kind in 'iu':
+        targets = (np.int16, np.int32) if _isCount(name) else (np.int32,)
+        if len(column):
+            low, high = column.min(), column.max()
+        else:
+            low = high = 0
+        for target in targets:
+            if dtype == target:
+                return column
+            info = np.iinfo(target)
+            if info.min <= low and high <= info.max:
+                return column.astype(target)
+        return column
+    if dtype.kind == 'f' and dtype != np.float32 and name not in SCORE_FIELDS:
+        values = column.values
+        compact = values.astype(np.float32)
+        # only whole numbers (and NaNs) are guaranteed to survive the trip to float32 unchanged
+        with np.errstate(invalid='ignore'):
+            exact = ((compact == values) | np.isnan(values)).all()
+        return Series(compact, index=column.index, name=column.name) if exact else column
+    return column
+
+
+def _isCount(name):
+    return name.endswith('gaps') or name.endswith('mismatches')
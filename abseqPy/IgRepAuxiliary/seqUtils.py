@@ -25,7 +25,7 @@ from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import Alphabet
 from Bio import Alphabet
 
-from abseqPy.IgRepertoire.igRepUtils import alignListOfSeqs, safeOpen, detectFileFormat
+from abseqPy.IgRepertoire.igRepUtils import alignListOfSeqs
 from abseqPy.config import WEBLOGO
 from abseqPy.logger import printto, LEVEL
 from abseqPy.utilities import ShortOpts, requires, quote
@@ -42,17 +42,6 @@ from abseqPy.utilities import ShortOpts, requires, quote
 # from TAMO.MotifTools import Motif
 
 
-def readSeqFileIntoDict(seqFile, outDict=None, stream=None):
-    printto(stream, "Processing {} ... loading sequences into dictionary".format(os.path.basename(seqFile)))
-    format = detectFileFormat(seqFile)
-    if outDict is None:
-        outDict = {}
-    with safeOpen(seqFile) as fp:
-        for rec in SeqIO.parse(fp, format):
-            outDict[rec.id] = str(rec.seq)
-    return outDict
-
-
 def generateMotif(sequences, name, alphabet, filename, 
                   align=False, transSeq=False, protein=False, weights=None, outDir=None,
                   threads=2, stream=None):
@@ -13,7 +13,7 @@ from Bio import SeqIO
 from collections import defaultdict
 
 from abseqPy.IgRepReporting.igRepPlots import plotSeqLenDist, plotSeqLenDistClasses, plotDist
-from abseqPy.IgRepertoire.igRepUtils import gunzip, compressCountsFamilyLevel, \
+from abseqPy.IgRepertoire.igRepUtils import compressCountsFamilyLevel, \
     compressCountsGeneLevel, safeOpen, compressSeqGeneLevel, compressSeqFamilyLevel
 from abseqPy.logger import LEVEL, printto
 from abseqPy.utilities import requires
@@ -72,14 +72,14 @@ def plotUpstreamLenDist(upstreamFile, expectLength, name, outDir, stream=None):
         plotSeqLenDistClasses(upstreamFile, name, outputFile, fileExt, expectLength - 1, stream=stream)
 
 
-def extractUpstreamSeqs(cloneAnnot, recordFile, upstream, upstreamFile, stream=None):
+def extractUpstreamSeqs(cloneAnnot, seqStore, upstream, upstreamFile, stream=None):
     """
     extract the upstream DNA sequences and write them into a FASTA file named upstreamFile
     :param cloneAnnot:
                 cloneAnnot DataFrame
 
-    :param recordFile:
-                raw record file (string)
+    :param seqStore:
+                SeqStore object holding the raw sequences
 
     :param upstream:
                 list of 2 numbers, denoting [start, end] inclusive in 1-index. np.Inf is also allowed for end value
@@ -115,13 +115,8 @@ def extractUpstreamSeqs(cloneAnnot, recordFile, upstream, upstreamFile, stream=N
     expectLength = upstream[1] - upstream[0] + 1
     queryIds = cloneAnnot.index
 
-    # NOTE: SeqIO.index can only index string filenames and it has to be unzipped
-    _, ext = os.path.splitext(os.path.basename(recordFile.rstrip(os.path.sep)))
-    records = SeqIO.index(gunzip(recordFile), ext.lstrip('.'))
-
     with open(upstreamFile, 'w') as fp:
-        for id_ in queryIds:
-            record = records[id_]
+        for record in seqStore.records(queryIds):
             qsRec = cloneAnnot.loc[record.id]
             if qsRec.strand != 'forward':
                 revAlign += 1
@@ -231,9 +226,7 @@ def collectUpstreamSeqs(upstreamFile, sampleName, expectLength, outResDir, outAu
 
     ignoredSeqs = 0
 
-    records = SeqIO.index(gunzip(upstreamFile), 'fasta')
-    for id_ in records:
-        rec = records[id_]
+    for rec in _iterFasta(upstreamFile):
         ighv = rec.id.split(_UPSTREAM_SEQ_FILE_SEP)[1]
         seq = rec.seq
         if expectLength[0] <= len(rec) <= expectLength[1]:
@@ -465,6 +458,12 @@ def writeCountsCategoriesToFile(countsVariant, sampleName, filePrefix, title='')
     plotDist(countsVariant, sampleName, filePrefix + 'family.csv', title)
 
 
+def _iterFasta(filename):
+    with safeOpen(filename) as fp:
+        for rec in SeqIO.parse(fp, 'fasta'):
+            yield rec
+
+
 def _loadIGVSeqsFromFasta(filename):
     ighvSeqs = defaultdict(list)
     with safeOpen(filename) as fp:
@@ -10,5 +10,6 @@ __all__ = [
     'diversityReport',
     'igRepPlots',
     'productivityReport',
-    'restrictionReport'
+    'restrictionReport',
+    'runReport'
 ]
@@ -17,7 +17,11 @@ from abseqPy.IgRepReporting.igRepPlots import plotSeqLenDist, \
     generateCumulativeLogo, plotSeqDuplication, plotSeqRarefaction, \
     plotSeqRecaptureNew
 from abseqPy.logger import LEVEL, printto
-from abseqPy.utilities import hasLargeMem, requires
+from abseqPy.utilities import fitsInMemory, workersWithinBudget, requires
+from abseqPy.instrumentation import StageTimer
+
+# share of the memory budget that sequences buffered for asynchronous plotting may take
+BUFFER_FRACTION = 0.25
 
 
 def generateDiversityReport(spectraTypes, clonoTypes, name, outDir, topClonotypes, threads=2, segregate=False,
@@ -73,8 +77,9 @@ def generateSpectraTypePlots(spectraTypes, name, outDir, stream=None):
 
 def estimateDiversity(clonoTypes, flatClonoTypes, name, outDir, threads=2, segregate=False, stream=None):
     # create Germline gene level composition logos
-    compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=threads, detailed=segregate, stream=stream)
-    generateSeqMotifs(flatClonoTypes, name, outDir, threads=threads, stream=stream)
+    with StageTimer('logos'):
+        compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=threads, detailed=segregate, stream=stream)
+        generateSeqMotifs(flatClonoTypes, name, outDir, threads=threads, stream=stream)
     generateRarefactionPlots(flatClonoTypes, name, outDir, threads=threads, stream=stream)
     printto(stream, "The diversity of the library is being estimated ... ")
 
@@ -214,6 +219,7 @@ def compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=2, detail
     printto(stream, "Generating composition logos ...")
     if detailed:
         argBuffer = []
+        buffered, largest = 0, 0
         for vgerm in clonoTypes:
             regions = clonoTypes[vgerm].keys()
             regions.sort()
@@ -228,16 +234,18 @@ def compositionLogos(name, clonoTypes, flatClonoTypes, outDir, threads=2, detail
                 createIfNot(regionDirectory)
                 filename = os.path.join(regionDirectory, name + "_{}_cumulative_logo.csv"
                                         .format(vgerm.replace(os.path.sep, '_')))
-                if hasLargeMem():
+                size = _bufferedSize(seqs)
+                if fitsInMemory(buffered + size, fraction=BUFFER_FRACTION):
                     printto(stream, "\tbuffering {} for {}".format(region, vgerm))
                     argBuffer.append((seqs, weights, region, filename))
+                    buffered, largest = buffered + size, max(largest, size)
                 else:
                     printto(stream, "\tgenerating {} for {}".format(region, vgerm))
                     generateCumulativeLogo(seqs, weights, region, filename, stream=stream)
 
         if len(argBuffer):
             printto(stream, "Asynchronously generating composition logos from buffer ...")
-            pool = multiprocessing.Pool(processes=threads)
+            pool = multiprocessing.Pool(processes=workersWithinBudget(threads, largest))
             # Generate cumulative sequence logos using Toby's approach
             res = [pool.apply_async(generateCumulativeLogo, args=arg) for arg in argBuffer]
             [p.get() for p in res]  # join processes
@@ -297,6 +305,7 @@ def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
     regions = flatClonoTypes.keys()
     regions.sort()
     argBuffer = []
+    buffered, largest = 0, 0
     for region in regions:
         if region == 'v':
             continue
@@ -304,12 +313,17 @@ def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
         clonoType = flatClonoTypes[region]
         seqs = clonoType.keys()
         weights = clonoType.values()
+        # the aligned and unaligned motifs of a region are either both buffered or both generated right away
+        size = _bufferedSize(seqs)
+        buffering = fitsInMemory(buffered + size, fraction=BUFFER_FRACTION)
+        if buffering:
+            buffered, largest = buffered + size, max(largest, size)
 
         # Generate sequence motif logos using weblogo
         # generate logos without alignment
         filename = os.path.join(motifsFolder, name + ("_{}_motif_logo.png".format(region)))
         alphabet = createAlphabet(align=False, protein=True, extendAlphabet=True)
-        if hasLargeMem():
+        if buffering:
             printto(stream, "\tbuffering data for {} motif".format(region))
             argBuffer.append((seqs, region, alphabet, filename, False, False, True, weights, outDir, threads))
         else:
@@ -320,7 +334,7 @@ def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
         # generate  logos after alignment
         filename = os.path.join(motifsFolder, name + ("_{}_motif_aligned_logo.png".format(region)))
         alphabet = createAlphabet(align=True, protein=True, extendAlphabet=True)
-        if hasLargeMem():
+        if buffering:
             argBuffer.append((seqs, region, alphabet, filename, True, False, True, weights, outDir, threads))
         else:
             generateMotif(seqs, region, alphabet, filename,  align=True,
@@ -328,7 +342,7 @@ def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
 
     if len(argBuffer):
         printto(stream, "Asynchronously generating motifs from buffer ...")
-        pool = multiprocessing.Pool(processes=threads)
+        pool = multiprocessing.Pool(processes=workersWithinBudget(threads, largest))
         res = [pool.apply_async(generateMotif, args=arg) for arg in argBuffer]
         [p.get() for p in res]
         pool.close()
@@ -337,6 +351,14 @@ def generateSeqMotifs(flatClonoTypes, name, outDir, threads=2, stream=None):
     printto(stream, "CDR/FR Motif analysis complete")
 
 
+def _bufferedSize(seqs):
+    """
+    :param seqs: list of sequences
+    :return: int. rough estimate (in bytes) of the memory taken by a buffered copy of the sequences and their weights
+    """
+    return sum(len(seq) for seq in seqs) + 128 * len(seqs)
+
+
 def writeClonotypeDiversityRegionAnalysis(clonoTypes, sampleName, outDir, stream=None):
     """
     For a given set of similar CDR3 clonotypes, it may be classified as a different clonotype if the entire V region
@@ -85,11 +85,11 @@ def plotSeqLenDist(counts, sampleName, outputFile, fileFormat='fasta',
     printto(stream, "\tThe sequence length distribution is being calculated for " + sampleName)
 
     if isinstance(counts, str):
-        with abseqPy.IgRepertoire.igRepUtils.safeOpen(counts) as fp:
-            sizes = [len(rec) for rec in SeqIO.parse(fp, fileFormat) if len(rec) <= maxLen]
-        if len(sizes) == 0:
+        _, count = abseqPy.IgRepertoire.igRepUtils.scanSeqFile(counts, fileFormat)
+        for size in [size for size in count if size > maxLen]:
+            del count[size]
+        if len(count) == 0:
             return
-        count = Counter(sizes)
         sizes = count.keys()
         weights = count.values()
     elif isinstance(counts, list):
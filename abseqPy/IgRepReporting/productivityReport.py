@@ -10,16 +10,16 @@ import pandas as pd
 import os
 
 from collections import Counter, OrderedDict
-from numpy import nan
 
 from abseqPy.IgRepReporting.igRepPlots import plotDist
 from abseqPy.IgRepertoire.igRepUtils import compressCountsFamilyLevel
+from abseqPy.IgRepAuxiliary.schemaAuxiliary import fillMissing, restoreMissing
 
 
 def generateProductivityReport(cloneAnnot, cloneSeqs, name, chain, outputDir, stream=None):
     # since np.nan is considered different objects, canonicalize them using 'NaN' string representation
     nanString = 'NaN'
-    cloneAnnot.fillna(nanString, inplace=True)
+    fillMissing(cloneAnnot, nanString)
 
     productive = extractProductiveClones(cloneAnnot, name, outputDir, stream=stream)
     productiveFamilyDist = compressCountsFamilyLevel(Counter(productive['vgene'].tolist()))
@@ -35,7 +35,7 @@ def generateProductivityReport(cloneAnnot, cloneSeqs, name, chain, outputDir, st
     writeStopCodonStats(cloneAnnot, cloneSeqs, name, outputDir, inframe=False, stream=stream)
 
     # now that counting is complete, replace all 'NaN' strings with np.nan again
-    cloneAnnot.replace(nanString, nan, inplace=True)
+    restoreMissing(cloneAnnot, nanString)
 
 
 def writeProdStats(cloneAnnot, sampleName, outdir):
@@ -0,0 +1,125 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+import csv
+import json
+import time
+
+from collections import OrderedDict
+
+from abseqPy.logger import printto
+
+# columns of the run report, in order
+REPORT_FIELDS = ['stage', 'worker', 'calls', 'start', 'wallTime', 'cpuTime', 'childCpuTime', 'records',
+                 'recordsPerSecond', 'peakRss', 'bytesRead', 'bytesWritten', 'queueDepth', 'cacheHits', 'cacheMisses',
+                 'cacheHitRate', 'failed']
+
+
+def writeRunReport(records, name, outDir, stream=None):
+    """
+    writes the run report of a sample, <name>_run_report.json and <name>_run_report.csv in outDir, from the
+    records of its StageTimers (see instrumentation.py). The report has a row per stage, summed over its workers,
+    followed by a row per worker of every stage (the CSV tells them apart by their worker column, "all" for the
+    stage rows). Stages are in the order they started, start is in seconds since the start of the run.
+
+    Stages nest: the tasks of the sample (e.g. annotateClones) contain the stages they run (e.g. split, igblast
+    and parse), and diversity contains logos
+
+    :param records: list of StageTimer records
+    :param name: string. sample name
+    :param outDir: string. output directory
+    :param stream: logging stream
+    :return: string. path to the JSON report, None if there were no records
+    """
+    if not records:
+        return None
+    started = min(rec['start'] for rec in records)
+    stages = _summarize(records, lambda rec: rec['stage'], started)
+    workers = _summarize(records, lambda rec: (rec['stage'], rec['worker']), started)
+    for row in stages:
+        row['worker'] = 'all'
+
+    jsonFile = os.path.join(outDir, name + "_run_report.json")
+    with open(jsonFile, 'w') as fp:
+        json.dump(OrderedDict([
+            ('sample', name),
+            ('started', time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))),
+            ('wallTime', _seconds(max(rec['start'] + rec['wallTime'] for rec in records) - started)),
+            ('stages', stages),
+            ('workers', workers)
+        ]), fp, indent=1)
+
+    csvFile = os.path.join(outDir, name + "_run_report.csv")
+    with open(csvFile, 'w') as fp:
+        writer = csv.DictWriter(fp, fieldnames=REPORT_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        for row in stages + workers:
+            writer.writerow(dict((k, '' if v is None else v) for k, v in row.items()))
+
+    printto(stream, "The run report has been written to " + os.path.basename(jsonFile))
+    return jsonFile
+
+
+def _summarize(records, keyOf, started):
+    """
+    :param records: list of StageTimer records
+    :param keyOf: callable that returns the group of a record
+    :param started: float. start of the run (epoch seconds)
+    :return: list of the summaries (OrderedDicts of REPORT_FIELDS) of the groups of records, in the order the
+    groups started. The wall time of a group spans its records, CPU times, records, bytes and cache lookups are
+    summed, peak RSS and queue depth are the largest of its records
+    """
+    groups = OrderedDict()
+    for rec in sorted(records, key=lambda r: r['start']):
+        groups.setdefault(keyOf(rec), []).append(rec)
+    rows = []
+    for recs in groups.values():
+        start = min(r['start'] for r in recs)
+        wall = max(r['start'] + r['wallTime'] for r in recs) - start
+        counted = [r['records'] for r in recs if r['records'] is not None]
+        noRecords = sum(counted) if counted else None
+        hits, misses = _total(r.get('cacheHits') for r in recs), _total(r.get('cacheMisses') for r in recs)
+        lookups = (hits or 0) + (misses or 0)
+        row = OrderedDict.fromkeys(REPORT_FIELDS)
+        row.update([
+            ('stage', recs[0]['stage']),
+            ('worker', recs[0]['worker']),
+            ('calls', len(recs)),
+            ('start', _seconds(start - started)),
+            ('wallTime', _seconds(wall)),
+            ('cpuTime', _seconds(sum(r['cpuTime'] for r in recs))),
+            ('childCpuTime', _seconds(sum(r['childCpuTime'] for r in recs))),
+            ('records', noRecords),
+            ('recordsPerSecond', round(noRecords / wall, 1) if noRecords is not None and wall > 0 else None),
+            ('peakRss', _largest(r['peakRss'] for r in recs)),
+            ('bytesRead', sum(r['bytesRead'] for r in recs)),
+            ('bytesWritten', sum(r['bytesWritten'] for r in recs)),
+            ('queueDepth', _largest(r['queueDepth'] for r in recs)),
+            ('cacheHits', hits),
+            ('cacheMisses', misses),
+            ('cacheHitRate', round(hits / lookups, 3) if lookups else None),
+            ('failed', any(r['failed'] for r in recs))
+        ])
+        rows.append(row)
+    return rows
+
+
+def _seconds(value):
+    # milliseconds are as precise as the clocks get
+    return round(value, 3)
+
+
+def _total(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _largest(values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
@@ -7,28 +7,35 @@
 from __future__ import division
 import gc
 import os
+import re
 import logging
 import sys
 import inspect
+import functools
 
-from collections import Counter, defaultdict
-from Bio import SeqIO
 from pandas.io.parsers import read_csv
 from pandas.io.pytables import read_hdf
 from numpy import Inf, logical_not
 
 from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker
+from abseqPy.IgMultiRepertoire.TaskGraph import TaskGraph
 from abseqPy.IgRepAuxiliary.upstreamAuxiliary import plotUpstreamLenDist, extractUpstreamSeqs, \
     findUpstreamMotifs
 from abseqPy.IgRepAuxiliary.primerAuxiliary import addPrimerData, generatePrimerPlots
 from abseqPy.config import FASTQC, AUX_FOLDER, HDF_FOLDER, DEFAULT_TASK, DEFAULT_MERGER, DEFAULT_TOP_CLONE_VALUE
-from abseqPy.IgRepertoire.igRepUtils import gunzip, fastq2fasta, mergeReads, \
-    writeListToFile, writeSummary, createIfNot, detectFileFormat, countSeqs
+from abseqPy.IgRepertoire.igRepUtils import fastq2fasta, mergeReads, \
+    writeListToFile, writeSummary, createIfNot, detectFileFormat, countSeqs, scanSeqFile
 from abseqPy.versionManager import writeParams
 from abseqPy.logger import printto, setupLogger, LEVEL
 from abseqPy.IgRepAuxiliary.productivityAuxiliary import refineClonesAnnotation
 from abseqPy.IgRepReporting.igRepPlots import plotSeqLenDist, plotSeqLenDistClasses, eitherExists
 from abseqPy.IgRepAuxiliary.annotateAuxiliary import annotateIGSeqRead
+from abseqPy.IgRepAuxiliary.SeqStore import SeqStore
+from abseqPy.IgRepAuxiliary.StageManifest import StageManifest
+from abseqPy.IgRepAuxiliary.schemaAuxiliary import compactCloneAnnot, compactCloneSeqs, readCloneFrame, \
+    writeCloneFrame, countCloneFrame
+from abseqPy.IgRepAuxiliary.dedupAuxiliary import collapseDuplicateReads, expandRepresentatives, \
+    expandRepresentativeIDs
 from abseqPy.IgRepReporting.abundanceReport import writeAbundanceToFiles
 from abseqPy.IgRepReporting.productivityReport import generateProductivityReport
 from abseqPy.IgRepReporting.diversityReport import generateDiversityReport
@@ -36,7 +43,93 @@ from abseqPy.IgRepAuxiliary.diversityAuxiliary import annotateSpectratypes, \
     annotateClonotypes
 from abseqPy.IgRepAuxiliary.restrictionAuxiliary import scanRestrictionSites
 from abseqPy.IgRepReporting.restrictionReport import generateOverlapFigures
-from abseqPy.utilities import ShortOpts, quote
+from abseqPy.utilities import ShortOpts, quote, fitsInMemory
+from abseqPy.instrumentation import StageTimer
+
+# share of the memory budget that the dataframes kept in memory between tasks (see IgRepertoire._cacheFrame) may take
+CACHE_FRACTION = 0.25
+# generous estimate of the memory taken by a row of a clone annotation dataframe (compact schema)
+ANNOT_ROW_BYTES = 512
+
+# the analysis stages whose outputs are tracked by a StageManifest (see IgRepertoire._beginStages). A stage is
+# stage name -> (output paths, the IgRepertoire arguments its outputs depend on, the arguments that are paths to input
+# files, the stages whose outputs it builds on). Output paths are directories the stage owns or glob patterns of the
+# files it writes to a directory it shares, {hdf}, {aux} and {name} stand for hdfDir, auxDir and the sample name.
+# Stages can run at the same time, no two stages may claim the same files. The reads are inputs of all stages.
+# The clone annotation dataframes are saved unfiltered so that they can be reused with other filtering criteria: they
+# are stages of their own, and only the "_report" stages that filter them depend on the filtering criteria
+_FILTERING = ('bitscore', 'alignlen', 'sstart', 'qstart')
+_REFINEMENT = ('actualqstart', 'trim5', 'trim3', 'fr4cut')
+
+
+def _dirs(name):
+    return '{hdf}/' + name, '{aux}/' + name
+
+
+def _globEscape(path):
+    # glob.escape is python 3 only
+    return re.sub(r'([*?[])', r'[\1]', path)
+
+
+STAGES = {
+    'fastqc': (_dirs('fastqc'), (), (), ()),
+    'annot': (('{hdf}/annot/{name}_clones_annot.h5', '{hdf}/annot/{name}_unmapped_clones.txt',
+               '{hdf}/annot/{name}_dedup.h5', '{hdf}/annot/{name}_unique.fasta', '{hdf}/annot/tmp'),
+              ('chain', 'seqtype', 'domainSystem', 'database', 'merger', 'dedup'), (), ()),
+    'annot_report': (('{hdf}/annot/{name}_filtered_out_clones.txt', '{aux}/annot/{name}_all_clones_len_dist*'),
+                     _FILTERING, (), ('annot',)),
+    'abundance': (_dirs('abundance'), ('chain',) + _FILTERING, (), ('annot',)),
+    'productivity': (('{hdf}/productivity/{name}_refined_clones_annot.h5', '{hdf}/productivity/{name}_clones_seq.h5',
+                      '{hdf}/productivity/{name}_refinement_flagged*'), _REFINEMENT, (), ('annot',)),
+    'productivity_report': (('{hdf}/productivity/{name}_filtered_out_clones.txt', '{aux}/productivity'),
+                            _FILTERING, (), ('productivity',)),
+    'diversity': (_dirs('diversity'), ('clonelimit', 'detailedComposition') + _FILTERING, (), ('productivity',)),
+    'restriction_sites': (_dirs('restriction_sites'), ('sites',) + _FILTERING, ('sites',), ('annot', 'productivity')),
+    'secretion': (_dirs('secretion'), ('upstream',) + _FILTERING, (), ('annot',)),
+    'utr5': (_dirs('utr5'), ('upstream',) + _FILTERING, (), ('annot',)),
+    'primer_specificity': (('{hdf}/primer_specificity/{name}_primer_annot.h5',),
+                           ('primer5end', 'primer3end', 'primer5endoffset') + _REFINEMENT,
+                           ('primer5end', 'primer3end'), ('annot',)),
+    'primer_specificity_report': (('{hdf}/primer_specificity/{name}_filtered_out_clones.txt',
+                                   '{aux}/primer_specificity'),
+                                  _FILTERING, (), ('primer_specificity', 'productivity')),
+    # its plots sit next to the ones of the annotation
+    'seqlen': (('{aux}/annot/{name}_seq_length_dist*',), ('merger',), (), ())
+}
+
+
+def stagePaths(stage, hdfDir, auxDir, name):
+    """
+    :param stage: string. stage name, one of STAGES
+    :param hdfDir: string. hdf directory of the sample
+    :param auxDir: string. auxiliary directory of the sample
+    :param name: string. sample name
+    :return: list of the output paths (directories and glob patterns of files) of the stage
+    """
+    # directory and sample names are taken literally, not as glob patterns
+    return [os.path.normpath(path.format(hdf=_globEscape(hdfDir), aux=_globEscape(auxDir), name=_globEscape(name)))
+            for path in STAGES[stage][0]]
+
+
+def _stage(*names):
+    """
+    decorator of the IgRepertoire methods that run analysis stages: the outputs of the stages that are out of date
+    (see StageManifest) are removed before the method runs, and the manifests of the stages are updated once it
+    returns. If the method raises, the manifests are left as "running" and the next run cleans up after it
+
+    :param names: string. stage names, in STAGES
+    :return: decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            manifests = self._beginStages(names)
+            ret = method(self, *args, **kwargs)
+            for name, manifest in zip(names, manifests):
+                self._completeStage(name, manifest)
+            return ret
+        return wrapper
+    return decorator
 
 
 # the following are conditionally imported in functions that require them to reduce abseq's dependency list
@@ -61,7 +154,7 @@ class IgRepertoire:
                  actualqstart=-1, trim5=0, trim3=0,
                  fr4cut=True, primer5endoffset=0, primer5end=None, primer3end=None,
                  upstream=None, sites=None, database="$IGBLASTDB", task=DEFAULT_TASK, log=None,
-                 yaml=None):
+                 yaml=None, dedup=False, memory=None, queue=None):
         """
 
         :param f1: string
@@ -155,6 +248,16 @@ class IgRepertoire:
                                 path to logger file
         :param yaml: string
                                 dummy variable. Used in commandline mode
+        :param dedup: bool
+                                collapse identical reads before annotation and refinement. Only one read of
+                                every group of identical reads is aligned and refined, the results are then
+                                copied to the other reads of the group
+        :param memory: int
+                                memory budget of this sample in bytes. Chunk sizes, buffering and the number of
+                                worker processes are chosen to stay within it. If None, it is derived from the
+                                memory limit of the container (cgroup) or the physical memory of the host
+        :param queue: string
+                                dummy variable. Job queue directory of the run, see IgMultiRepertoire
         """
         fargs, _, _, values = inspect.getargvalues(inspect.currentframe())
         self.args = dict([(arg, values[arg]) for arg in fargs if arg != 'self'])
@@ -168,6 +271,7 @@ class IgRepertoire:
 
         # directory creation
         outputDir = os.path.abspath(outdir)
+        self.outputDir = outputDir
         self.hdfDir = os.path.join(outputDir, HDF_FOLDER, self.name) + os.path.sep
         self.auxDir = os.path.join(outputDir, AUX_FOLDER, self.name) + os.path.sep
 
@@ -205,17 +309,23 @@ class IgRepertoire:
         self.format = fmt if fmt is not None else detectFileFormat(self.readFile1)
         self.merger = merger
         self.merge = 'no' if self.merger is None else 'yes'
+        self.dedup = dedup
+        self.memory = memory
 
         self.seqsPerFile = int(10.0 ** 5 / 2)
         self.cloneAnnot = None
         self.cloneSeqs = None
         self.readFile = None
+        self.seqStore = None
+        # unfiltered dataframes of the HDF5 files written or read by this sample, keyed by file name
+        self._frameCache = {}
 
         setupLogger(self.name, self.task, log)
         writeParams(self.args, self.auxDir)
         self._tasks = self._setupTasks()
         self._summaryFile = os.path.join(self.auxDir, "summary.txt")
 
+    @_stage('fastqc')
     def runFastqc(self):
         logger = logging.getLogger(self.name)
 
@@ -251,10 +361,15 @@ class IgRepertoire:
         if self.merge != 'yes':
             self.readFile = self.readFile1
         else:
-            mergedFastq = mergeReads(self.readFile1, self.readFile2,
-                                     self.threads, self.merger, self.hdfDir, stream=logger)
+            with StageTimer('merge') as timer:
+                mergedFastq = mergeReads(self.readFile1, self.readFile2,
+                                         self.threads, self.merger, self.hdfDir, stream=logger)
+                # the merger runs in its own process, its I/O is not counted in this one's
+                timer.addRead(self.readFile1, self.readFile2)
+                timer.addWritten(mergedFastq)
             self.readFile = mergedFastq
 
+    @_stage('annot', 'annot_report')
     def annotateClones(self, filterOutDir=None, inplaceProductive=False):
         """
         annotate clones from self.read using IgBLAST. self.cloneAnnot will be a dataframe
@@ -285,9 +400,8 @@ class IgRepertoire:
         if self.readFile is None:
             self.mergePairedReads()
 
-        writeSummary(self._summaryFile, "RawReads", countSeqs(self.readFile1))
-
         if os.path.exists(cloneAnnotFile):
+            writeSummary(self._summaryFile, "RawReads", countSeqs(self.readFile1))
             if self.task == "annotate":
                 printto(logger, "\tClones annotation file found and no further work needed ... " +
                         os.path.basename(cloneAnnotFile))
@@ -295,7 +409,7 @@ class IgRepertoire:
             else:
                 printto(logger, "\tClones annotation file found and being loaded ... " +
                         os.path.basename(cloneAnnotFile))
-                self.cloneAnnot = read_hdf(cloneAnnotFile, "cloneAnnot")
+                self.cloneAnnot = self._loadFrame(cloneAnnotFile, "cloneAnnot")
             # write (update) number of annotated reads - this is possible because we always
             # save the unfiltered cloneannot dataframe, and re-filter after reloading
             writeSummary(self._summaryFile, "AnnotatedReads", self.cloneAnnot.shape[0])
@@ -304,22 +418,51 @@ class IgRepertoire:
                 raise Exception(self.readFile + " does not exist!")
 
             # Convert FASTQ file into FASTA format
+            noSeqs = None
             if self.format == 'fastq':
-                readFasta = fastq2fasta(self.readFile, self.hdfDir, stream=logger)
+                with StageTimer('fastq2fasta') as timer:
+                    readFasta, noSeqs = fastq2fasta(self.readFile, self.hdfDir, stream=logger)
+                    timer.records = noSeqs
             elif self.format == 'fasta':
-                # unzip the fasta file if need be
-                readFasta = gunzip(self.readFile)
+                # gzipped FASTA files are decompressed on the fly
+                readFasta = self.readFile
             else:
                 raise Exception('unknown file format! ' + self.format)
             #             if self.trim3End > 0 or self.trim5End > 0:
             #                 trimSequences(readFasta)
             #                 self.trimmed = True
 
-            # Estimate the IGV family abundance for each library
+            if self.readFile == self.readFile1:
+                # the raw reads are the reads being annotated, the conversion counted them unless it ran before
+                if noSeqs is None:
+                    noSeqs = countSeqs(self.readFile1)
+                writeSummary(self._summaryFile, "RawReads", noSeqs)
+            else:
+                writeSummary(self._summaryFile, "RawReads", countSeqs(self.readFile1))
+
+            representatives = None
+            if self.dedup:
+                # only one read of every group of identical reads is aligned
+                uniqueFasta = os.path.join(outAuxDir, self.name + "_unique.fasta")
+                representatives = collapseDuplicateReads(readFasta, 'fasta', uniqueFile=uniqueFasta, stream=logger)
+                representatives.to_hdf(self._dedupFile(), "representatives", mode='w')
+                readFasta = uniqueFasta
+
+            # Estimate the IGV family abundance for each library. Chunks that were already annotated by a previous
+            # run (e.g. one that crashed, or one with fewer reads) are picked up from the chunk cache
             (self.cloneAnnot, filteredIDs) = annotateIGSeqRead(readFasta, self.chain, self.db, self.threads,
                                                                self.seqsPerFile, self.seqType, outdir=outAuxDir,
                                                                domainSystem=self.domainSystem,
+                                                               cacheDir=os.path.join(outAuxDir, "cache"),
+                                                               noSeqs=(noSeqs if representatives is None
+                                                                       else None),
                                                                stream=logger)
+            compactCloneAnnot(self.cloneAnnot)
+            if representatives is not None:
+                # duplicates get the annotation of their representative
+                self.cloneAnnot = expandRepresentatives(self.cloneAnnot, representatives)
+                filteredIDs = expandRepresentativeIDs(filteredIDs, representatives)
+                os.remove(readFasta)
             sys.stdout.flush()
             gc.collect()
 
@@ -328,7 +471,8 @@ class IgRepertoire:
             # export the CDR/FR annotation to a file
             printto(logger, "\tClones annotation file is being written to " +
                     os.path.basename(cloneAnnotFile))
-            self.cloneAnnot.to_hdf(cloneAnnotFile, "cloneAnnot", mode='w')
+            writeCloneFrame(self.cloneAnnot, cloneAnnotFile, "cloneAnnot", queryable=True)
+            self._cacheFrame(cloneAnnotFile, self.cloneAnnot)
             paramFile = writeParams(self.args, outResDir)
             printto(logger, "The analysis parameters have been written to " + paramFile)
 
@@ -360,13 +504,8 @@ class IgRepertoire:
         # generate plot of clone sequence length distribution
         outputFile = os.path.join(outResDir, self.name + '_all_clones_len_dist.csv')
         noOutlierOutputFile = os.path.join(outResDir, self.name + '_all_clones_len_dist_no_outliers.csv')
-        seqLengths = defaultdict(int)
         if not eitherExists(outputFile) or not eitherExists(noOutlierOutputFile):
-            for record in SeqIO.parse(gunzip(self.readFile), self.format):
-                if record.id in self.cloneAnnot.index:
-                    seqLengths[len(record)] += 1
-
-            count = Counter(seqLengths)
+            count = self._loadSeqStore().lengthDist(self.cloneAnnot.index)
 
             plotSeqLenDist(count, self.name, outputFile, self.format,
                            maxbins=40, histtype='bar', removeOutliers=False,
@@ -387,6 +526,7 @@ class IgRepertoire:
         # finally, write number of filtered reads
         writeSummary(self._summaryFile, "FilteredReads", self.cloneAnnot.shape[0])
 
+    @_stage('abundance')
     def analyzeAbundance(self):
         # Estimate the IGV family abundance for each library
         logger = logging.getLogger(self.name)
@@ -405,6 +545,7 @@ class IgRepertoire:
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
+    @_stage('productivity', 'productivity_report')
     def analyzeProductivity(self, inplaceProductive=True, inplaceFiltered=True):
         """
         analyze sample productivity
@@ -441,43 +582,47 @@ class IgRepertoire:
             #                       ", you may not need trimming")
             # print(sys.getsizeof(self.cloneAnnot) / (1024.**3)) # in GB
             (self.cloneAnnot, self.cloneSeqs) = refineClonesAnnotation(outAuxDir, self.name,
-                                                                       self.cloneAnnot, self.readFile,
-                                                                       self.format, self.actualQstart,
+                                                                       self.cloneAnnot, self._loadSeqStore(),
+                                                                       self.actualQstart,
                                                                        self.chain, self.fr4cut,
                                                                        self.trim5End, self.trim3End,
                                                                        self.seqsPerFile, self.threads,
+                                                                       representatives=self._loadDuplicates(),
                                                                        stream=logger)
             gc.collect()
             # if generateReport:
             # export the CDR/FR annotation to a file                
             printto(logger, "The refined clone annotation file is being written to "
                     + os.path.basename(refinedCloneAnnotFile))
-            self.cloneAnnot.to_hdf(refinedCloneAnnotFile, "refinedCloneAnnot", mode='w', complib='blosc')
+            writeCloneFrame(self.cloneAnnot, refinedCloneAnnotFile, "refinedCloneAnnot", complib='blosc',
+                            queryable=True)
+            self._cacheFrame(refinedCloneAnnotFile, self.cloneAnnot)
 
             printto(logger, "The clone protein sequences are being written to " + os.path.basename(cloneSeqFile))
-            self.cloneSeqs.to_hdf(cloneSeqFile, "cloneSequences", mode='w', complib='blosc')
+            writeCloneFrame(self.cloneSeqs, cloneSeqFile, "cloneSequences", complib='blosc')
+            self._cacheFrame(cloneSeqFile, self.cloneSeqs)
 
             paramFile = writeParams(self.args, outResDir)
             printto(logger, "The analysis parameters have been written to " + paramFile)
             # although self.cloneAnnot is already filtered,
             # reapply filtering because vqstart might've changed post refinement
             printto(logger, "Applying filtering criteria to refined datafames")
+            before = self.cloneAnnot.shape[0]
+            selectedRows = self._cloneAnnotFilteredRows(logger)
+            self.cloneAnnot = self.cloneAnnot[selectedRows]
         else:
             printto(logger, "The refined clone annotation files were found and being loaded ... " +
                     os.path.basename(refinedCloneAnnotFile))
 
-            self.cloneAnnot = read_hdf(refinedCloneAnnotFile, "refinedCloneAnnot")
+            # since we load it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria,
+            # clones that do not pass them are not even loaded
+            printto(logger, "\tApplying filtering criteria to loaded HDF5 dataframes")
+            self.cloneAnnot, before = self._loadFilteredAnnot(refinedCloneAnnotFile, "refinedCloneAnnot", logger)
             printto(logger, "\tClone annotation was loaded successfully")
 
-            self.cloneSeqs = read_hdf(cloneSeqFile, "cloneSequences")
+            self.cloneSeqs = self._loadFrame(cloneSeqFile, "cloneSequences", compact=compactCloneSeqs)
             printto(logger, "\tClone sequences were loaded successfully")
 
-            # since we loaded it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria
-            printto(logger, "\tApplying filtering criteria to loaded HDF5 dataframes")
-
-        before = self.cloneAnnot.shape[0]
-        selectedRows = self._cloneAnnotFilteredRows(logger)
-        self.cloneAnnot = self.cloneAnnot[selectedRows]
         self.cloneSeqs = self.cloneSeqs.loc[self.cloneAnnot.index]
         printto(logger, "\tPercentage of retained clones is {:.2%} ({:,}/{:,})"
                 .format(self.cloneAnnot.shape[0] / before, self.cloneAnnot.shape[0], before))
@@ -512,6 +657,7 @@ class IgRepertoire:
             self.cloneAnnot = self.cloneAnnot[self.cloneAnnot['filtered'] == 'No']
             self.cloneSeqs = self.cloneSeqs.loc[self.cloneAnnot.index]
 
+    @_stage('diversity')
     def analyzeDiversity(self):
         logger = logging.getLogger(self.name)
 
@@ -532,16 +678,17 @@ class IgRepertoire:
 
         gc.collect()
 
-        # Identify spectratypes 
-        printto(logger, "Spectratypes are being calculated ... ")
-        spectraTypes = annotateSpectratypes(self.cloneAnnot, amino=True)
+        with StageTimer('diversity', records=len(self.cloneAnnot)):
+            # Identify spectratypes
+            printto(logger, "Spectratypes are being calculated ... ")
+            spectraTypes = annotateSpectratypes(self.cloneAnnot, amino=True)
 
-        # Identify clonotypes 
-        printto(logger, "Clonotypes are being generated ... ")
-        clonoTypes = annotateClonotypes(self.cloneSeqs, segregate=self.detailedComposition, removeNone=True)
+            # Identify clonotypes
+            printto(logger, "Clonotypes are being generated ... ")
+            clonoTypes = annotateClonotypes(self.cloneSeqs, segregate=self.detailedComposition, removeNone=True)
 
-        generateDiversityReport(spectraTypes, clonoTypes, self.name, outResDir, self.clonelimit,
-                                threads=self.threads, segregate=self.detailedComposition, stream=logger)
+            generateDiversityReport(spectraTypes, clonoTypes, self.name, outResDir, self.clonelimit,
+                                    threads=self.threads, segregate=self.detailedComposition, stream=logger)
 
         # todo: remove this for now - it's unoptimized and extremely slow
         # writeClonotypeDiversityRegionAnalysis(self.cloneSeqs, self.name, outResDir, stream=logger)
@@ -549,6 +696,7 @@ class IgRepertoire:
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
+    @_stage('restriction_sites')
     def analyzeRestrictionSites(self, simple):
         logger = logging.getLogger(self.name)
         ssimple = 'simple' if simple else 'detailed'
@@ -558,13 +706,10 @@ class IgRepertoire:
         if not os.path.isdir(outResDir):
             os.makedirs(outResDir)
 
+        # RSA uses filtered dataframes and saves its data files with filtered results, they are removed by
+        # _beginStages if the filtering criteria changed
         if not os.path.isdir(outAuxDir):
             os.makedirs(outAuxDir)
-        else:
-            # RSA uses filtered dataframes, and saves its data files with filtered results. If the user has changed
-            # any of their filtering criteria, they should remove or rename the directory before regenerating the files
-            printto(logger, "WARNING: remove the 'restriction_sites' directory if you changed the filtering criteria.",
-                    LEVEL.WARN)
 
         # enzyme, restriction site (seq), no. hits, percentage, no molecule, percentage of molecules
         siteHitsFile = os.path.join(outResDir, self.name + "_{}_rsa{}.csv"
@@ -593,7 +738,7 @@ class IgRepertoire:
             else:
                 # always take the refined dataframe, in contrast to RSA simple which takes any available one
                 self.analyzeProductivity(inplaceFiltered=True, inplaceProductive=True)
-            (rsaResults, overlapResults) = scanRestrictionSites(self.name, self.readFile, self.cloneAnnot,
+            (rsaResults, overlapResults) = scanRestrictionSites(self.name, self._loadSeqStore(), self.cloneAnnot,
                                                                 self.sitesFile, self.threads, simple=simple,
                                                                 stream=logger)
             rsaResults.to_csv(siteHitsFile, header=True, index=False)
@@ -607,6 +752,7 @@ class IgRepertoire:
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
+    @_stage('secretion')
     def analyzeSecretionSignal(self):
         logger = logging.getLogger(self.name)
 
@@ -616,12 +762,10 @@ class IgRepertoire:
         if not os.path.exists(outResDir):
             os.makedirs(outResDir)
 
+        # abseq will load the files in this directory if they are found, to reduce time recomputing them (they are
+        # removed by _beginStages if the filtering criteria changed)
         if not os.path.exists(outAuxDir):
             os.makedirs(outAuxDir)
-        else:
-            # abseq will load the files in this directory if they are found, to reduce time recomputing them
-            printto(logger, "WARNING: Remove 'secretion' directory if you've changed the filtering criteria.",
-                    LEVEL.WARN)
 
         # need self.cloneAnnot dataframe for further analysis
         if self.cloneAnnot is None:
@@ -633,7 +777,7 @@ class IgRepertoire:
                                     .format(self.upstream[0], self.upstream[1]))
 
         if not os.path.exists(upstreamFile):
-            extractUpstreamSeqs(self.cloneAnnot, self.readFile, self.upstream, upstreamFile, stream=logger)
+            extractUpstreamSeqs(self.cloneAnnot, self._loadSeqStore(), self.upstream, upstreamFile, stream=logger)
         else:
             printto(logger, "\tUpstream sequences file {} was found! Loading file ... "
                     .format(os.path.basename(upstreamFile)), LEVEL.WARN)
@@ -669,6 +813,7 @@ class IgRepertoire:
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
+    @_stage('utr5')
     def analyze5UTR(self):
         logger = logging.getLogger(self.name)
 
@@ -678,12 +823,10 @@ class IgRepertoire:
         if not os.path.exists(outResDir):
             os.makedirs(outResDir)
 
+        # abseq will load the files in this directory if they are found, to reduce time recomputing them (they are
+        # removed by _beginStages if the filtering criteria changed)
         if not os.path.exists(outAuxDir):
             os.makedirs(outAuxDir)
-        else:
-            # abseq will load the files in this directory if they are found, to reduce time recomputing them
-            printto(logger, "WARNING: Remove 'utr5' directory if you've changed the filtering criteria",
-                    LEVEL.WARN)
 
         # requires self.cloneAnnot dataframe for further analysis
         if self.cloneAnnot is None:
@@ -695,7 +838,7 @@ class IgRepertoire:
                                     .format(self.upstream[0], self.upstream[1]))
 
         if not os.path.exists(upstreamFile):
-            extractUpstreamSeqs(self.cloneAnnot, self.readFile, self.upstream, upstreamFile, stream=logger)
+            extractUpstreamSeqs(self.cloneAnnot, self._loadSeqStore(), self.upstream, upstreamFile, stream=logger)
         else:
             printto(logger, "\tUpstream sequences file {} was found! Loading file... "
                     .format(os.path.basename(upstreamFile)), LEVEL.WARN)
@@ -719,6 +862,7 @@ class IgRepertoire:
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
+    @_stage('primer_specificity', 'primer_specificity_report')
     def analyzePrimerSpecificity(self):
         logger = logging.getLogger(self.name)
 
@@ -742,25 +886,25 @@ class IgRepertoire:
 
             # add additional primer related data to the dataframe generated by either abundance/productivity analysis
             # before we begin primer analysis
-            self.cloneAnnot = addPrimerData(self.cloneAnnot, self.readFile, self.format, self.fr4cut,
+            self.cloneAnnot = addPrimerData(self.cloneAnnot, self._loadSeqStore(), self.fr4cut,
                                             self.trim5End, self.trim3End, self.actualQstart,
                                             self.end5, self.end3, self.end5offset, self.threads, stream=logger)
             # save new "primer column-ed dataframe" into primer_specificity directory
-            self.cloneAnnot.to_hdf(primerAnnotFile, "primerCloneAnnot", mode='w', complib='blosc')
+            writeCloneFrame(self.cloneAnnot, primerAnnotFile, "primerCloneAnnot", complib='blosc', queryable=True)
+            self._cacheFrame(primerAnnotFile, self.cloneAnnot)
 
             # now we can safely apply the filter on self.cloneAnnot
             printto(logger, "\tApplying filtering criteria to primer specificity analysis dataframes")
+            before = self.cloneAnnot.shape[0]
+            selectedRows = self._cloneAnnotFilteredRows(logger)
+            self.cloneAnnot = self.cloneAnnot[selectedRows]
         else:
             printto(logger, "The primer clone annotation files were found and being loaded ... ", LEVEL.WARN)
-            self.cloneAnnot = read_hdf(primerAnnotFile, "primerCloneAnnot")
-            printto(logger, "\tPrimer clone annotation loaded successfully")
-
-            # since we loaded it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria
+            # since we load it from the saved (old) HDF5 dataframes, we need to re-apply all filtering criteria
             printto(logger, "\tApplying filtering criteria to loaded HDF5 dataframes")
+            self.cloneAnnot, before = self._loadFilteredAnnot(primerAnnotFile, "primerCloneAnnot", logger)
+            printto(logger, "\tPrimer clone annotation loaded successfully")
 
-        before = self.cloneAnnot.shape[0]
-        selectedRows = self._cloneAnnotFilteredRows(logger)
-        self.cloneAnnot = self.cloneAnnot[selectedRows]
         self.cloneSeqs = self.cloneSeqs.loc[self.cloneAnnot.index]
         printto(logger, "\tPercentage of retained clones is {:.2%} ({:,}/{:,})"
                 .format(self.cloneAnnot.shape[0] / before, self.cloneAnnot.shape[0], before))
@@ -772,6 +916,7 @@ class IgRepertoire:
         paramFile = writeParams(self.args, outResDir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
+    @_stage('seqlen')
     def analyzeSeqLen(self, klass=False):
         """
         plots the distribution length of raw sequences (after merging, if needed). This is different from
@@ -801,32 +946,98 @@ class IgRepertoire:
             plotSeqLenDistClasses(self.readFile, self.name, outputFile, self.format, stream=logger)
         else:
             outputFile = os.path.join(outResdir, self.name + '_seq_length_dist.csv')
-            plotSeqLenDist(self.readFile, self.name, outputFile, self.format, maxbins=-1, stream=logger)
-            outputFile = os.path.join(outResdir, self.name + '_seq_length_dist_no_outliers.csv')
-            plotSeqLenDist(self.readFile, self.name, outputFile, self.format, removeOutliers=True,
-                           maxbins=-1, stream=logger)
+            noOutlierOutputFile = os.path.join(outResdir, self.name + '_seq_length_dist_no_outliers.csv')
+            if not eitherExists(outputFile) or not eitherExists(noOutlierOutputFile):
+                # both distributions come from the same pass over the reads
+                _, count = scanSeqFile(self.readFile, self.format)
+                plotSeqLenDist(count, self.name, outputFile, self.format, maxbins=-1, stream=logger)
+                plotSeqLenDist(count, self.name, noOutlierOutputFile, self.format, removeOutliers=True,
+                               maxbins=-1, stream=logger)
+            else:
+                printto(logger, "File found ... {}".format(os.path.basename(outputFile)), LEVEL.WARN)
+                printto(logger, "File found ... {}".format(os.path.basename(noOutlierOutputFile)), LEVEL.WARN)
 
         paramFile = writeParams(self.args, outResdir)
         printto(logger, "The analysis parameters have been written to " + paramFile)
 
-    def _cloneAnnotFilteredRows(self, logger):
+    def _filterRanges(self, logger):
+        """
+        :param logger: logging stream
+        :return: dict of clone annotation column -> (min, max) range a clone must lie within to be retained
+        """
         printto(logger, "Clones are being filtered based on the following criteria: ", LEVEL.INFO)
         printto(logger, "\tBit score: " + repr(self.bitScore), LEVEL.INFO)
         printto(logger, "\tAlignment length: " + repr(self.alignLen), LEVEL.INFO)
         printto(logger, "\tSubject V gene start: " + repr(self.sStart), LEVEL.INFO)
         printto(logger, "\tQuery V gene start: " + repr(self.qStart), LEVEL.INFO)
-        selectedRows = (
-                (self.cloneAnnot['bitscore'] >= self.bitScore[0]) &  # check bit-Score
-                (self.cloneAnnot['bitscore'] <= self.bitScore[1]) &
-                (self.cloneAnnot['alignlen'] >= self.alignLen[0]) &  # check alignment length
-                (self.cloneAnnot['alignlen'] <= self.alignLen[1]) &
-                (self.cloneAnnot['vstart'] >= self.sStart[0]) &  # check subject (V gene) start position
-                (self.cloneAnnot['vstart'] <= self.sStart[1]) &
-                (self.cloneAnnot['vqstart'] >= self.qStart[0]) &  # check query (V gene) start position
-                (self.cloneAnnot['vqstart'] <= self.qStart[1])
-        )
+        return {
+            'bitscore': tuple(self.bitScore),   # check bit-Score
+            'alignlen': tuple(self.alignLen),   # check alignment length
+            'vstart': tuple(self.sStart),       # check subject (V gene) start position
+            'vqstart': tuple(self.qStart)       # check query (V gene) start position
+        }
+
+    def _cloneAnnotFilteredRows(self, logger, cloneAnnot=None):
+        cloneAnnot = self.cloneAnnot if cloneAnnot is None else cloneAnnot
+        selectedRows = None
+        for col, (low, high) in self._filterRanges(logger).items():
+            inRange = (cloneAnnot[col] >= low) & (cloneAnnot[col] <= high)
+            selectedRows = inRange if selectedRows is None else (selectedRows & inRange)
         return selectedRows
 
+    def _loadFilteredAnnot(self, filename, key, logger):
+        """
+        the clones of a saved clone annotation dataframe that pass the filtering criteria. They are taken from the
+        cached dataframe if there is one. Otherwise, the whole dataframe is loaded (and cached) if the memory
+        budget allows it, or else only the clones that pass the criteria are read (the criteria are applied while
+        reading files written by this version, clones that do not pass them are never loaded)
+
+        :param filename: string. HDF5 file written by writeCloneFrame
+        :param key: string. key of the dataframe in filename
+        :param logger: logging stream
+        :return: (cloneAnnot, before) tuple. before is the number of clones in the file, filtered or not
+        """
+        cloneAnnot = self._frameCache.get(filename)
+        if cloneAnnot is None:
+            before = countCloneFrame(filename, key)
+            if not self._fitsCache(before * ANNOT_ROW_BYTES):
+                return compactCloneAnnot(readCloneFrame(filename, key, ranges=self._filterRanges(logger))), before
+            cloneAnnot = self._loadFrame(filename, key)
+        return cloneAnnot[self._cloneAnnotFilteredRows(logger, cloneAnnot)], cloneAnnot.shape[0]
+
+    def _loadFrame(self, filename, key, compact=compactCloneAnnot):
+        """
+        the unfiltered dataframe saved in filename, from the cache if it is there, or else from disk (it is then
+        cached). Cached dataframes are shared, they must not be modified in place
+
+        :param filename: string. HDF5 file written by writeCloneFrame
+        :param key: string. key of the dataframe in filename
+        :param compact: function that brings the dataframe to the compact schema
+        :return: dataframe
+        """
+        df = self._frameCache.get(filename)
+        if df is None:
+            df = self._cacheFrame(filename, compact(readCloneFrame(filename, key)))
+        return df
+
+    def _cacheFrame(self, filename, df):
+        """
+        keeps the unfiltered dataframe saved in filename in memory, as long as the memory budget allows it, so that
+        the tasks that need it later on do not read it from disk again
+
+        :param filename: string. HDF5 file df was written to
+        :param df: dataframe
+        :return: df
+        """
+        self._frameCache.pop(filename, None)
+        if self._fitsCache(int(df.memory_usage(index=True).sum())):
+            self._frameCache[filename] = df
+        return df
+
+    def _fitsCache(self, size):
+        cached = sum(int(df.memory_usage(index=True).sum()) for df in self._frameCache.values())
+        return fitsInMemory(cached + size, fraction=CACHE_FRACTION)
+
     def _getBestCloneAnnot(self, outAuxDir, inplaceFiltered, inplaceProductive, stream=None):
         """
         populate self.cloneAnnot by the following order:
@@ -881,29 +1092,114 @@ class IgRepertoire:
         aux = os.path.join(self.hdfDir, "annot")
         cloneAnnotFile = os.path.join(aux, self.name + "_clones_annot.h5")
         if os.path.exists(cloneAnnotFile):
-            self.cloneAnnot = read_hdf(cloneAnnotFile, "cloneAnnot")
+            self.cloneAnnot = self._loadFrame(cloneAnnotFile, "cloneAnnot")
         else:
             raise Exception("Cannot reload self.cloneAnnot, file {} not found".format(cloneAnnotFile))
 
+    def _dedupFile(self):
+        return os.path.join(self.hdfDir, "annot", self.name + "_dedup.h5")
+
+    def _loadDuplicates(self):
+        """
+        :return: the representatives Series of collapseDuplicateReads if identical reads should be collapsed,
+        None otherwise
+        """
+        if not self.dedup:
+            return None
+        if self.readFile is None:
+            self.mergePairedReads()
+        dedupFile = self._dedupFile()
+        if os.path.exists(dedupFile):
+            return read_hdf(dedupFile, "representatives")
+        # the annotation was produced without collapsing identical reads
+        representatives = collapseDuplicateReads(self.readFile, self.format, stream=logging.getLogger(self.name))
+        representatives.to_hdf(dedupFile, "representatives", mode='w')
+        return representatives
+
+    def _loadSeqStore(self):
+        """
+        the sequence store is built once (after merging, if needed) from self.readFile and is shared by every
+        analysis that needs the raw sequences of the clones
+
+        :return: SeqStore of self.readFile
+        """
+        if self.seqStore is None:
+            if self.readFile is None:
+                self.mergePairedReads()
+            self.seqStore = SeqStore.open(self.readFile, self.format, os.path.join(self.hdfDir, "seqstore"),
+                                          stream=logging.getLogger(self.name))
+        return self.seqStore
+
+    def _stageManifest(self, stage):
+        # the parameters file written by writeParams is a record of the last run, not an output
+        return StageManifest(os.path.join(self.hdfDir, "manifests", stage + ".json"), root=self.outputDir,
+                             ignore=('cache', 'analysis.params'))
+
+    def _stageSpec(self, stage):
+        """
+        :param stage: string. stage name, one of STAGES
+        :return: (output paths, dict of parameters, list of input files, list of upstream stages) of the stage
+        """
+        _, params, inputs, upstream = STAGES[stage]
+        params = dict((arg, self.args[arg]) for arg in params)
+        inputs = [self.readFile1, self.readFile2] + [self.args[arg] for arg in inputs]
+        return stagePaths(stage, self.hdfDir, self.auxDir, self.name), params, inputs, upstream
+
+    def _upstreamDigests(self, stage):
+        return dict((up, self._stageManifest(up).digest()) for up in STAGES[stage][3])
+
+    def _stageUpToDate(self, stage, manifest=None):
+        """
+        :param stage: string. stage name, one of STAGES
+        :param manifest: StageManifest of the stage, if already loaded
+        :return: bool. True if the outputs of the stage, and of the stages it builds on, can be reused as they are
+        """
+        manifest = manifest or self._stageManifest(stage)
+        _, params, inputs, upstream = self._stageSpec(stage)
+        return manifest.isUpToDate(params, inputs, self._upstreamDigests(stage)) and \
+            all(self._upstreamUpToDate(up) for up in upstream)
+
+    def _upstreamUpToDate(self, stage):
+        # an upstream stage that never ran (e.g. productivity for RSA simple) does not invalidate the stage, its
+        # digest was recorded as None
+        manifest = self._stageManifest(stage)
+        return manifest.status is None or self._stageUpToDate(stage, manifest)
+
+    def _beginStages(self, stages):
+        """
+        removes the outputs of the stages that are out of date, and records the start of the stages. All of them are
+        checked before any is started: a started stage has no digest, the stages that build on it would look out of date
+
+        :param stages: list of stage names, in STAGES
+        :return: list of the StageManifest of the stages
+        """
+        manifests = [self._stageManifest(stage) for stage in stages]
+        outOfDate = [manifest.status is not None and not self._stageUpToDate(stage, manifest)
+                     for stage, manifest in zip(stages, manifests)]
+        for stage, manifest, clean in zip(stages, manifests, outOfDate):
+            paths, params, inputs, _ = self._stageSpec(stage)
+            if clean:
+                manifest.clean(paths, stream=logging.getLogger(self.name))
+            manifest.begin(params, inputs, self._upstreamDigests(stage), paths)
+        return manifests
+
+    def _completeStage(self, stage, manifest):
+        # the upstream stages may have run on demand during this one
+        manifest.complete(self._stageSpec(stage)[0], self._upstreamDigests(stage))
+
     def _minimize(self):
         # XXX: cloneAnnot and cloneSeqs are the largest objects in a IgReportoire object,
         # we remove them so that we can pickle them into the queue again.
         # When needed, these files will be loaded automatically later on anyway
         self.cloneAnnot = None
         self.cloneSeqs = None
-
-    def _nextTask(self):
-        if len(self._tasks) > 0:
-            pack = self._tasks.pop()
-            if isinstance(pack, str):
-                return pack, [], {}
-            else:
-                # type(pack) = tuple: (str, dict) - see SeqLenClass
-                return pack[0], [], pack[1]
-        else:
-            return None, [], {}
+        self.seqStore = None
+        self._frameCache = {}
 
     def _setupTasks(self):
+        """
+        :return: TaskGraph of the requested tasks
+        """
         logger = logging.getLogger(self.name)
         todo = []
         if self.task == 'all':
@@ -942,8 +1238,7 @@ class IgRepertoire:
                             "analysis in addition to {} ... ".format(self.task), LEVEL.INFO)
             todo.append(AbSeqWorker.PRIM)
 
-        # reverse it so that the first to be popped out is the original first element
-        return todo[::-1]
+        return TaskGraph(todo, AbSeqWorker.io, AbSeqWorker.providers)
 
     def analyzeIgProtein(self):
         raise NotImplementedError
@@ -24,9 +24,10 @@ from collections import Counter, defaultdict
 from Bio.pairwise2 import align, format_alignment
 from Bio.SubsMat import MatrixInfo as matlist
 
+from abseqPy.IgRepAuxiliary.PatternMatcher import PatternMatcher
 from abseqPy.config import CLUSTALOMEGA, IGBLASTN, IGBLASTP, LEEHOM, PEAR, FLASH
 from abseqPy.logger import printto, LEVEL
-from abseqPy.utilities import hasLargeMem, ShortOpts, quote
+from abseqPy.utilities import ShortOpts, quote
 
 
 def detectFileFormat(fname, noRaise=False):
@@ -87,31 +88,100 @@ def safeOpen(filename, mode="rU"):
     :return: file handle
     """
     if filename.endswith(".gz"):
+        # gzip has no universal newline mode, and it opens files in binary mode unless told otherwise in python 3
+        mode = mode.replace("U", "")
+        if sys.version_info[0] >= 3 and "b" not in mode:
+            mode += "t"
         return gzip.open(filename, mode)
     return open(filename, mode)
 
 
-def gunzip(gzipFile):
+def _iterFastaLines(fp):
     """
-    Given a gzipped file, create a similar file that's uncompressed. If the file is not gzipped, do nothing.
-    The naming scheme follows the original provided path to file, but with .gz suffix stripped
-    The original gzipped file stays as a zipped file.
-
-    NOTE: WILL NOT DECOMPRESS IF THE DECOMPRESSED FILE IS FOUND
+    :param fp: open FASTA file handle
+    :return: generator of (title, sequence) string tuples
+    """
+    title, seq = None, []
+    for line in fp:
+        if line.startswith(">"):
+            if title is not None:
+                yield title, "".join(seq)
+            title, seq = line[1:].rstrip(), []
+        elif title is not None:
+            seq.append(line.strip().replace(" ", ""))
+    if title is not None:
+        yield title, "".join(seq)
+
+
+def _iterFastqLines(fp):
+    """
+    :param fp: open FASTQ file handle
+    :return: generator of (title, sequence) string tuples. Sequences and qualities may span multiple lines
+    """
+    for line in fp:
+        if not line.strip():
+            continue
+        if not line.startswith("@"):
+            raise ValueError("Records in FASTQ files should start with '@' character")
+        title, seq = line[1:].rstrip(), []
+        for line in fp:
+            if line.startswith("+"):
+                break
+            seq.append(line.strip())
+        seq = "".join(seq)
+        # the quality string is as long as the sequence, but it may start with '@' or '+' as well
+        qualityLength = 0
+        while qualityLength < len(seq):
+            try:
+                qualityLength += len(next(fp).strip())
+            except StopIteration:
+                raise ValueError("Truncated FASTQ record " + title)
+        yield title, seq
+
+
+def iterSeqFile(filename, fmt):
+    """
+    iterates over the records of a FASTA/FASTQ file (gzipped or not) by reading its raw lines, without creating
+    SeqRecord objects
 
-    :param gzipFile: file(filename) to be unzipped
-    :return: new filename of uncompressed file, or if file was originally not gzipped, return same name as argument
+    :param filename: path to FASTA/FASTQ file
+    :param fmt: fasta or fastq
+    :return: generator of (title, sequence) string tuples, the title is the header line without its '>' or '@'
     """
+    records = _iterFastqLines if fmt == "fastq" else _iterFastaLines
+    with safeOpen(filename) as fp:
+        for title, seq in records(fp):
+            yield title, seq
 
-    if not gzipFile.endswith(".gz"):
-        return gzipFile
 
-    newFileName = gzipFile.replace(".gz", "")
-    # only decompress if the file is not found
-    if not os.path.exists(newFileName):
-        with gzip.open(gzipFile, 'rb') as f_in, open(newFileName, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    return newFileName
+def scanSeqFile(filename, fmt, fastaFile=None, ids=None):
+    """
+    counts the records of a FASTA/FASTQ file (gzipped or not) and their sequence lengths in a single pass over the
+    raw lines of the file (no SeqRecord objects are created). The records can also be written out in FASTA format
+    along the way
+
+    :param filename: path to FASTA/FASTQ file
+    :param fmt: fasta or fastq
+    :param fastaFile: string. If provided, the records are written to this file in FASTA format
+    :param ids: set of record ids. If provided, only records with these ids are counted (all records are still
+    written to fastaFile)
+    :return: (number of records, Counter of sequence length -> number of records) tuple
+    """
+    lengths = Counter()
+    count = 0
+    out = open(fastaFile, 'w') if fastaFile is not None else None
+    try:
+        for title, seq in iterSeqFile(filename, fmt):
+            if out is not None:
+                out.write(">" + title + "\n" + seq + "\n")
+            if ids is not None and (title.split(None, 1) or [""])[0] not in ids:
+                continue
+            count += 1
+            lengths[len(seq)] += 1
+    finally:
+        if out is not None:
+            out.close()
+    return count, lengths
 
 
 def fastq2fasta(fastqFile, outputDir, stream=None):
@@ -120,7 +190,8 @@ def fastq2fasta(fastqFile, outputDir, stream=None):
     :param fastqFile: (un)compressed fastq file. If compressed, will leave original compressed untouched
     :param outputDir: Where to produce the new fasta file
     :param stream: debugging stream
-    :return: fasta filename
+    :return: (fasta filename, number of converted sequences) tuple. The number is None if the fasta file was
+            already there
     """
     # FASTQ to FASTA
     # awk 'NR % 4 == 1 {print ">" $0 } NR % 4 == 2 {print $0}' my.fastq > my.fasta
@@ -133,28 +204,29 @@ def fastq2fasta(fastqFile, outputDir, stream=None):
     # rename all fastq files to fasta, including gzipped files
     if filename.endswith(".gz"):
         filename = os.path.join(seqOut, filename.replace(filename.split('.')[-2] + ".gz", 'fasta'))
-        fastqFile = gunzip(fastqFile)
     else:
         filename = os.path.join(seqOut, filename.replace(filename.split('.')[-1], 'fasta'))
 
     if exists(filename):
         printto(stream, "\tThe FASTA file was found!", LEVEL.WARN)
-        return filename
+        return filename, None
 
     printto(stream, "\t" + os.path.basename(fastqFile) + " is being converted into FASTA ...")
-    SeqIO.convert(fastqFile, 'fastq', filename, 'fasta')
+    # gzipped files are decompressed on the fly
+    noSeqs, _ = scanSeqFile(fastqFile, 'fastq', fastaFile=filename)
+    printto(stream, "\t{:,} sequences were converted".format(noSeqs))
 
     # not all systems have AWK by default (cough, windows)
     # command = ("awk 'NR % 4 == 1 {sub(\"@\", \"\", $0) ; print \">\" $0} NR % 4 == 2 "
     #            "{print $0}' " + fastqFile + " > " + filename
     #            )
     # os.system(command)
-    return filename
+    return filename, noSeqs
 
 
 def runIgblastn(blastInput, chain, threads=8,
                 db='$IGBLASTDB', igdata="$IGDATA", domainSystem='imgt',
-                outputDir="", species='human', stream=None):
+                outputDir="", species='human', overwrite=False, stream=None):
     """
     Excerpt:
         The V domain can be delineated using either IMGT system (Lefranc et al 2003) or
@@ -178,6 +250,7 @@ def runIgblastn(blastInput, chain, threads=8,
     :param domainSystem: string, one of imgt or kabat
     :param outputDir: output directory where the output file will be saved in
     :param species: human is the only species supported currently
+    :param overwrite: bool. run igblast even if the output file already exists (e.g. left behind by a previous run)
     :param stream: logger stream object
     :return: output filename
     """
@@ -188,8 +261,10 @@ def runIgblastn(blastInput, chain, threads=8,
         blastOutput = blastInput.replace('.' + blastInput.split('.')[-1], '.out')
 
     if exists(blastOutput):
-        printto(stream, "\tBlast results were found ... " + os.path.basename(blastOutput))
-        return blastOutput
+        if not overwrite:
+            printto(stream, "\tBlast results were found ... " + os.path.basename(blastOutput))
+            return blastOutput
+        os.remove(blastOutput)
 
     printto(stream, '\tRunning igblast ... ' + os.path.basename(blastInput))
 
@@ -205,7 +280,7 @@ def runIgblastn(blastInput, chain, threads=8,
 
 
 def runIgblastp(blastInput, chain, threads=8, db='$IGBLASTDB', igdata='$IGDATA', domainSystem='imgt',
-                outputDir="", species='human', stream=None):
+                outputDir="", species='human', overwrite=False, stream=None):
     """
     Excerpt:
         The V domain can be delineated using either IMGT system (Lefranc et al 2003) or
@@ -229,14 +304,17 @@ def runIgblastp(blastInput, chain, threads=8, db='$IGBLASTDB', igdata='$IGDATA',
     :param domainSystem: string, one of imgt or kabat
     :param outputDir: output directory where the output file will be saved in
     :param species: human is the only species supported currently
+    :param overwrite: bool. run igblast even if the output file already exists (e.g. left behind by a previous run)
     :param stream: logger stream object
     :return: output filename
     """
     blastOutput = os.path.join(outputDir, blastInput.replace('.' + blastInput.split('.')[-1], '.out'))
 
     if exists(blastOutput):
-        printto(stream, "\tBlast results were found ... " + os.path.basename(blastOutput))
-        return blastOutput
+        if not overwrite:
+            printto(stream, "\tBlast results were found ... " + os.path.basename(blastOutput))
+            return blastOutput
+        os.remove(blastOutput)
 
     printto(stream, '\tRunning igblast ... ' + os.path.basename(blastInput))
 
@@ -448,7 +526,8 @@ def mergeReads(readFile1, readFile2, threads=3, merger='leehom', outDir="./", st
         else:
             printto(stream, "\tMerged reads file " + os.path.basename(mergedFastq) + ' was found!', LEVEL.WARN)
     elif merger == 'leehom':
-        mergedFastq = outputPrefix + '.fq'
+        # leehom writes a gzipped FASTQ file, which is read as-is from here on
+        mergedFastq = outputPrefix + '.fq.gz'
         if not exists(mergedFastq):
             printto(stream, "{} and {} are being merged ...".format(os.path.basename(readFile1)
                                                                     , os.path.basename(readFile2)))
@@ -456,7 +535,6 @@ def mergeReads(readFile1, readFile2, threads=3, merger='leehom', outDir="./", st
                                fqo=quote(outputPrefix), t=threads)
             # printto(stream, "Executing: " + str(leehom))
             leehom()
-            gunzip(mergedFastq + '.gz')
         else:
             printto(stream, "\tMerged reads file " + os.path.basename(mergedFastq) + ' was found!', LEVEL.WARN)
     elif merger == 'flash':
@@ -661,18 +739,42 @@ def findBestMatchedPattern(seq, patterns, extend5end=False):
                                          should (obviously) not interpret that as mismatch at pos 0 or indel at pos 0
           2) mismatch_position = 0    => no mismatches
           3) indel_position = 0       => no indel_position
+          4) the result is the same as aligning seq against every pattern with Bio.pairwise2 (in order, see
+             _alignAllPatterns), but only the best pattern is aligned, see PatternMatcher
+    """
+    NO_MATCH = (str(nan), 0, 0, -1, -1)
+    patterns = list(patterns)
+    matcher = PatternMatcher.compile(patterns)
+    query = matcher.encode(seq.upper()) if matcher.supported else None
+    if query is None:
+        return _alignAllPatterns(seq, patterns, extend5end)
+
+    # the pattern _alignAllPatterns would pick, from the few patterns the sequence shares seeds with
+    bestInd, intact = matcher.bestPattern(query)
+    if bestInd is None:
+        return NO_MATCH
+    if intact:
+        return patterns[bestInd][0], 0, 0, 0, len(patterns[bestInd][1])
+
+    alignments = align.localds(seq.upper(), patterns[bestInd][1], subMatIUPAC, -5, -5)
+    return _classifyAlignment(patterns[bestInd], _bestAlignment(alignments), extend5end)
+
+
+def _alignAllPatterns(seq, patterns, extend5end=False):
+    """
+    findBestMatchedPattern by aligning seq against all the patterns, for the sequences and patterns PatternMatcher
+    does not support
+    :param seq: nucleotide sequence
+    :param patterns: list of (pattern_id, pattern_seq, pattern_max_IUPAC_score)
+    :param extend5end: see findBestMatchedPattern
+    :return: see findBestMatchedPattern
     """
     NO_MATCH = (str(nan), 0, 0, -1, -1)
     scores = []
     # align the sequence against all possible patterns
     for (id, pattern, maxScore) in patterns:
-        alignments = align.localds(seq.upper(), pattern, subMatIUPAC, -5, -5)
-        if len(alignments) > 1:
-            localScores = [a[2] for a in alignments]
-            alignment = alignments[localScores.index(max(localScores))]
-        elif len(alignments) > 0:
-            alignment = alignments[0]
-        else:
+        alignment = _bestAlignment(align.localds(seq.upper(), pattern, subMatIUPAC, -5, -5))
+        if alignment is None:
             return NO_MATCH
         if alignment:
             alignLen = alignment[-1] - alignment[-2]
@@ -689,14 +791,39 @@ def findBestMatchedPattern(seq, patterns, extend5end=False):
 
     # if no exact matching ==> find the best alignment (pattern)
     if len(scores) > 1:
-        tmp = map(lambda x: x[1][2], scores)
+        tmp = [x[1][2] for x in scores]
         bestInd = tmp.index(max(tmp))
     elif len(scores) == 1:
         bestInd = 0
     else:
         return NO_MATCH
 
-    best = list(scores[bestInd])
+    return _classifyAlignment(patterns[bestInd], scores[bestInd][1], extend5end)
+
+
+def _bestAlignment(alignments):
+    """
+    :param alignments: list of alignments returned by Bio.pairwise2
+    :return: the first alignment of the highest score, None if there are no alignments
+    """
+    if len(alignments) > 1:
+        localScores = [a[2] for a in alignments]
+        return alignments[localScores.index(max(localScores))]
+    elif len(alignments) > 0:
+        return alignments[0]
+    return None
+
+
+def _classifyAlignment(pattern, alignment, extend5end=False):
+    """
+    classify the alignment of a sequence with its best matched pattern
+    :param pattern: (pattern_id, pattern_seq, pattern_max_IUPAC_score) tuple
+    :param alignment: Bio.pairwise2 alignment of the sequence and pattern_seq
+    :param extend5end: see findBestMatchedPattern
+    :return: see findBestMatchedPattern
+    """
+    NO_MATCH = (str(nan), 0, 0, -1, -1)
+    best = [pattern[0], alignment]
     best[1] = list(best[1])
 
     # best = [id, [seq, pattern, score, matchstart, matchend]]
@@ -734,11 +861,11 @@ def findBestMatchedPattern(seq, patterns, extend5end=False):
     # find the location of mismatch
     misPos = -1
     # if it is Mismatched ==> length of alignment == length of pattern
-    if len(best[ALIGNMENT][SEQ]) == len(patterns[bestInd][1]):
+    if len(best[ALIGNMENT][SEQ]) == len(pattern[1]):
         misPos = 0
         while misPos < len(best[ALIGNMENT][SEQ]):
             # 5 is max score in the substitution matrix
-            if subMatIUPAC[(best[ALIGNMENT][SEQ][misPos], patterns[bestInd][ALIGNMENT][misPos])] != 5:
+            if subMatIUPAC[(best[ALIGNMENT][SEQ][misPos], pattern[1][misPos])] != 5:
                 break
             misPos += 1
     # TODO: revise algorithm
@@ -765,30 +892,6 @@ def extend5align(localAlignment):
     return start if start > 0 else localAlignment[-2]
 
 
-def splitFastaFile(fastaFile, totalFiles, seqsPerFile, filesDir,
-                   prefix="", ext=".fasta", stream=None):
-    if not exists(os.path.join(filesDir, prefix + "part" + str(int(totalFiles)) + ext)) and \
-            not exists(os.path.join(filesDir, prefix + "part" + str(int(totalFiles)) + ".out")):
-        # Split the FASTA file into multiple chunks
-        printto(stream, "\tThe clones are distributed into multiple workers .. ")
-        if not os.path.isdir(filesDir):
-            os.makedirs(filesDir)
-        if hasLargeMem():
-            with safeOpen(fastaFile) as fp:
-                recordsAll = SeqIO.to_dict(SeqIO.parse(fp, 'fasta'))
-            queryIds = recordsAll.keys()
-        else:
-            # SeqIO.index can only open string filenames and they must be unzipped
-            recordsAll = SeqIO.index(gunzip(fastaFile), 'fasta')
-            # recordsAll.keys() is of type <dictionary-keyiterator object>, need to cast to list
-            queryIds = list(recordsAll.keys())
-        for i in range(totalFiles):
-            ids = queryIds[i * seqsPerFile: (i + 1) * seqsPerFile]
-            records = map(lambda x: recordsAll[x], ids)
-            out = os.path.join(filesDir, prefix + 'part' + str(i + 1) + ext)
-            SeqIO.write(records, out, 'fasta')
-
-
 def writeSummary(filename, key, value):
     if os.path.exists(filename):
         with open(filename) as fp:
@@ -810,11 +913,9 @@ def countSeqs(filename):
     _, ext = os.path.splitext(os.path.normpath(filename).replace(".gz", ""))
     ext = ext.lstrip(".")
     if ext in {"fasta", "fa"}:
-        with safeOpen(filename) as fp:
-            return sum([1 for _ in SeqIO.parse(fp, "fasta")])
+        return scanSeqFile(filename, "fasta")[0]
     elif ext in {"fastq", "fq"}:
-        with safeOpen(filename) as fp:
-            return sum([1 for _ in SeqIO.parse(fp, "fastq")])
+        return scanSeqFile(filename, "fastq")[0]
     else:
         raise ValueError("Unrecognized format {}, expected FASTA or FASTQ".format(ext))
 
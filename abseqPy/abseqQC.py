@@ -9,12 +9,14 @@
 
 import sys
 import time
+import argparse
 import traceback
 import warnings
 
 from datetime import timedelta
 
 from abseqPy.IgMultiRepertoire.IgMultiRepertoire import IgMultiRepertoire
+from abseqPy.IgMultiRepertoire.Executor import SharedQueueExecutor
 from abseqPy.argsParser import parseArgs
 from abseqPy.config import VERSION
 from abseqPy.utilities import PriorityPath
@@ -34,6 +36,22 @@ __version__ = VERSION
 #     fxn()
 
 
+def worker():
+    """
+    entry point of abseq-worker, runs the samples queued by abseq -Q / --queue on this host
+    """
+    parser = argparse.ArgumentParser(description="Runs the samples queued by abseq -Q / --queue QUEUE on this host,"
+                                                 " alongside the other hosts working the same queue")
+    parser.add_argument('queue', help="path to the job queue directory, on a filesystem shared with the other hosts")
+    parser.add_argument('-q', '--threads', help="number of threads the samples run by this host may use in total. "
+                                                "[default = 80%% of the CPUs of this host]", type=int, default=None)
+    parser.add_argument('-w', '--wait', help="if specified, keep waiting for new samples once the queue is empty",
+                        action='store_true')
+    args = parser.parse_args()
+    with PriorityPath():
+        SharedQueueExecutor(args.queue, threads=args.threads).work(wait=args.wait)
+
+
 def main():
     startTimeStr = time.strftime("%Y-%m-%d %H:%M:%S")
     startTime = time.time()
@@ -16,6 +16,7 @@ from copy import deepcopy
 
 from abseqPy.IgRepertoire.igRepUtils import inferSampleName, detectFileFormat, safeOpen
 from abseqPy.config import VERSION, DEFAULT_MERGER, DEFAULT_TOP_CLONE_VALUE, DEFAULT_TASK
+from abseqPy.utilities import parseMemorySize
 
 
 def parseArgs(arguments=None):
@@ -170,6 +171,17 @@ def parseArgs(arguments=None):
 
     args.database = os.path.abspath(args.database) if args.database is not None else "$IGBLASTDB"
 
+    args.queue = os.path.abspath(args.queue) if args.queue is not None else None
+
+    if args.memory is not None:
+        try:
+            args.memory = parseMemorySize(args.memory)
+        except ValueError:
+            parser.error("Unrecognized -mem / --memory value {}, expected a size such as 8G or 512M"
+                         .format(args.memory))
+        if args.memory <= 0:
+            parser.error("-mem / --memory must be a positive size")
+
     # done
     return args
 
@@ -306,6 +318,23 @@ def parseCommandLineArguments(arguments=None):
                           default=None)
     optional.add_argument('-q', '--threads', help="number of threads to use (spawns separate processes). [default=1]",
                           type=int, default=1)
+    optional.add_argument('-dd', '--dedup', help="if specified, identical reads are collapsed before annotation and "
+                                                "refinement, and only one read of every group of identical reads "
+                                                "is aligned and refined. All outputs are the same as those of a "
+                                                "run without this option. [default = no collapsing]",
+                          action='store_true')
+    optional.add_argument('-mem', '--memory', help="memory budget of the run, EG: 8G or 512M (a number without a unit "
+                                                   "is in GB). Chunk sizes, buffering and the number of worker "
+                                                   "processes are chosen to stay within it, it is shared evenly "
+                                                   "between the samples of a YAML file. [default=the memory limit of "
+                                                   "the container (cgroup) or the physical memory of the host]",
+                          default=None)
+    optional.add_argument('-Q', '--queue', help="path to a job queue directory on a filesystem shared by several "
+                                                "hosts. The samples are queued there and run by this host and by "
+                                                "every host running abseq-worker on the same directory, their "
+                                                "outdir must be on the shared filesystem too. "
+                                                "[default = all samples run on this host]",
+                          default=None)
     optional.add_argument('-v', '--version', action='version', version='%(prog)s ' + VERSION)
     optional.add_argument('-h', '--help', action='help', help="show this help message and exit")
     return parser, parser.parse_args() if arguments is None else parser.parse_args(arguments)
@@ -134,6 +134,13 @@ else:
     tmp = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')  # e.g. 4015976448
     MEM_GB = tmp/GB
 
+# environment variable that holds the memory budget (in bytes) of the running process. It is an environment variable
+# rather than a module variable so that the processes spawned by a sample inherit the sample's budget
+MEM_BUDGET_ENV = 'ABSEQ_MEMORY_BUDGET'
+
+# environment variable that holds the path to the run statistics file of the running sample, see instrumentation.py
+RUN_STATS_ENV = 'ABSEQ_RUN_STATS'
+
 
 # SAMTOOLS_PROGRAM= 'samtools'
 # BGZIP = 'bgzip'
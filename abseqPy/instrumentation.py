@@ -0,0 +1,213 @@
+'''
+    Short description: Quality Control Analysis of Immunoglobulin Repertoire NGS (Paired-End MiSeq)
+    Author: Monther Alhamdoosh
+    Python Version: 2.7
+    Changes log: check git commits.
+'''
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import threading
+
+from multiprocessing import current_process
+
+from abseqPy.config import RUN_STATS_ENV
+
+try:
+    import resource
+except ImportError:
+    # windows, peak RSS is not reported
+    resource = None
+
+
+def setRunStats(filename):
+    """
+    sets the file the StageTimers of this process, and of the processes it spawns from now on, append their records
+    to. The file is emptied
+
+    :param filename: string. path to the run statistics file, None disables the records
+    :return: None
+    """
+    if filename is None:
+        os.environ.pop(RUN_STATS_ENV, None)
+        return
+    open(filename, 'w').close()
+    os.environ[RUN_STATS_ENV] = filename
+
+
+def runStatsFile():
+    """
+    :return: string. path to the run statistics file set by setRunStats, None if there is none
+    """
+    return os.environ.get(RUN_STATS_ENV) or None
+
+
+def loadRunStats(filename):
+    """
+    :param filename: string. path to a run statistics file
+    :return: list of the records (dicts, see StageTimer) in the file, in the order they were written
+    """
+    records = []
+    if filename is None or not os.path.exists(filename):
+        return records
+    with open(filename) as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # the last line of a process that was killed while writing it
+                continue
+    return records
+
+
+class StageTimer(object):
+    """
+    measures a stage (or the share of a stage run by one worker) and appends its record to the run statistics file
+    once the stage is done, if one was set (see setRunStats). Records are dicts of:
+
+        stage, worker (name of the process, or of the thread, that ran it), start (epoch seconds),
+        wallTime and cpuTime (user + system seconds of this process) of the stage,
+        childCpuTime (seconds of the external programs it ran and waited for, e.g. IgBLAST),
+        records (number of records processed, None if the stage does not count them) and recordsPerSecond,
+        peakRss (bytes, the high-water mark of the process, or of the largest external program, so far),
+        bytesRead and bytesWritten (I/O of the process, files and pipes alike, plus the files of external programs
+        declared with addRead and addWritten) and
+        queueDepth (largest depth of the queue the stage takes its work from, see observeQueue),
+        cacheHits and cacheMisses (lookups of the caches of the stage, None if it has none, see countCache).
+
+    CPU time and I/O are counted per process: stages that run at the same time in threads of the same process
+    (e.g. IgBLAST alignment and parsing) share them
+
+    >>> with StageTimer("example", records=0) as timer:
+    ...     timer.records += 10
+    >>> timer.record['records'], timer.record['stage']
+    (10, 'example')
+    """
+
+    def __init__(self, stage, worker=None, records=None):
+        """
+        :param stage: string. stage name
+        :param worker: string. worker name, defaults to the name of the current process (and thread, if it is not
+        the main thread)
+        :param records: int. number of records processed, can also be updated while the stage runs
+        """
+        self.stage = stage
+        self.worker = worker if worker is not None else _workerName()
+        self.records = records
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.queueDepth = None
+        self.cacheHits = None
+        self.cacheMisses = None
+        self.record = None
+
+    def addRead(self, *paths):
+        """
+        adds the size of files read by an external program to the bytes read by the stage
+        """
+        self.bytesRead += sum(os.path.getsize(p) for p in paths if p is not None and os.path.isfile(p))
+
+    def addWritten(self, *paths):
+        """
+        adds the size of files written by an external program to the bytes written by the stage
+        """
+        self.bytesWritten += sum(os.path.getsize(p) for p in paths if p is not None and os.path.isfile(p))
+
+    def observeQueue(self, queue=None, depth=None):
+        """
+        :param queue: multiprocessing (or threading) queue, its depth is taken if depth is not given. Platforms
+        that do not implement qsize (macOS) are ignored
+        :param depth: int. depth of the queue
+        :return: None
+        """
+        if depth is None:
+            try:
+                depth = queue.qsize()
+            except NotImplementedError:
+                return
+        self.queueDepth = depth if self.queueDepth is None else max(self.queueDepth, depth)
+
+    def countCache(self, hits, misses):
+        """
+        adds the lookups of a cache of the stage (e.g. a memo of matched primer windows) to the stage statistics
+
+        :param hits: int. number of lookups the cache answered
+        :param misses: int. number of lookups it did not
+        :return: None
+        """
+        self.cacheHits = (self.cacheHits or 0) + hits
+        self.cacheMisses = (self.cacheMisses or 0) + misses
+
+    def __enter__(self):
+        self._start = time.time()
+        self._times = os.times()
+        self._io = _ioCounters()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.time() - self._start
+        times = os.times()
+        io = _ioCounters()
+        self.record = {
+            'stage': self.stage,
+            'worker': self.worker,
+            'start': self._start,
+            'wallTime': wall,
+            'cpuTime': (times[0] - self._times[0]) + (times[1] - self._times[1]),
+            'childCpuTime': (times[2] - self._times[2]) + (times[3] - self._times[3]),
+            'records': self.records,
+            'recordsPerSecond': self.records / wall if self.records is not None and wall > 0 else None,
+            'peakRss': _peakRss(),
+            'bytesRead': self.bytesRead + ((io[0] - self._io[0]) if io is not None else 0),
+            'bytesWritten': self.bytesWritten + ((io[1] - self._io[1]) if io is not None else 0),
+            'queueDepth': self.queueDepth,
+            'cacheHits': self.cacheHits,
+            'cacheMisses': self.cacheMisses,
+            'failed': exc_type is not None
+        }
+        filename = runStatsFile()
+        if filename is not None:
+            try:
+                # a single write of a short line, so that the records of concurrent processes do not interleave
+                with open(filename, 'a') as fp:
+                    fp.write(json.dumps(self.record) + "\n")
+            except (IOError, OSError):
+                # the statistics are never worth failing a stage for
+                pass
+        return False
+
+
+def _workerName():
+    name = current_process().name
+    thread = threading.current_thread()
+    if thread.name != 'MainThread':
+        name += "/" + thread.name
+    return name
+
+
+def _ioCounters():
+    """
+    :return: (bytes read, bytes written) tuple of this process so far, None if the platform does not tell
+    """
+    try:
+        with open("/proc/self/io") as fp:
+            counters = dict(line.split(":") for line in fp if ":" in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _peakRss():
+    """
+    :return: int. largest resident set size (bytes) of this process and of the child processes it waited for, so
+    far, None if the platform does not tell
+    """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -78,8 +78,8 @@ def formattedTitle(task, defaultTitle=False):
         raise Exception("Unknown task requested. Available tasks are: {}".format(','.join(_BANNER.keys())))
     string = "-" * 100 + '\n'
     string += "|" + " " * 98 + "|\n"
-    string += "|" + " " * ((98 - len(title)) / 2) + title + " " * (
-            (98 - len(title)) / 2 + (98 - len(title)) % 2) + "|\n"
+    string += "|" + " " * ((98 - len(title)) // 2) + title + " " * (
+            (98 - len(title)) // 2 + (98 - len(title)) % 2) + "|\n"
     string += "|" + " " * 98 + "|\n"
     string += "-" * 100 + '\n'
     return string
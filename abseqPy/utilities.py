@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import os
+import re
 import sys
 import subprocess
 import shlex
@@ -8,8 +9,25 @@ import platform
 import functools
 import importlib
 
+from contextlib import contextmanager
+from multiprocessing import BoundedSemaphore, Lock
+from numbers import Integral
+
 from abseqPy.config import ABSEQROOT, EXTERNAL_DEP_DIR
-from abseqPy.config import MEM_GB
+from abseqPy.config import MEM_GB, GB, MEM_BUDGET_ENV
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+# cgroup v2 and v1 files holding the memory limit of the container we run in
+_CGROUP_LIMIT_FILES = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+# memory taken by a worker process before it is handed any data (interpreter, numpy, pandas and Biopython)
+WORKER_BASE_BYTES = 1 << 27
+# run-wide pool of CPU slots, see setCpuSlots: (semaphore, lock taken to acquire several slots, number of slots)
+_cpuSlots = None
 
 
 # temporarily overrides PATH variable with EXTERNAL_DEP_DIR/bin, IGBLASTDB and IGDATA (if they exist)
@@ -65,14 +83,201 @@ class PriorityPath:
             os.environ.update(self.old_env)
 
 
-def hasLargeMem(size=16):
+def parseMemorySize(size):
+    """
+    converts a human readable memory size to bytes. Sizes without a unit are in GB
+
+    :param size: string or number. EG: 8G, 512M, 1.5GB, 64GiB, 4096B or 16
+    :return: int. number of bytes
+
+    >>> parseMemorySize("8G") == 8 * 1024 ** 3
+    True
+    >>> parseMemorySize("512m") == 512 * 1024 ** 2
+    True
+    >>> parseMemorySize("1.5GiB") == int(1.5 * 1024 ** 3)
+    True
+    >>> parseMemorySize(16) == 16 * 1024 ** 3
+    True
+    >>> parseMemorySize("4096B")
+    4096
+    >>> parseMemorySize("lots")
+    Traceback (most recent call last):
+    ValueError: Unrecognized memory size lots
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([kmgt]?)(i?b)?\s*$', str(size), re.IGNORECASE)
+    if not match or (match.group(3) and match.group(3).lower() == 'ib' and not match.group(2)):
+        raise ValueError("Unrecognized memory size {}".format(size))
+    value, unit, suffix = match.groups()
+    if not unit:
+        # a bare number is in GB, a number followed by B is in bytes
+        exponent = 0 if suffix else 3
+    else:
+        exponent = 'kmgt'.index(unit.lower()) + 1
+    return int(float(value) * 1024 ** exponent)
+
+
+def cgroupMemoryLimit():
+    """
+    :return: int. memory limit (in bytes) of the cgroup (container) this process runs in, None if there is no limit
+    or it cannot be read
+    """
+    for limitFile in _CGROUP_LIMIT_FILES:
+        try:
+            with open(limitFile) as fp:
+                limit = fp.read().strip()
+        except (IOError, OSError):
+            continue
+        if limit.isdigit():
+            # cgroup v1 reports "no limit" as a huge number (close to 2^63) rather than "max"
+            return int(limit) if int(limit) < (1 << 60) else None
+        return None
+    return None
+
+
+def setMemoryBudget(size):
+    """
+    sets the memory budget of this process and of the processes it spawns from now on
+
+    :param size: int (bytes) or string (see parseMemorySize). None removes the budget, so that it is derived from
+    the cgroup limit or the physical memory again
+    :return: None
+    """
+    if size is None:
+        os.environ.pop(MEM_BUDGET_ENV, None)
+    else:
+        os.environ[MEM_BUDGET_ENV] = str(int(size) if isinstance(size, Integral) else parseMemorySize(size))
+
+
+def memoryBudget(environ=None):
+    """
+    the memory (in bytes) this process may use. It is the budget set by setMemoryBudget (see -mem/--memory) if
+    there is one, otherwise the cgroup memory limit, never more than the physical memory of the host
+
+    :param environ: mapping the budget is read from, defaults to os.environ (where setMemoryBudget puts it)
+    :return: int. memory budget in bytes
+
+    >>> memoryBudget({MEM_BUDGET_ENV: str(2 * 1024 ** 3)}) == 2 * 1024 ** 3
+    True
+    >>> memoryBudget({}) <= MEM_GB * GB
+    True
+    """
+    budget = (os.environ if environ is None else environ).get(MEM_BUDGET_ENV)
+    if budget:
+        return int(budget)
+    physical = int(MEM_GB * GB)
+    limit = cgroupMemoryLimit()
+    return min(limit, physical) if limit is not None else physical
+
+
+def fitsInMemory(size, fraction=0.5):
     """
-    tells if system has memory strictly larger than specified size in GB
+    tells if size bytes fit within a fraction of the memory budget
 
-    :param size: unit GB
-    :return: bool. true if virtual_memory > size
+    :param size: int. number of bytes
+    :param fraction: float. share of the memory budget that size may take
+    :return: bool
+    """
+    return size <= memoryBudget() * fraction
+
+
+def ioBufferSize(preferred=1 << 23, fraction=0.01):
+    """
+    size of the buffer of a file that is written in many small pieces
+
+    :param preferred: int. buffer size (in bytes) when memory is plentiful
+    :param fraction: float. share of the memory budget a single buffer may take
+    :return: int. buffer size to give to open(), -1 (system default) if the budget is too small for a larger one
+    """
+    size = min(preferred, int(memoryBudget() * fraction))
+    return size if size > (1 << 16) else -1
+
+
+def workersWithinBudget(threads, bytesPerWorker):
+    """
+    number of worker processes that can run at once without going over the memory budget
+
+    :param threads: int. number of workers asked for
+    :param bytesPerWorker: int. memory (in bytes) a worker holds on top of WORKER_BASE_BYTES
+    :return: int. between 1 and threads
+    """
+    return max(1, min(threads, int(memoryBudget() // (WORKER_BASE_BYTES + max(0, bytesPerWorker)))))
+
+
+def setCpuSlots(n):
+    """
+    sets up the run-wide pool of n CPU slots. The pool is inherited by every process forked afterwards (the workers
+    of all the samples and the processes they spawn). Chunk workers hold a slot while they analyse a chunk (see
+    cpuSlot), so that no more than n chunks are analysed at once across all the samples of the run, and the slots a
+    sample does not need are picked up, chunk by chunk, by the samples that still have work left.
+
+    A process killed while it holds slots never gives them back, chunk workers are therefore stopped with
+    stopWorkers rather than terminated
+
+    :param n: int. number of slots. None removes the pool, chunks are then analysed as soon as a worker is free
+    :return: None
+    """
+    global _cpuSlots
+    _cpuSlots = None if n is None else (BoundedSemaphore(max(1, int(n))), Lock(), max(1, int(n)))
+
+
+@contextmanager
+def cpuSlot(n=1):
+    """
+    holds n slots of the run-wide CPU pool (see setCpuSlots) for the duration of the with block, once they are
+    free. n is capped to the size of the pool. Does nothing if there is no pool
+
+    :param n: int. number of slots, e.g. the threads of an external program
+    """
+    if _cpuSlots is None:
+        yield
+        return
+    slots, lock, size = _cpuSlots
+    n = max(1, min(n, size))
+    if n == 1:
+        slots.acquire()
+    else:
+        # slots are taken one at a time: two processes gathering several slots at once could each end up holding
+        # some of the slots the other one waits for
+        with lock:
+            for _ in range(n):
+                slots.acquire()
+    try:
+        yield
+    finally:
+        for _ in range(n):
+            slots.release()
+
+
+def stopWorkers(workers, tasksQueue, resultsQueue=None):
+    """
+    stops chunk workers once they are done with the chunk they are on. The tasks they have not taken yet are
+    dropped and every worker gets a poison pill (None). Unlike Process.terminate, this never kills a worker while
+    it holds a CPU slot (see setCpuSlots), which would starve the other samples of the run.
+    Returns at once if the workers already exited
+
+    :param workers: list of Process objects that take their tasks from tasksQueue
+    :param tasksQueue: multiprocessing queue of the workers' tasks
+    :param resultsQueue: multiprocessing queue the workers put their results in. Results that are still coming
+    are dropped, a process does not exit before what it put in a queue was read
+    :return: None
     """
-    return MEM_GB > size
+    _drain(tasksQueue)
+    for _ in workers:
+        tasksQueue.put(None)
+    while any(w.is_alive() for w in workers):
+        if resultsQueue is not None:
+            _drain(resultsQueue)
+        for w in workers:
+            if w.is_alive():
+                w.join(0.1)
+
+
+def _drain(queue):
+    while True:
+        try:
+            queue.get(timeout=0.01)
+        except Empty:
+            return
 
 
 class CommandLine:
@@ -62,7 +62,7 @@ setup(name="abseqPy",
                    ] if platform.system() != "Windows" else []),
       include_package_data=True,
       entry_points={
-          'console_scripts': ['abseq=abseqPy.abseqQC:main'],
+          'console_scripts': ['abseq=abseqPy.abseqQC:main', 'abseq-worker=abseqPy.abseqQC:worker'],
       },
       classifiers=[
             "Programming Language :: Python :: 2.7",
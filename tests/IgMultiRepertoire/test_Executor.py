@@ -0,0 +1,70 @@
+import os
+
+from multiprocessing import Process
+
+import pytest
+
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker, AbSeqWorkerException
+from abseqPy.IgMultiRepertoire.Executor import SharedQueueExecutor
+from abseqPy.IgMultiRepertoire.TaskGraph import TaskGraph
+
+
+class _Sample(object):
+    # stands in for IgRepertoire, its only task records the process that ran it
+    def __init__(self, name, outDir, crash=False):
+        self.name = name
+        self.task = 'fastqc'
+        self.threads = 1
+        self.memory = None
+        self.hdfDir = self.auxDir = outDir
+        self.args = {'threads': 1, 'memory': None, 'log': os.path.join(outDir, name + ".log")}
+        self.crash = crash
+        self._tasks = TaskGraph([AbSeqWorker.FASTQC], AbSeqWorker.io, AbSeqWorker.providers)
+
+    def runFastqc(self):
+        with open(os.path.join(self.auxDir, self.name + ".runs"), 'a') as fp:
+            fp.write(str(os.getpid()) + "\n")
+        if self.crash:
+            raise ValueError("the sample crashed")
+
+    def _minimize(self):
+        pass
+
+
+def _work(queueDir):
+    SharedQueueExecutor(queueDir, threads=1, poll=0.05).work()
+
+
+def _runs(sample):
+    path = os.path.join(sample.auxDir, sample.name + ".runs")
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        return fp.read().split()
+
+
+def test_sharedQueueExecutor_runs_every_job_once(tmpdir):
+    queueDir = str(tmpdir.join("queue"))
+    outDir = str(tmpdir.mkdir("out"))
+    samples = [_Sample("sample" + str(i), outDir, crash=(i == 3)) for i in range(8)]
+    executor = SharedQueueExecutor(queueDir, poll=0.05)
+    jobs = executor.submit(samples)
+
+    hosts = [Process(target=_work, args=(queueDir,)) for _ in range(3)]
+    for host in hosts:
+        host.start()
+    for host in hosts:
+        host.join(120)
+        assert host.exitcode == 0
+
+    assert all(len(_runs(sample)) == 1 for sample in samples)
+    # every host took a share of the samples
+    assert len(set(pid for sample in samples for pid in _runs(sample))) > 1
+    for state in (SharedQueueExecutor.PENDING, SharedQueueExecutor.RUNNING):
+        assert os.listdir(os.path.join(queueDir, state)) == []
+    assert sorted(os.listdir(os.path.join(queueDir, SharedQueueExecutor.FAILED))) == [jobs[3] + ".pkl"]
+
+    done = [job for i, job in enumerate(jobs) if i != 3]
+    assert [rep.name for rep in executor.collect(done)] == [samples[i].name for i in range(8) if i != 3]
+    with pytest.raises(AbSeqWorkerException):
+        executor.collect(jobs)
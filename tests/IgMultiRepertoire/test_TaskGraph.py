@@ -0,0 +1,65 @@
+from abseqPy.IgMultiRepertoire.AbSeqWorker import AbSeqWorker as W
+from abseqPy.IgMultiRepertoire.TaskGraph import TaskGraph
+
+
+def _graph(todo):
+    return TaskGraph(todo, W.io, W.providers)
+
+
+def _methods(tasks):
+    return [task.method for task in tasks]
+
+
+def _runInOrder(graph):
+    # runs the ready tasks one at a time, returns the order they ran in
+    order = []
+    while len(graph):
+        task = graph.ready()[0]
+        order.append(task.method)
+        graph.done(task)
+    return order
+
+
+def test_taskGraph_runs_tasks_after_their_dependencies():
+    graph = _graph([W.ANNOT, W.PROD, W.DIVER])
+    assert _methods(graph.tasks) == [W.MERGE, W.STORE, W.ANNOT, W.PROD, W.DIVER]
+    # every task depends on the one before it, there is never more than one ready
+    for task in graph.tasks:
+        assert _methods(graph.ready()) == [task.method]
+        graph.done(task)
+    assert len(graph) == 0 and graph.ready() == []
+
+
+def test_taskGraph_adds_the_providers_of_missing_resources():
+    graph = _graph([W.SEQLEN])
+    assert _methods(graph.tasks) == [W.MERGE, W.SEQLEN]
+    merge, seqLen = graph.tasks
+    assert seqLen.deps == {merge}
+
+    # providers are added once, before the first task that needs them
+    graph = _graph([W.ABUN, W.ANNOT])
+    assert _methods(graph.tasks) == [W.MERGE, W.STORE, W.ABUN, W.ANNOT]
+    # nothing provides the clone annotation, the abundance analysis annotates the clones on demand
+    abun, annot = graph.tasks[2:]
+    assert W.ANNOTATION in abun.produces and abun in annot.deps
+    assert _runInOrder(graph) == [W.MERGE, W.STORE, W.ABUN, W.ANNOT]
+
+    # requested providers are not added again
+    graph = _graph([W.MERGE, (W.ANNOT, {})])
+    assert _methods(graph.tasks) == [W.MERGE, W.STORE, W.ANNOT]
+
+
+def test_taskGraph_leaves_are_ready_together():
+    graph = _graph([W.FASTQC, W.ANNOT, W.ABUN, (W.SECR, {'upstream': [1, 10]}), W.UTR5])
+    fastqc, merge, store, annot, abun, secr, utr5 = graph.tasks
+    assert repr(secr) == "analyzeSecretionSignal(upstream=[1, 10])"
+    # the quality control does not share a resource with anything
+    assert graph.ready() == [fastqc, merge]
+    assert graph.ready(running=[fastqc]) == [merge]
+    for task in (merge, store, annot):
+        assert graph.hasDependents(task)
+        graph.done(task)
+    assert graph.ready(running=[fastqc]) == [abun, secr, utr5]
+    assert not any(graph.hasDependents(task) for task in (fastqc, abun, secr, utr5))
+    graph.done(secr)
+    assert graph.ready() == [fastqc, abun, utr5] and len(graph) == 3
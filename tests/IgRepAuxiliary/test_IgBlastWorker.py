@@ -0,0 +1,80 @@
+import os
+
+import abseqPy.IgRepertoire.igRepUtils as igRepUtils
+
+from abseqPy.IgRepAuxiliary.IgBlastWorker import IgBlastWorker, _AlignmentThread, loadCachedChunk
+
+
+def _igblastOutput(queryIds):
+    # the V hit of a heavy chain query, in -outfmt 7
+    lines = []
+    for queryId in queryIds:
+        lines += [
+            "# IGBLASTN 2.7.1+",
+            "# Query: " + queryId,
+            "# V-(D)-J rearrangement summary for query sequence (Top V gene match, Top D gene match, "
+            "Top J gene match, Chain type, stop codon, V-J frame, Productive, Strand).",
+            "\t".join(["IGHV3-23*01", "IGHD3-10*01", "IGHJ4*02", "VH", "No", "In-frame", "Yes", "+"]),
+            "# Alignment summary between query and top germline V gene hit (from, to, length, matches, mismatches, "
+            "gaps, percent identity)",
+            "\t".join(["FR1-IMGT", "1", "75", "75", "75", "0", "0", "100"]),
+            "# Hit table (the first field indicates the chain type of the hit)",
+            "# Fields: query id, subject id, % identity, alignment length, mismatches, gap opens, gaps, q. start, "
+            "q. end, s. start, s. end, evalue, bit score",
+            "# 1 hits found",
+            "\t".join(["V", queryId, "IGHV3-23*01", "100.00", "296", "0", "0", "0", "1", "296", "1", "296",
+                       "1e-100", "500"]),
+        ]
+    return "\n".join(lines) + "\n"
+
+
+class _Results(list):
+    def put(self, item):
+        self.append(item)
+
+
+def _alignStaleChunk(tmpdir, monkeypatch, cacheFile):
+    # aligns part1.fasta (read "fresh") next to the part1.out a previous run left behind (read "stale")
+    aligned = []
+
+    def buildIgBLASTCommand(igdata, db, chain, species, domainSystem, blastInput, blastOutput, threads, **kwargs):
+        def command(**_):
+            aligned.append(blastInput)
+            with open(blastInput) as fasta:
+                queryIds = [line[1:].strip() for line in fasta if line.startswith(">")]
+            with open(blastOutput, "w") as out:
+                out.write(_igblastOutput(queryIds))
+        return command
+
+    monkeypatch.setattr(igRepUtils, "buildIgBLASTCommand", buildIgBLASTCommand)
+    fastaFile = str(tmpdir.join("part1.fasta"))
+    with open(fastaFile, "w") as fp:
+        fp.write(">fresh\nACGT\n")
+    with open(str(tmpdir.join("part1.out")), "w") as fp:
+        fp.write(_igblastOutput(["stale"]))
+
+    worker = IgBlastWorker("hv", str(tmpdir), "dna", 1)
+    worker.resultsQueue = _Results()
+    aligner = _AlignmentThread((0, fastaFile, cacheFile, 1), worker)
+    aligner.run()
+    worker._parse(aligner)
+
+    assert aligned == [fastaFile]
+    index, (cloneAnnot, filteredIDs) = worker.resultsQueue[0]
+    assert index == 0 and list(cloneAnnot.index) == ["fresh"] and filteredIDs == []
+    assert not os.path.exists(fastaFile)
+    return aligner
+
+
+def test_stale_output_is_realigned_on_cache_miss(tmpdir, monkeypatch):
+    cacheFile = str(tmpdir.join("cache", "digest.h5"))
+    aligner = _alignStaleChunk(tmpdir, monkeypatch, cacheFile)
+    assert list(loadCachedChunk(cacheFile)[0].index) == ["fresh"]
+    # the cache entry replaces the output
+    assert not os.path.exists(aligner.blastOutput)
+
+
+def test_stale_output_is_realigned_without_cache(tmpdir, monkeypatch):
+    aligner = _alignStaleChunk(tmpdir, monkeypatch, None)
+    with open(aligner.blastOutput) as fp:
+        assert "stale" not in fp.read()
@@ -0,0 +1,294 @@
+import random
+
+from collections import defaultdict
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from numpy import isnan, nan
+from pandas import DataFrame
+
+from abseqPy.config import FR4_CONSENSUS, FR4_CONSENSUS_DNA
+from abseqPy.IgRepertoire.igRepUtils import extractProteinFrag, findBestAlignment, extractCDRsandFRsProtein, \
+    findBestMatchedPattern
+from abseqPy.IgRepAuxiliary.IgBlastWorker import getAnnotationFields, convertCloneRecordToOrderedList
+from abseqPy.IgRepAuxiliary.RefineWorker import refineChunk, _parse3EndSeqs, _recordFRLength, _defaultdefaultInt
+from abseqPy.IgRepAuxiliary.productivityAuxiliary import loadRefineFlagInfo
+
+
+# the refinement of a single clone, as it was before refineChunk: refineChunk must give the same results
+
+
+def refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut, trim5End, trim3End, flags):
+    seqs = [record.id, qsRec['vgene']]
+
+    if qsRec['chain'] in ['VH', 'VK', 'VL']:
+        chain = qsRec['chain']
+    else:
+        # convert hv, kv, lv and klv to VH, VK, or VL
+        if chain == 'klv':
+            if 'K' in qsRec['vgene']:
+                chain = "VK"
+            else:
+                chain = "VL"
+        else:
+            chain = chain[::-1].upper()
+
+    try:
+        if qsRec['strand'] == "reversed":
+            record = SeqRecord(record.seq.reverse_complement(), id=record.id, name="", description="")
+
+        record = record[trim5End:]
+        if isinstance(trim3End, int):
+            record = record[:(len(record) - trim3End)]
+
+        if actualQstart > -1:
+            offset = actualQstart
+        else:
+            offset = int(qsRec['vqstart'] - qsRec['vstart'])
+        if offset < 0:
+            offset = 0
+        vh = record.seq[offset:]
+
+        if len(vh) % 3 != 0:
+            vh = vh[:-1 * (len(vh) % 3)]
+        protein = str(vh.translate())
+
+        if qsRec['vqstart'] != qsRec['fr1.start']:
+            flags['fr1NotAtBegin'] += [record.id]
+        qsRec['fr1.start'] = offset + 1
+
+        if isnan(qsRec['fr4.end']):
+            searchRegion = extractProteinFrag(protein, qsRec['fr3.end'] + 1, -1, offset, trimAtStop=False)
+            if searchRegion is None:
+                raise Exception("ERROR: undefined search region to find FR4 consensus.")
+
+            qsRec['cdr3.start'] = qsRec['fr3.end'] + 1
+
+            fr4start, fr4end, gapped = findBestAlignment(searchRegion, FR4_CONSENSUS[chain], dna=False)
+
+            if not gapped and fr4start != -1 and fr4end != -1 and fr4end > fr4start:
+                qsRec['fr4.start'] = (fr4start - 1) * 3 + qsRec['fr3.end'] + 1
+                qsRec['cdr3.end'] = qsRec['fr4.start'] - 1
+                fr4end = qsRec['fr3.end'] + fr4end * 3
+            else:
+                searchRegion = str(record.seq)[int(qsRec['fr3.end']):]
+                fr4start, fr4end, gapped = findBestAlignment(searchRegion, FR4_CONSENSUS_DNA[chain], dna=True)
+
+                if fr4start != -1 and fr4end != -1 and fr4end > fr4start:
+                    qsRec['fr4.start'] = qsRec['fr3.end'] + fr4start
+                    qsRec['cdr3.end'] = qsRec['fr4.start'] - 1
+                    flags['CDR3dna'] += [record.id]
+                    fr4end = qsRec['fr3.end'] + fr4end
+                else:
+                    qsRec['cdr3.end'] = qsRec['jqend']
+                    fr4end = nan
+
+            if not fr4cut:
+                if not isinstance(trim3End, int):
+                    _, _, _, relativeFR4EndPosition, _ = \
+                        findBestMatchedPattern(str(record.seq)[int(qsRec['cdr3.end']):], trim3End, extend5end=True)
+                    if relativeFR4EndPosition == -1:
+                        flags['FR4endless'] += [record.id]
+                        qsRec['fr4.end'] = fr4end
+                    else:
+                        qsRec['fr4.end'] = qsRec['cdr3.end'] + relativeFR4EndPosition
+                        if qsRec['fr4.end'] < qsRec['jqend']:
+                            flags['FR4cutEarly'] += [record.id]
+                            qsRec['fr4.end'] = fr4end
+                else:
+                    qsRec['fr4.end'] = len(record.seq)
+            else:
+                if isnan(fr4end):
+                    qsRec['FR4PredictedError'] += [record.id]
+                qsRec['fr4.end'] = fr4end
+
+        (protein, tmp) = extractCDRsandFRsProtein(protein, qsRec, offset)
+        seqs += tmp
+        if seqs[-1][:4] != FR4_CONSENSUS[chain][:4]:
+            flags['fr4NotAsExpected'] += [record.id]
+        if seqs[-1] == '':
+            flags['noFR4'] += [record.id]
+
+        if '*' in protein:
+            flags['endsWithStopCodon'] += [record.id]
+            if qsRec['stopcodon'] == 'No':
+                flags['updatedStopCodon'] += [record.id]
+                qsRec['stopcodon'] = 'Yes'
+
+        gaps = int(abs(qsRec['vqstart'] - qsRec['vstart']) - offset)
+        mismatches = qsRec['vstart'] - 1
+        if qsRec['vstart'] > qsRec['vqstart'] and gaps > 0:
+            mismatches -= gaps
+
+        if gaps > 0:
+            qsRec['fr1.gaps'] += gaps
+            qsRec['vgaps'] += gaps
+
+        if mismatches > 0:
+            qsRec['fr1.mismatches'] += mismatches
+            qsRec['vmismatches'] += mismatches
+            qsRec['vstart'] -= mismatches
+            qsRec['vqstart'] -= mismatches
+    except Exception as e:
+        if "partitioning" in str(e):
+            flags['partitioning'] += [record.id]
+    return seqs
+
+
+def refineInFramePrediction(qsRec, record, actualQstart, flags):
+    inframe = True
+
+    if (qsRec['v-jframe'] == 'N/A' or
+            (not isinstance(qsRec['v-jframe'], str) and isnan(qsRec['v-jframe']))):
+        flags['updatedInFrameNA'] += [record.id]
+        inframe = False
+
+    offset = int(qsRec['vqstart'] - qsRec['vstart']) + 1
+    if (inframe and (offset < 1 or
+                     (actualQstart != -1 and (offset - 1 - actualQstart) % 3 != 0))):
+        inframe = False
+        flags['updatedInFrameConc'] += [record.id]
+
+    if (inframe and (isnan(qsRec['fr4.start']) or
+                     isnan(qsRec['fr4.end']) or isnan(qsRec['cdr3.start']) or
+                     qsRec['cdr3.start'] >= qsRec['cdr3.end'])):
+        inframe = False
+        flags['updatedInFrameNo3or4'] += [record.id]
+
+    if (inframe and ((qsRec['fr4.end'] - qsRec['fr1.start'] + 1) % 3 != 0 or
+                     (actualQstart != -1 and
+                      ((qsRec['fr4.end'] - actualQstart) % 3 != 0)))):
+        inframe = False
+        flags['updatedInFrame3x'] += [record.id]
+
+    if (inframe and (
+            qsRec['fr1.gaps'] % 3 != 0 or
+            qsRec['fr2.gaps'] % 3 != 0 or
+            qsRec['fr3g.gaps'] % 3 != 0 or
+            qsRec['cdr1.gaps'] % 3 != 0 or
+            qsRec['cdr2.gaps'] % 3 != 0 or
+            (not isnan(qsRec['cdr3g.gaps']) and qsRec['cdr3g.gaps'] % 3 != 0)
+    )):
+        inframe = False
+        flags['updatedInFrameIndel'] += [record.id]
+
+    if not inframe:
+        qsRec['v-jframe'] = 'Out-of-frame'
+        flags['updatedInFrame'] += [record.id]
+
+    return inframe
+
+
+def _refineClones(annot, records, actualQstart, chain, fr4cut, trim5End, trim3End, flags):
+    # the loop of RefineWorker.run before refineChunk
+    qsRecs, seqsAll = [], []
+    recordLengths = defaultdict(_defaultdefaultInt)
+    for record, queryId in zip(records, annot.index):
+        qsRec = annot.loc[queryId].to_dict()
+        seqs = refineCloneAnnotation(qsRec, record, actualQstart, chain, fr4cut, trim5End, trim3End, flags)
+        if qsRec['v-jframe'] != 'Out-of-frame':
+            if refineInFramePrediction(qsRec, record, actualQstart, flags):
+                _recordFRLength(qsRec, recordLengths)
+        qsRec['queryid'] = record.id
+        qsRecs.append(convertCloneRecordToOrderedList(qsRec, chain))
+        seqsAll.append(seqs)
+    return qsRecs, seqsAll, recordLengths
+
+
+def _clone(rng, queryId, chain):
+    # a clone annotation as IgBLAST would have it, with its read. Most of them can be partitioned, some have no FR4
+    # (which is then searched for) and some have odd or missing values
+    vqstart, vstart = rng.randint(1, 6), rng.choice([1, 1, 2, 3, 5])
+    offset = max(0, vqstart - vstart)
+    starts = [offset + 1]
+    for length in (75, 24, 51, 24, 114, rng.choice([30, 36, 45]), 33):
+        starts.append(starts[-1] + length + rng.choice([0, 0, 0, 3, -3, 1]))
+    (fr1, cdr1, fr2, cdr2, fr3, cdr3, fr4), end = [(s, e - 1) for s, e in zip(starts, starts[1:])], starts[-1] - 1
+    length = end + rng.randint(0, 40)
+    seq = [rng.choice("ACGT") for _ in range(length)]
+    if rng.random() < 0.7:
+        consensus = FR4_CONSENSUS_DNA['VH' if chain == 'hv' else rng.choice(['VK', 'VL'])].replace("N", "A")
+        at = fr4[0] - 1
+        seq[at:at + len(consensus)] = consensus
+    seq = "".join(seq[:length])
+    strand = rng.choice(["forward", "forward", "reversed"])
+    rec = dict.fromkeys(getAnnotationFields(chain), 0)
+    rec.update({
+        'vgene': rng.choice(['IGHV1-2*01', 'IGKV1-5*03', 'IGLV2-14*01']), 'jgene': rng.choice(['IGHJ4*02', 'IGKJ1*01']),
+        'vqstart': vqstart, 'vstart': vstart,
+        'vmismatches': rng.randint(0, 5), 'vgaps': rng.choice([0, 0, 1, 3]),
+        'identity': rng.uniform(80, 100), 'alignlen': 290, 'bitscore': rng.uniform(200, 500),
+        'chain': rng.choice(['VH', 'VK', 'VL', 'N/A']) if chain != 'hv' else rng.choice(['VH'] * 5 + ['N/A']),
+        'jqstart': fr4[0] - 10, 'jqend': fr4[1] - rng.choice([0, 3]), 'jstart': 1, 'jend': 48,
+        'strand': strand, 'stopcodon': rng.choice(['No', 'No', 'Yes']),
+        'v-jframe': rng.choice(['In-frame', 'In-frame', 'Out-of-frame', 'N/A']),
+        'fr1.start': fr1[0] + rng.choice([0, 0, 0, 1]), 'fr1.end': fr1[1], 'cdr1.start': cdr1[0], 'cdr1.end': cdr1[1],
+        'fr2.start': fr2[0], 'fr2.end': fr2[1], 'cdr2.start': cdr2[0], 'cdr2.end': cdr2[1],
+        'fr3.start': fr3[0], 'fr3g.end': fr3[1], 'fr3.end': fr3[1],
+        'cdr3g.start': cdr3[0], 'cdr3g.end': cdr3[0] + 8, 'cdr3g.gaps': rng.choice([0, 1, nan]),
+        'cdr3.start': cdr3[0], 'cdr3.end': cdr3[1], 'fr4.start': fr4[0], 'fr4.end': fr4[1],
+    })
+    for region in ('fr1', 'cdr1', 'fr2', 'cdr2', 'fr3g', 'fr4'):
+        rec[region + '.gaps'] = rng.choice([0, 0, 0, 1, 3])
+        rec[region + '.mismatches'] = rng.randint(0, 3)
+    if chain == 'hv':
+        rec.update({'dgene': 'IGHD3-10*01', 'dqstart': cdr3[0] + 3, 'dqend': cdr3[0] + 12, 'dstart': 2})
+    if rng.random() < 0.4:
+        # FR4 was not annotated
+        rec['fr4.start'] = rec['fr4.end'] = nan
+        if rng.random() < 0.5:
+            rec['cdr3.start'] = rec['cdr3.end'] = nan
+    if rng.random() < 0.05:
+        rec['cdr1.start'] = rec['cdr1.end'] = nan
+    rec['queryid'] = queryId
+    read = Seq(seq) if strand == "forward" else Seq(seq).reverse_complement()
+    return rec, SeqRecord(read, id=queryId, name=queryId, description=queryId)
+
+
+def _chunk(rng, number, chain):
+    clones = [_clone(rng, "read" + str(i), chain) for i in range(number)]
+    fields = getAnnotationFields(chain)
+    annot = DataFrame([[rec[f] for f in fields] for rec, _ in clones], columns=fields).set_index('queryid')
+    return annot, [record for _, record in clones]
+
+
+def _same(a, b):
+    if isinstance(a, float) and isinstance(b, float) and isnan(a) and isnan(b):
+        return True
+    return a == b
+
+
+def _plain(recordLengths):
+    return dict((gene, dict((region, dict(counts)) for region, counts in regions.items()))
+                for gene, regions in recordLengths.items())
+
+
+def test_refineChunk_same_as_refining_clone_by_clone():
+    rng = random.Random(9)
+    flagNames, _ = loadRefineFlagInfo()
+    settings = [
+        # chain, actualQstart, fr4cut, trim5End, trim3End
+        ('hv', -1, True, 0, 0),
+        ('hv', -1, False, 0, 0),
+        ('hv', 2, True, 0, 0),
+        ('klv', -1, True, 2, 3),
+        ('kv', -1, False, 0, list(_parse3EndSeqs(['GGTGAGTCCTCA', 'ACCGTCTCCTCAGG']))),
+        ('hv', -1, False, 1, list(_parse3EndSeqs(['GTGACCGTGAGCAGC']))),
+    ]
+    for chain, actualQstart, fr4cut, trim5End, trim3End in settings:
+        annot, records = _chunk(rng, 60, chain)
+        expectedFlags = dict((f, []) for f in flagNames)
+        expected = _refineClones(annot.copy(), records, actualQstart, chain, fr4cut, trim5End, trim3End,
+                                 expectedFlags)
+        flags = dict((f, []) for f in flagNames)
+        rows, seqsAll, recordLengths = refineChunk(annot.copy(), records, actualQstart, chain, fr4cut, trim5End,
+                                                   trim3End, flags)
+        assert len(rows) == len(expected[0])
+        for row, expectedRow in zip(rows, expected[0]):
+            assert all(_same(a, b) for a, b in zip(row, expectedRow)), (row, expectedRow)
+        assert seqsAll == expected[1]
+        assert flags == expectedFlags
+        assert _plain(recordLengths) == _plain(expected[2])
+        # the chunk exercises the paths of the refinement
+        assert sum(len(s) == 9 for s in seqsAll) > 10
+        assert flags['updatedInFrame'] and flags['fr4NotAsExpected']
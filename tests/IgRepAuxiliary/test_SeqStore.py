@@ -0,0 +1,34 @@
+import os
+
+from abseqPy.IgRepAuxiliary.SeqStore import SeqStore
+
+
+def _writeFasta(path, records):
+    with open(path, "w") as fp:
+        for readId, seq in records:
+            fp.write(">" + readId + "\n" + seq + "\n")
+
+
+def test_seqStore_is_rebuilt_when_its_input_changes(tmpdir):
+    readFile = str(tmpdir.join("sample.fasta"))
+    storeDir = str(tmpdir.join("seqstore"))
+    _writeFasta(readFile, [("read1", "ACGT"), ("read2", "GGC")])
+    store = SeqStore.open(readFile, "fasta", storeDir)
+    assert list(store.ids) == ["read1", "read2"] and store.seq("read2") == "GGC"
+
+    # an unchanged input reuses the store
+    with open(os.path.join(storeDir, SeqStore.SEQUENCES), "w") as fp:
+        fp.write("N" * 7)
+    assert SeqStore.open(readFile, "fasta", storeDir).seq("read2") == "NNN"
+
+    # rewritten input, with the same size and a later modification time
+    _writeFasta(readFile, [("read1", "TTTT"), ("read3", "CAC")])
+    stat = os.stat(readFile)
+    os.utime(readFile, (stat.st_atime, stat.st_mtime + 10))
+    store = SeqStore.open(readFile, "fasta", storeDir)
+    assert list(store.ids) == ["read1", "read3"] and store.seq("read1") == "TTTT"
+
+    # stores built before the input was fingerprinted are rebuilt too
+    os.remove(os.path.join(storeDir, SeqStore.SOURCE))
+    assert SeqStore.open(readFile, "fasta", storeDir).seq("read3") == "CAC"
+    assert SeqStore.source(storeDir) == SeqStore.fingerprint(readFile)
@@ -0,0 +1,83 @@
+import os
+
+from abseqPy.IgRepAuxiliary.StageManifest import StageManifest
+
+
+def _write(path, content):
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def _run(manifestFile, root, params, inputs, dirs, outputs):
+    # a run of a stage that writes outputs (path -> content)
+    manifest = StageManifest(manifestFile, root)
+    manifest.begin(params, inputs, {}, dirs)
+    for path, content in outputs.items():
+        _write(path, content)
+    manifest.complete(dirs, {})
+
+
+def _setup(tmpdir):
+    root = str(tmpdir)
+    outDir = str(tmpdir.mkdir("out"))
+    reads = str(tmpdir.join("reads.fasta"))
+    _write(reads, ">read1\nACGT\n")
+    return root, outDir, reads, str(tmpdir.join("manifests", "stage.json"))
+
+
+def test_completed_stage_is_up_to_date(tmpdir):
+    root, outDir, reads, manifestFile = _setup(tmpdir)
+    output = os.path.join(outDir, "stage.csv")
+    _run(manifestFile, root, {'threshold': 5}, [reads], [outDir], {output: "a,b\n"})
+
+    manifest = StageManifest(manifestFile, root)
+    assert manifest.status == StageManifest.COMPLETE and manifest.digest() is not None
+    assert list(manifest.data['outputs']) == [os.path.relpath(output, root)]
+    # the same parameters and inputs, the stage is skipped
+    assert manifest.isUpToDate({'threshold': 5}, [reads], {})
+
+
+def test_changed_inputs_invalidate_a_completed_stage(tmpdir):
+    root, outDir, reads, manifestFile = _setup(tmpdir)
+    output = os.path.join(outDir, "stage.csv")
+    _run(manifestFile, root, {'threshold': 5}, [reads], [outDir], {output: "a,b\n"})
+    manifest = StageManifest(manifestFile, root)
+
+    assert not manifest.isUpToDate({'threshold': 6}, [reads], {})
+    assert not manifest.isUpToDate({'threshold': 5}, [reads], {'annotate': 'another digest'})
+    # same size, other content
+    _write(reads, ">read1\nTGCA\n")
+    stat = os.stat(reads)
+    os.utime(reads, (stat.st_atime, stat.st_mtime + 10))
+    assert not manifest.isUpToDate({'threshold': 5}, [reads], {})
+
+    # once the stage ran again with the new input, a changed output invalidates it too
+    manifest.clean([outDir])
+    assert not os.path.exists(output)
+    _run(manifestFile, root, {'threshold': 5}, [reads], [outDir], {output: "a,b\n"})
+    assert StageManifest(manifestFile, root).isUpToDate({'threshold': 5}, [reads], {})
+    _write(output, "a,b,c\n")
+    assert not StageManifest(manifestFile, root).isUpToDate({'threshold': 5}, [reads], {})
+
+
+def test_interrupted_stage_is_not_recorded(tmpdir):
+    root, outDir, reads, manifestFile = _setup(tmpdir)
+    previous = os.path.join(outDir, "other_stage.csv")
+    _write(previous, "written by another stage\n")
+    partial = os.path.join(outDir, "stage.csv")
+
+    # killed while writing its output
+    StageManifest(manifestFile, root).begin({'threshold': 5}, [reads], {}, [outDir])
+    _write(partial, "a,")
+
+    manifest = StageManifest(manifestFile, root)
+    assert manifest.status == StageManifest.RUNNING and manifest.digest() is None
+    assert not manifest.isUpToDate({'threshold': 5}, [reads], {})
+    # only what the interrupted run wrote is removed
+    manifest.clean([outDir])
+    assert not os.path.exists(partial) and os.path.exists(previous)
+
+    # killed while writing the manifest itself
+    _write(manifestFile, '{"status": "comp')
+    manifest = StageManifest(manifestFile, root)
+    assert manifest.status is None and not manifest.isUpToDate({'threshold': 5}, [reads], {})
@@ -0,0 +1,78 @@
+from __future__ import division
+
+import random
+
+import abseqPy.IgRepertoire.igRepUtils as igRepUtils
+
+from abseqPy.IgRepAuxiliary.annotateAuxiliary import annotateIGSeqRead
+from abseqPy.IgRepAuxiliary.dedupAuxiliary import collapseDuplicateReads, expandRepresentatives, \
+    expandRepresentativeIDs
+from abseqPy.IgRepertoire.igRepUtils import iterSeqFile
+
+
+def _igblastOutput(records):
+    # -outfmt 7 output whose hits depend on the sequence of the query only, like IgBLAST's. Queries with an N have
+    # no hits
+    lines = []
+    for queryId, seq in records:
+        lines += ["# IGBLASTN 2.7.1+", "# Query: " + queryId]
+        if "N" in seq:
+            lines.append("# 0 hits found")
+            continue
+        vGene = "IGHV3-23*01" if seq[0] in "AC" else "IGHV1-2*02"
+        mismatches = seq.count("G")
+        lines += [
+            "# V-(D)-J rearrangement summary for query sequence (Top V gene match, Top D gene match, "
+            "Top J gene match, Chain type, stop codon, V-J frame, Productive, Strand).",
+            "\t".join([vGene, "IGHD3-10*01", "IGHJ4*02", "VH", "No", "In-frame", "Yes", "+"]),
+            "# Alignment summary between query and top germline V gene hit (from, to, length, matches, mismatches, "
+            "gaps, percent identity)",
+            "\t".join(["FR1-IMGT", "1", str(len(seq)), str(len(seq)), str(len(seq) - mismatches), str(mismatches),
+                       "0", "{:.1f}".format(100 * (len(seq) - mismatches) / len(seq))]),
+            "# Hit table (the first field indicates the chain type of the hit)",
+            "# Fields: query id, subject id, % identity, alignment length, mismatches, gap opens, gaps, q. start, "
+            "q. end, s. start, s. end, evalue, bit score",
+            "# 1 hits found",
+            "\t".join(["V", queryId, vGene, "{:.2f}".format(100 * (len(seq) - mismatches) / len(seq)),
+                       str(len(seq)), str(mismatches), "0", "0", "1", str(len(seq)), "1", str(len(seq)), "1e-100",
+                       str(500 - mismatches)]),
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def _fakeIgBLAST(blastInput, blastOutput):
+    def command(**_):
+        with open(blastOutput, "w") as out:
+            out.write(_igblastOutput([(title.split()[0], seq) for title, seq in iterSeqFile(blastInput, "fasta")]))
+    return command
+
+
+def _annotate(fastaFile, outDir):
+    cloneAnnot, filteredIDs = annotateIGSeqRead(fastaFile, "hv", "db", 2, 7, outdir=outDir)
+    return cloneAnnot.sort_index(axis=1), filteredIDs
+
+
+def test_dedup_annotation_same_as_annotating_every_read(tmpdir, monkeypatch):
+    monkeypatch.setattr(igRepUtils, "buildIgBLASTCommand",
+                        lambda igdata, db, chain, species, domainSystem, blastInput, blastOutput, threads, **kwargs:
+                        _fakeIgBLAST(blastInput, blastOutput))
+    rng = random.Random(5)
+    distinct = ["".join(rng.choice("ACGT") for _ in range(rng.randint(20, 30))) for _ in range(12)] + \
+               ["ACGTNACGTACGTACGTACG", "TTTTTTTTTTTTTTTTTTTT"]
+    fastaFile = str(tmpdir.join("reads.fasta"))
+    with open(fastaFile, "w") as fp:
+        for i in range(60):
+            fp.write(">read{} sample=1\n{}\n".format(i, rng.choice(distinct)))
+
+    cloneAnnot, filteredIDs = _annotate(fastaFile, str(tmpdir.mkdir("all")))
+
+    representatives = collapseDuplicateReads(fastaFile, "fasta", uniqueFile=str(tmpdir.join("unique.fasta")))
+    assert list(representatives.index) == ["read" + str(i) for i in range(60)]
+    assert len(set(representatives.values)) < 60
+    uniqueAnnot, uniqueFilteredIDs = _annotate(str(tmpdir.join("unique.fasta")), str(tmpdir.mkdir("unique")))
+    assert len(uniqueAnnot) + len(uniqueFilteredIDs) == len(set(representatives.values))
+
+    expanded = expandRepresentatives(uniqueAnnot, representatives)
+    assert len(expanded) == len(cloneAnnot) and len(cloneAnnot) + len(filteredIDs) == 60
+    assert expanded.equals(cloneAnnot)
+    assert expandRepresentativeIDs(uniqueFilteredIDs, representatives) == filteredIDs
@@ -1,4 +1,10 @@
+import random
+import re
+
+from Bio.Seq import Seq
+
 from abseqPy.IgRepAuxiliary.restrictionAuxiliary import *
+from abseqPy.IgRepAuxiliary.SitesAutomaton import SitesAutomaton
 
 
 def test_loadRestrictionSites(tmpdir):
@@ -42,7 +48,6 @@ def test_replaceIUPACLetters():
 
 def test_findHits():
     # test simple definition of re.finditer
-    import re
     simple_seq = "ACGTACGT"
     site1 = re.compile(r"[ACG][ACG][GT]T")
     site2 = re.compile(r"[ACG][ACG][GT]TAC[GT][TA]")
@@ -51,3 +56,42 @@ def test_findHits():
 
     assert findHits(simple_seq, site1) == [0, 4]
     assert findHits(simple_seq, site2) == [0]
+
+
+def _scanEachSite(seq, sites):
+    # one site at a time, forward strand first
+    results = []
+    for site, siteRegex in sites.items():
+        hits, strand = findHits(seq, siteRegex), "forward"
+        if len(hits) == 0:
+            hits, strand = findHits(str(Seq(seq).reverse_complement()), siteRegex), "reversed"
+        results.append((site, hits, strand))
+    return results
+
+
+def test_sitesAutomaton(tmpdir):
+    tmp_file = str(tmpdir.mkdir("data").join("restruction_sites.txt"))
+    with open(tmp_file, 'w') as fp:
+        fp.write("BamHI\tGGATCC\n"          # palindrome
+                 "BsaI\tGGTCTC\n"
+                 "SfiI\tGGCCNNNNNGGCC\n"
+                 "AccI\tGTMKAC\n"
+                 "POLYA\tAAA\n"             # overlapping occurrences
+                 "ENZ5\tXFI\n"              # not IUPAC, scanned with its regex
+                 "ENZ6\tNNNNNNNNNNNN\n")    # too many expansions, scanned with its regex
+    sites = loadRestrictionSites(tmp_file)
+    automaton = SitesAutomaton(sites)
+    assert sorted(automaton.names[i] for i in automaton.fallback) == ["ENZ5", "ENZ6"]
+
+    rng = random.Random(24)
+    planted = ["GGATCC", "GGTCTC", "GAGACC", "GGCCATGCAGGCC", "GTCTAC", "AAAAAAA", "XFI"]
+    for _ in range(300):
+        seq = [rng.choice("ACGT") for _ in range(rng.randint(0, 80))]
+        for _ in range(rng.randint(0, 3)):
+            pos = rng.randint(0, len(seq))
+            seq[pos:pos] = list(rng.choice(planted))
+        if rng.random() < 0.1:
+            seq.append("N")
+        seq = "".join(seq)
+        seq = seq.lower() if rng.random() < 0.1 else seq
+        assert automaton.scan(seq) == _scanEachSite(seq, sites), seq
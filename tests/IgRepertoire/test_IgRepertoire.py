@@ -0,0 +1,100 @@
+import os
+
+from abseqPy.IgRepAuxiliary.StageManifest import StageManifest
+from abseqPy.IgRepertoire.IgRepertoire import STAGES, stagePaths
+
+# files written by a run of every stage of sample S, relative to its hdf and auxiliary directories
+_HDF_FILES = [
+    "annot/S_clones_annot.h5", "annot/S_unmapped_clones.txt", "annot/S_filtered_out_clones.txt", "annot/S_dedup.h5",
+    "annot/cache/0123.h5", "annot/tmp/part1.out",
+    "abundance/S_filtered_out_clones.txt",
+    "productivity/S_refined_clones_annot.h5", "productivity/S_clones_seq.h5", "productivity/S_refinement_flagged.txt",
+    "productivity/S_refinement_flagged_summary.txt", "productivity/S_filtered_out_clones.txt",
+    "restriction_sites/S_filtered_out_clones.txt",
+    "secretion/S_secsig_1_40.fasta", "utr5/S_5utr_1_40.fasta",
+    "primer_specificity/S_primer_annot.h5", "primer_specificity/S_filtered_out_clones.txt",
+]
+_AUX_FILES = [
+    "fastqc/S_fastqc.html",
+    "annot/S_all_clones_len_dist.csv", "annot/S_all_clones_len_dist.png", "annot/S_all_clones_len_dist_no_outliers.csv",
+    "annot/S_seq_length_dist.csv", "annot/S_seq_length_dist.png", "annot/S_seq_length_dist_no_outliers.csv",
+    "annot/analysis.params",
+    "abundance/S_igv_dist_variant_level.csv",
+    "productivity/S_productivity.csv",
+    "diversity/S_cdr_duplication.csv", "diversity/spectratypes/S_cdr3_spectratype.csv",
+    "restriction_sites/S_sites_rsasimple.csv",
+    "secretion/S_secsig_1_40_dist.csv", "utr5/S_5utr_1_40_dist.csv",
+    "primer_specificity/S_all_5end_integrity_dist.csv",
+]
+
+
+def _sample(tmpdir, name="S"):
+    # the output directories of a sample whose stages all ran
+    hdfDir = str(tmpdir.join("out", "hdf", name))
+    auxDir = str(tmpdir.join("out", "auxiliary", name))
+    for root, files in ((hdfDir, _HDF_FILES), (auxDir, _AUX_FILES)):
+        for f in files:
+            path = os.path.join(root, f.replace("S_", name + "_"))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as fp:
+                fp.write(f)
+    return hdfDir, auxDir
+
+
+def _manifest(tmpdir, stage, name="S"):
+    return StageManifest(str(tmpdir.join("out", "hdf", name, "manifests", stage + ".json")),
+                         root=str(tmpdir.join("out")), ignore=('cache', 'analysis.params'))
+
+
+def test_stages_never_claim_the_same_files(tmpdir):
+    for name in ("S", "S[1]"):
+        hdfDir, auxDir = _sample(tmpdir, name)
+        claimed = {}
+        for stage in STAGES:
+            for path in _manifest(tmpdir, stage, name)._snapshot(stagePaths(stage, hdfDir, auxDir, name)):
+                assert path not in claimed, (path, stage, claimed.get(path))
+                claimed[path] = stage
+        assert claimed[os.path.join(auxDir, "annot", name + "_seq_length_dist.csv")] == 'seqlen'
+        assert claimed[os.path.join(hdfDir, "annot", name + "_clones_annot.h5")] == 'annot'
+        assert claimed[os.path.join(hdfDir, "annot", name + "_filtered_out_clones.txt")] == 'annot_report'
+        # everything but the caches and parameter records belongs to a stage
+        assert len(claimed) == len(_HDF_FILES) + len(_AUX_FILES) - 2
+
+
+def test_interrupted_seqlen_leaves_the_annotation_alone(tmpdir):
+    hdfDir, auxDir = str(tmpdir.join("out", "hdf", "S")), str(tmpdir.join("out", "auxiliary", "S"))
+    paths = stagePaths('seqlen', hdfDir, auxDir, "S")
+    _manifest(tmpdir, 'seqlen').begin({}, [], {}, paths)
+    # the annotation runs alongside seqlen, which is killed before it writes its plots
+    hdfDir, auxDir = _sample(tmpdir)
+    os.remove(os.path.join(auxDir, "annot", "S_seq_length_dist.csv"))
+    _manifest(tmpdir, 'seqlen').clean(paths)
+    assert os.path.exists(os.path.join(hdfDir, "annot", "S_clones_annot.h5"))
+    assert os.path.exists(os.path.join(auxDir, "annot", "S_all_clones_len_dist.csv"))
+    assert not os.path.exists(os.path.join(auxDir, "annot", "S_seq_length_dist.png"))
+
+
+def test_filtering_criteria_only_invalidate_the_reports(tmpdir):
+    hdfDir, auxDir = str(tmpdir.join("out", "hdf", "S")), str(tmpdir.join("out", "auxiliary", "S"))
+    args = dict((arg, 1) for stage in STAGES.values() for arg in stage[1])
+    stages = ['annot', 'annot_report', 'productivity', 'productivity_report', 'primer_specificity',
+              'primer_specificity_report']
+
+    def spec(stage):
+        return dict((arg, args[arg]) for arg in STAGES[stage][1]), dict((up, digests[up]) for up in STAGES[stage][3])
+
+    digests = {}
+    for stage in stages:
+        params, upstream = spec(stage)
+        paths = stagePaths(stage, hdfDir, auxDir, "S")
+        manifest = _manifest(tmpdir, stage)
+        manifest.begin(params, [], upstream, paths)
+        manifest.complete(paths, upstream)
+        digests[stage] = manifest.digest()
+
+    args['bitscore'] = 2
+    for stage in stages:
+        params, upstream = spec(stage)
+        # the unfiltered dataframes are kept
+        assert _manifest(tmpdir, stage).isUpToDate(params, [], upstream) == (not stage.endswith('_report')), stage
@@ -0,0 +1,174 @@
+import os
+import random
+
+from Bio.pairwise2 import align
+
+from abseqPy.IgRepAuxiliary.PatternMatcher import PatternMatcher, seedlessBound
+from abseqPy.IgRepertoire.igRepUtils import findBestMatchedPattern, _alignAllPatterns, calMaxIUPACAlignScores, \
+    subMatIUPAC, fastq2fasta
+
+IUPAC = "ACGTRYSWKMBDHVN"
+
+
+def _patterns(seqs):
+    return list(zip(["p" + str(i) for i in range(len(seqs))], seqs, calMaxIUPACAlignScores(seqs)))
+
+
+def _outcome(fn, *args):
+    # findBestMatchedPattern raises on some alignments (e.g. a gap where a mismatch is looked up), the callers count
+    # them as unexpected
+    try:
+        return fn(*args)
+    except Exception as e:
+        return type(e)
+
+
+def _randomPrimers(rng, number, length):
+    # mostly nucleotides, like real primers, with a few degenerate positions
+    return ["".join(rng.choice(IUPAC) if rng.random() < 0.15 else rng.choice("ACGT") for _ in range(length))
+            for _ in range(number)]
+
+
+def _instance(rng, primer):
+    # a nucleotide sequence matching the primer
+    return "".join(rng.choice([b for b in "ACGT" if subMatIUPAC[(b, c)] == 5]) for c in primer)
+
+
+def _mutate(rng, seq):
+    seq = list(seq)
+    for _ in range(rng.randint(1, 3)):
+        pos = rng.randrange(len(seq))
+        kind = rng.choice(("substitution", "insertion", "deletion"))
+        if kind == "substitution":
+            seq[pos] = rng.choice("ACGT")
+        elif kind == "insertion":
+            seq.insert(pos, rng.choice("ACGT"))
+        elif len(seq) > 1:
+            del seq[pos]
+    return "".join(seq)
+
+
+def _windows(rng, primers, number):
+    length = max(len(p) for p in primers)
+    for _ in range(number):
+        kind = rng.random()
+        primer = rng.choice(primers)
+        if kind < 0.3:
+            yield _instance(rng, primer)
+        elif kind < 0.8:
+            yield _mutate(rng, _instance(rng, primer))[:length]
+        else:
+            yield "".join(rng.choice("ACGT") for _ in range(rng.randint(0, length + 3)))
+
+
+def test_findBestMatchedPattern_same_as_aligning_all_patterns():
+    rng = random.Random(21)
+    for length, number in ((20, 12), (12, 30), (25, 4)):
+        primers = _randomPrimers(rng, number, length)
+        patterns = _patterns(primers)
+        for window in _windows(rng, primers, 60):
+            for extend5end in (False, True):
+                assert _outcome(findBestMatchedPattern, window, patterns, extend5end) == \
+                    _outcome(_alignAllPatterns, window, patterns, extend5end), window
+
+
+def test_findBestMatchedPattern_primers_of_different_lengths():
+    rng = random.Random(22)
+    primers = _randomPrimers(rng, 6, 18) + _randomPrimers(rng, 6, 22) + _randomPrimers(rng, 3, 9)
+    rng.shuffle(primers)
+    patterns = _patterns(primers)
+    for window in _windows(rng, primers, 80):
+        assert _outcome(findBestMatchedPattern, window, patterns) == _outcome(_alignAllPatterns, window, patterns), \
+            window
+
+
+def test_findBestMatchedPattern_intact():
+    patterns = _patterns(["ACGTACGTAC", "ACGTRCGTAC", "TTTTTTTTTT"])
+    # the first intact primer wins
+    assert findBestMatchedPattern("ACGTACGTAC", patterns) == ("p0", 0, 0, 0, 10)
+    assert findBestMatchedPattern("ACGTGCGTAC", patterns) == ("p1", 0, 0, 0, 10)
+    assert findBestMatchedPattern("acgtgcgtac", patterns) == ("p1", 0, 0, 0, 10)
+    # nothing in common with the first primer
+    assert findBestMatchedPattern("GGGG", patterns) == ("nan", 0, 0, -1, -1)
+    assert findBestMatchedPattern("", patterns) == ("nan", 0, 0, -1, -1)
+    assert findBestMatchedPattern("ACGT", []) == ("nan", 0, 0, -1, -1)
+
+
+def test_findBestMatchedPattern_unsupported_sequences():
+    # sequences with other letters than A, C, G and T are aligned against all the patterns
+    rng = random.Random(23)
+    primers = _randomPrimers(rng, 8, 15)
+    patterns = _patterns(primers)
+    for window in _windows(rng, primers, 30):
+        window = list(window)
+        if window:
+            window[rng.randrange(len(window))] = "N"
+        window = "".join(window)
+        assert _outcome(findBestMatchedPattern, window, patterns) == _outcome(_alignAllPatterns, window, patterns), \
+            window
+
+
+def test_patternMatcher_scores():
+    rng = random.Random(24)
+    primers = _randomPrimers(rng, 10, 16) + _randomPrimers(rng, 5, 11)
+    matcher = PatternMatcher(_patterns(primers))
+    assert matcher.supported
+    for window in _windows(rng, primers, 40):
+        if not window:
+            continue
+        expected = [align.localds(window, p, subMatIUPAC, -5, -5, score_only=True) for p in primers]
+        assert list(matcher.scores(matcher.encode(window))) == expected, window
+
+
+def _family(rng, number, length):
+    # primers of a panel that differ at a few positions, so that windows share seeds with many of them
+    root = _randomPrimers(rng, 1, length)[0]
+    return [_mutate(rng, root)[:length] for _ in range(number)]
+
+
+def test_patternMatcher_bestPattern_large_panels():
+    rng = random.Random(25)
+    primers = _family(rng, 40, 20) + _randomPrimers(rng, 40, 20) + _family(rng, 20, 24) + ["NNNNNNNNACGT"]
+    patterns = _patterns(primers)
+    matcher = PatternMatcher(patterns)
+    assert matcher.unindexed == [len(primers) - 1]
+    for window in _windows(rng, primers, 150):
+        query = matcher.encode(window)
+        scores = list(matcher.scores(query))
+        # brute force: every pattern in order
+        expected = (None, False)
+        for i, (_, primer, maxScore) in enumerate(patterns):
+            if scores[i] == 0:
+                break
+            if scores[i] == maxScore and len(window) == len(primer):
+                expected = (i, True)
+                break
+        else:
+            expected = (scores.index(max(scores)), False)
+        assert matcher.bestPattern(query) == expected, window
+
+
+def test_seedlessBound():
+    rng = random.Random(26)
+    primers = _randomPrimers(rng, 30, 20)
+    matcher = PatternMatcher(_patterns(primers))
+    for window in _windows(rng, primers, 100):
+        query = matcher.encode(window)
+        scores = matcher.scores(query)
+        seeded = set()
+        for seed in query[4]:
+            seeded.update(matcher.seeds.get(seed, ()))
+        assert all(scores[i] <= seedlessBound(len(primers[i])) for i in range(len(primers)) if i not in seeded)
+
+
+def test_fastq2fasta_counts_the_converted_reads(tmpdir):
+    fastqFile = str(tmpdir.join("sample.fastq"))
+    with open(fastqFile, "w") as fp:
+        # the second quality line starts with @
+        fp.write("@read1\nACGT\n+\nIIII\n@read2\nGGC\n+\n@II\n")
+    fastaFile, noSeqs = fastq2fasta(fastqFile, str(tmpdir))
+    assert fastaFile == os.path.join(str(tmpdir), "seq", "sample.fasta") and noSeqs == 2
+    with open(fastaFile) as fp:
+        assert fp.read().split() == [">read1", "ACGT", ">read2", "GGC"]
+    # an existing FASTA file is not converted, nor counted, again
+    assert fastq2fasta(fastqFile, str(tmpdir)) == (fastaFile, None)